@@ -5,6 +5,10 @@ from django.views.decorators.debug import sensitive_post_parameters
 from django.contrib.auth.decorators import login_required
 from django.utils import timezone
 from django.views import View
+from django.db import transaction
+from django.db.models import Q, Value, Count, Min, Max
+from django.db.models.functions import Coalesce
+from django.core.exceptions import ValidationError
 
 
 from django.contrib.auth.models import User
@@ -16,10 +20,13 @@ from . import forms
 from . import signals
 from . import fixed_data
 from . import form_handlers
+from . import qc
+from . import metric_store
 from .form_handlers import _format_tuple
 
 
 import json
+import os
 import uuid
 import datetime
 
@@ -74,12 +81,18 @@ def wrap_api_v2(request, f, permission=None, oauth_permission=None, partial=Fals
     if hasattr(request, "tatl_oauth") and request.tatl_oauth:
         oauth = True
 
-        # borrowed from the oauth2_provider backend
-        from oauth2_provider.oauth2_backends import get_oauthlib_core
-        OAuthLibCore = get_oauthlib_core()
+        scopes = oauth_permission.split(" ") if oauth_permission else []
+        token = getattr(request, "tatl_oauth_token", None)
+        if token:
+            # the token was already verified by TempOAuth2TokenMiddleware, just check the scopes
+            valid = token.is_valid(scopes)
+        else:
+            # borrowed from the oauth2_provider backend
+            from oauth2_provider.oauth2_backends import get_oauthlib_core
+            OAuthLibCore = get_oauthlib_core()
 
-        # now check the request for the right scopes
-        valid, r = OAuthLibCore.verify_request(request, scopes=oauth_permission.split(" ") if oauth_permission else [])
+            # now check the request for the right scopes
+            valid, r = OAuthLibCore.verify_request(request, scopes=scopes)
         if valid:
             profile = request.user.profile
             user = request.user
@@ -96,35 +109,26 @@ def wrap_api_v2(request, f, permission=None, oauth_permission=None, partial=Fals
             # GET API endpoints are OAuth only
             return HttpResponseBadRequest()
 
-        try:
-            # Check new key validity
-            key = models.ProfileAPIKey.objects.get(key=json_data["token"], profile__user__username=json_data["username"], was_revoked=False, validity_start__lt=timezone.now(), validity_end__gt=timezone.now())
-            profile = key.profile
-        except:
+        # Check new key validity, and that permission has been granted to both the user and key
+        # Validations are cached by util.get_api_key_auth and dropped by majora2.receivers on change
+        profile, permitted = util.get_api_key_auth(json_data["token"], json_data["username"], permission)
+        if not profile:
             return HttpResponseBadRequest()
             #api_o["messages"].append("That key does not exist, has expired or was revoked")
             #api_o["errors"] += 1
             #bad = True
         user = profile.user
 
-        if permission:
-            # Check permission has been granted to user
-            if not user.has_perm(permission):
-                return HttpResponseBadRequest()
-
-            # Check permission has been granted to key
-            if not key.key_definition.permission:
-                return HttpResponseBadRequest()
-            if key.key_definition.permission.codename != permission.split('.')[1]:
-                return HttpResponseBadRequest()
+        if permission and not permitted:
+            return HttpResponseBadRequest()
 
     # If in doubt
     if not profile or not user.is_active or user.profile.is_revoked:
         return HttpResponseBadRequest()
 
+    # The treq is written once by TatlRequestLogMiddleware when the response is ready
     request.treq.is_api = True
     request.treq.user = user
-    request.treq.save()
 
     if permission and not oauth:
         tflex = TatlPermFlex(
@@ -143,7 +147,6 @@ def wrap_api_v2(request, f, permission=None, oauth_permission=None, partial=Fals
             try:
                 user = models.Profile.objects.get(user__username=json_data["sudo_as"]).user
                 request.treq.substitute_user = user
-                request.treq.save()
 
                 if permission and not oauth:
                     tflex.substitute_user = user
@@ -170,13 +173,13 @@ def wrap_api_v2(request, f, permission=None, oauth_permission=None, partial=Fals
             bad = True
 
     # Call the wrapped function
+    possible_fstream = None
     if not bad and profile:
         possible_fstream = f(request, api_o, json_data, user=user, partial=partial)
 
     api_o["success"] = api_o["errors"] == 0
 
     end_ts = timezone.now()
-    request.treq.save()
 
     if stream and possible_fstream:
         return possible_fstream
@@ -187,9 +190,20 @@ def wrap_api_v2(request, f, permission=None, oauth_permission=None, partial=Fals
 def handle_metadata(metadata, tag_type, tag_to, user, api_o):
 
     changed_fields = []
+    stale_artifacts = set([])
     #nulled_fields = []
 
+    # Resolve the target once, rather than once per key through TestMetadataForm.
+    # If that fails, drop to the per key forms which will report the problem.
+    target = None
+    if tag_type in ["artifact", "group", "process"]:
+        try:
+            target = forms.TestMetadataForm.base_fields[tag_type].clean(tag_to)
+        except ValidationError:
+            pass
+
     ts = timezone.now()
+    metadata_forms = []
     for tag_key in metadata:
         for key in metadata[tag_key]:
             t_data = {
@@ -199,18 +213,16 @@ def handle_metadata(metadata, tag_type, tag_to, user, api_o):
             }
             t_data["name"] = key
             t_data["value"] = metadata[tag_key][key]
-            form = forms.TestMetadataForm(t_data)
+            if target:
+                form = forms.TestMetadataValueForm(t_data)
+            else:
+                form = forms.TestMetadataForm(t_data)
             if form.is_valid():
+                if target:
+                    metadata_forms.append(form)
+                    continue
                 majora_meta, created, updated = form_handlers.handle_testmetadata(form, user=user, api_o=api_o)
-                if not created:
-                    #TODO catch
-                    pass
-                if not majora_meta:
-                    api_o["warnings"] += 1
-                    api_o["ignored"].append("metadata__%s__%s" % (t_data.get("tag"), t_data.get("name")))
-
-                if updated:
-                    changed_fields.append("metadata:%s.%s" % (t_data.get("tag"), t_data.get("name")))
+                _handle_metadata_result(majora_meta, created, updated, t_data, changed_fields, stale_artifacts, api_o)
 
                 #if t_data.get("value") is None:
                 #    # Nuke the record if it has been None'd
@@ -220,129 +232,189 @@ def handle_metadata(metadata, tag_type, tag_to, user, api_o):
                 api_o["errors"] += 1
                 api_o["ignored"].append("metadata__%s__%s" % (t_data.get("tag"), t_data.get("name")))
                 api_o["messages"].append(form.errors.get_json_data())
+
+    if len(metadata_forms) > 0:
+        results = form_handlers.handle_testmetadata_bulk(tag_type, target, metadata_forms, user=user, api_o=api_o)
+        for form, (majora_meta, created, updated) in zip(metadata_forms, results):
+            _handle_metadata_result(majora_meta, created, updated, form.cleaned_data, changed_fields, stale_artifacts, api_o)
+
+    if len(stale_artifacts) > 0:
+        util.mark_pag_exports_stale(artifacts=stale_artifacts)
     return changed_fields
 
+def _handle_metadata_result(majora_meta, created, updated, t_data, changed_fields, stale_artifacts, api_o):
+    if not created:
+        #TODO catch
+        pass
+    if not majora_meta:
+        api_o["warnings"] += 1
+        api_o["ignored"].append("metadata__%s__%s" % (t_data.get("tag"), t_data.get("name")))
+
+    if updated:
+        changed_fields.append("metadata:%s.%s" % (t_data.get("tag"), t_data.get("name")))
+        if majora_meta and majora_meta.artifact_id:
+            stale_artifacts.add(majora_meta.artifact_id)
+
+# Metric namespaces accepted by the API, with the model and form that handle each
+METRIC_FORMS = {
+    "sequence": (models.TemporaryMajoraArtifactMetric_Sequence, forms.M2Metric_SequenceForm),
+    "mapping": (models.TemporaryMajoraArtifactMetric_Mapping, forms.M2Metric_MappingForm),
+    "tile-mapping": (models.TemporaryMajoraArtifactMetric_Mapping_Tiles, forms.M2Metric_MappingTileForm),
+    "ct": (models.TemporaryMajoraArtifactMetric_ThresholdCycle, forms.M2Metric_ThresholdCycleForm),
+}
+
 #TODO Abstract this away info form handlers per-metric, use modelforms properly
 def handle_metrics(metrics, tag_type, tag_to, user, api_o):
-    updated_metrics = []
-
-    ts = timezone.now()
-    for metric in metrics:
-        metrics[metric]["artifact"] = tag_to.id
-        metrics[metric]["namespace"] = metric
-
-        is_model = True
-        if metric == "sequence":
-            m = models.TemporaryMajoraArtifactMetric_Sequence.objects.filter(artifact=tag_to).first()
-            form = forms.M2Metric_SequenceForm(metrics[metric], instance=m)
-        elif metric == "mapping":
-            m = models.TemporaryMajoraArtifactMetric_Mapping.objects.filter(artifact=tag_to).first()
-            form = forms.M2Metric_MappingForm(metrics[metric], instance=m)
-        elif metric == "tile-mapping":
-            m = models.TemporaryMajoraArtifactMetric_Mapping_Tiles.objects.filter(artifact=tag_to).first()
-            form = forms.M2Metric_MappingTileForm(metrics[metric], instance=m)
-        elif metric == "ct":
-            m = models.TemporaryMajoraArtifactMetric_ThresholdCycle.objects.filter(artifact=tag_to).first()
-            metrics[metric]["num_tests"] = 0
-            metrics[metric]["min_ct"] = 0
-            metrics[metric]["max_ct"] = 0
-            form = forms.M2Metric_ThresholdCycleForm(metrics[metric], instance=m)
-
-            # Catch null values gently on uploader
-            any_ct = False
-            for metric_rec_name in metrics[metric].get("records", {}):
-                metric_rec = metrics[metric]["records"][metric_rec_name]
-                if metric_rec.get("ct_value"):
-                    any_ct = True
-            if not any_ct:
-                api_o["ignored"].append("%s" % metric)
-                api_o["messages"].append("'%s' records look empty" % metric)
+    return handle_metrics_many([(tag_to, metrics)], api_o).get(tag_to.id, [])
+
+# Validate and write the metrics of many artifacts, given as a list of (artifact, metrics) pairs
+# Existing metrics are fetched with one query per namespace and Ct records are replaced for the
+# whole batch at once, with num_tests, min_ct and max_ct recomputed by a single aggregate query.
+# Returns a dict of the updated artifact IDs, each mapped to the list of metrics whose records were replaced
+def handle_metrics_many(entries, api_o, namespaces=None):
+    if namespaces is None:
+        namespaces = METRIC_FORMS.keys()
+
+    existing = {}
+    wanted = {}
+    for artifact, metrics in entries:
+        for metric in metrics:
+            if metric in namespaces and isinstance(metrics[metric], dict):
+                wanted.setdefault(metric, set()).add(artifact.id)
+    for metric, artifact_ids in wanted.items():
+        # Iterate backwards so the first metric of each artifact wins, like .first() did
+        for m in METRIC_FORMS[metric][0].objects.filter(artifact_id__in=artifact_ids).order_by('-id'):
+            existing[(metric, m.artifact_id)] = m
+
+    updated = {}
+    updated_tuples = [] # reported once the writes have committed
+    pending = {}
+    ct_records = {}
+    for artifact, metrics in entries:
+        for metric in metrics:
+            if metric not in namespaces:
+                api_o["ignored"].append(metric)
+                api_o["messages"].append("'%s' does not describe a valid metric" % metric)
                 api_o["warnings"] += 1
                 continue
-        else:
-            api_o["ignored"].append(metric)
-            api_o["messages"].append("'%s' does not describe a valid metric" % metric)
-            api_o["warnings"] += 1
-            continue
+            if not isinstance(metrics[metric], dict):
+                api_o["errors"] += 1
+                api_o["ignored"].append(metric)
+                api_o["messages"].append("'%s' is not an object" % metric)
+                continue
+            model, form_cls = METRIC_FORMS[metric]
+            metric_data = dict(metrics[metric])
+            metric_data["namespace"] = metric
+
+            if metric == "ct":
+                # Aggregates are recomputed from the records once they are written
+                metric_data["num_tests"] = 0
+                metric_data["min_ct"] = 0
+                metric_data["max_ct"] = 0
+
+                # Catch null values gently on uploader
+                if not any(metric_rec.get("ct_value") for metric_rec in metric_data.get("records", {}).values()):
+                    api_o["ignored"].append("%s" % metric)
+                    api_o["messages"].append("'%s' records look empty" % metric)
+                    api_o["warnings"] += 1
+                    continue
 
-        if form.is_valid():
-            try:
-                metric_ob = form.save()
-                if metric_ob:
-                    api_o["updated"].append(_format_tuple(tag_to))
-
-                    # Handle optional records
-                    first_valid = True
-                    for metric_rec_name in metrics[metric].get("records", {}):
-                        metric_rec = metrics[metric]["records"][metric_rec_name]
-                        if metric == "ct":
-                            metric_rec["artifact_metric"] = metric_ob
-                            form = forms.M2MetricRecord_ThresholdCycleForm(metric_rec)
-                            # Catch null values gently on uploader
-                            if not metric_rec.get("ct_value"):
-                                api_o["ignored"].append("%s:%s" % (metric, metric_rec_name))
-                                api_o["warnings"] += 1
-                                continue
-                            if form.is_valid():
-                                if first_valid:
-                                    # Destroy existing records
-                                    dc = metric_ob.metric_records.all().delete()[0] # bye
-                                    if dc > 0:
-                                        api_o["messages"].append("%d existing Ct value records deleted and replaced with new values" % int(dc/2))
-                                        updated_metrics = [metric]
-                                    first_valid = False
-                                try:
-                                    artifact_metric = form.cleaned_data["artifact_metric"]
-                                    rec_obj, rec_obj_created = models.TemporaryMajoraArtifactMetricRecord_ThresholdCycle.objects.get_or_create(
-                                            artifact_metric = artifact_metric,
-                                            test_platform = form.cleaned_data.get("test_platform"),
-                                            test_target = form.cleaned_data.get("test_target"),
-                                            test_kit = form.cleaned_data.get("test_kit"),
-                                    )
-                                    if rec_obj:
-                                        rec_obj.ct_value = form.cleaned_data["ct_value"]
-                                        rec_obj.save()
-                                        artifact_metric.num_tests = len(artifact_metric.metric_records.all())
-                                        ct_min = None
-                                        ct_max = None
-                                        for record in artifact_metric.metric_records.all():
-                                            ct = record.ct_value
-                                            if not ct_min:
-                                                ct_min = ct
-                                            elif ct < ct_min:
-                                                ct_min = ct
-
-                                            if not ct_max:
-                                                ct_max = ct
-                                            elif ct > ct_max:
-                                                ct_max = ct
-
-                                        artifact_metric.min_ct = ct_min
-                                        artifact_metric.max_ct = ct_max
-                                        artifact_metric.save()
-
-                                    if not rec_obj:
-                                        api_o["ignored"].append("%s:%s" % (metric, metric_rec_name))
-                                        api_o["errors"] += 1
-                                except Exception as e:
-                                    api_o["errors"] += 1
-                                    api_o["messages"].append(str(e))
-                            else:
-                                api_o["errors"] += 1
-                                api_o["ignored"].append("%s:%s" % (metric, metric_rec_name))
-                                api_o["messages"].append(form.errors.get_json_data())
-                        # End Metric Records
-                else:
-                    api_o["ignored"].append(metric)
-                    api_o["errors"] += 1
-            except Exception as e:
+            form = form_cls(metric_data, instance=existing.get((metric, artifact.id)) or model(artifact=artifact))
+            if not form.is_valid():
                 api_o["errors"] += 1
-                api_o["messages"].append(str(e))
-        else:
-            api_o["errors"] += 1
-            api_o["ignored"].append(metric)
-            api_o["messages"].append(form.errors.get_json_data())
-    return updated_metrics
+                api_o["ignored"].append(metric)
+                api_o["messages"].append(form.errors.get_json_data())
+                continue
+            metric_ob = form.save(commit=False)
+            existing[(metric, artifact.id)] = metric_ob
+            pending[(metric, artifact.id)] = (metric_ob, list(form.fields))
+            updated.setdefault(artifact.id, [])
+            updated_tuples.append(_format_tuple(artifact))
+
+            if metric == "ct":
+                # Records are keyed by their test, so a repeated test keeps its last value
+                records = ct_records.setdefault(artifact.id, {})
+                for metric_rec_name in metric_data.get("records", {}):
+                    metric_rec = metric_data["records"][metric_rec_name]
+                    # Catch null values gently on uploader
+                    if not metric_rec.get("ct_value"):
+                        api_o["ignored"].append("%s:%s" % (metric, metric_rec_name))
+                        api_o["warnings"] += 1
+                        continue
+                    rec_form = forms.M2MetricRecord_ThresholdCycleForm(metric_rec)
+                    if rec_form.is_valid():
+                        records[(
+                            rec_form.cleaned_data.get("test_platform"),
+                            rec_form.cleaned_data.get("test_target"),
+                            rec_form.cleaned_data.get("test_kit"),
+                        )] = rec_form.cleaned_data["ct_value"]
+                    else:
+                        api_o["errors"] += 1
+                        api_o["ignored"].append("%s:%s" % (metric, metric_rec_name))
+                        api_o["messages"].append(rec_form.errors.get_json_data())
+
+    if len(pending) == 0:
+        return updated
+
+    try:
+        with transaction.atomic(), metric_store.deferred():
+            # Metrics are multi-table models, so new ones are saved in turn and existing ones updated in bulk
+            to_update = {}
+            for metric_ob, fields in pending.values():
+                if metric_ob.pk:
+                    to_update.setdefault(type(metric_ob), ([], fields))[0].append(metric_ob)
+                else:
+                    metric_ob.save()
+            for model, (metric_obs, fields) in to_update.items():
+                model.objects.bulk_update(metric_obs, fields)
+
+            ct_metrics = {artifact_id: pending[("ct", artifact_id)][0] for artifact_id in ct_records if ("ct", artifact_id) in pending}
+            replaced = {artifact_id: ct_metrics[artifact_id] for artifact_id, records in ct_records.items() if len(records) > 0}
+            if len(replaced) > 0:
+                # Destroy existing records
+                old_records = models.TemporaryMajoraArtifactMetricRecord.objects.filter(artifact_metric__in=[m.pk for m in replaced.values()])
+                n_old = {}
+                for metric_id in old_records.values_list('artifact_metric', flat=True):
+                    n_old[metric_id] = n_old.get(metric_id, 0) + 1
+                if len(n_old) > 0:
+                    old_records.delete() # bye
+                for artifact_id, artifact_metric in replaced.items():
+                    if n_old.get(artifact_metric.pk):
+                        api_o["messages"].append("%d existing Ct value records deleted and replaced with new values" % n_old[artifact_metric.pk])
+                        updated[artifact_id] = ["ct"]
+
+                    # Records are multi-table models too, and cannot be bulk created
+                    for (test_platform, test_target, test_kit), ct_value in ct_records[artifact_id].items():
+                        models.TemporaryMajoraArtifactMetricRecord_ThresholdCycle(
+                                artifact_metric=artifact_metric,
+                                test_platform=test_platform,
+                                test_target=test_target,
+                                test_kit=test_kit,
+                                ct_value=ct_value,
+                        ).save()
+
+            if len(ct_metrics) > 0:
+                # Recompute the Ct aggregates of the whole batch together
+                aggregates = {
+                    agg["artifact_metric"]: agg for agg in models.TemporaryMajoraArtifactMetricRecord_ThresholdCycle.objects.filter(
+                        artifact_metric__in=[m.pk for m in ct_metrics.values()]
+                    ).values('artifact_metric').annotate(num_tests=Count('pk'), min_ct=Min('ct_value'), max_ct=Max('ct_value')).order_by()
+                }
+                for artifact_metric in ct_metrics.values():
+                    agg = aggregates.get(artifact_metric.pk, {})
+                    artifact_metric.num_tests = agg.get("num_tests") or 0
+                    artifact_metric.min_ct = agg.get("min_ct") or 0
+                    artifact_metric.max_ct = agg.get("max_ct") or 0
+                models.TemporaryMajoraArtifactMetric_ThresholdCycle.objects.bulk_update(list(ct_metrics.values()), ["num_tests", "min_ct", "max_ct"])
+
+            # Bulk updates skip the signals that write metrics through to the store
+            metric_store.touch([artifact_id for metric, artifact_id in pending])
+    except Exception as e:
+        api_o["errors"] += 1
+        api_o["messages"].append(str(e))
+        return {}
+    api_o["updated"].extend(updated_tuples)
+    return updated
 
 
 
@@ -509,197 +581,25 @@ def add_qc(request):
             api_o["errors"] += 1
             return
 
-        t_group = models.PAGQualityTestEquivalenceGroup.objects.filter(slug=test_name).first()
-        if not t_group:
+        plan = qc.get_plan(test_name)
+        if not plan:
             api_o["messages"].append("Invalid 'test_name'")
             api_o["ignored"].append(pag_name)
             api_o["errors"] += 1
             return
 
-        # Gather metrics from PAG
-        metrics = {}
-        for artifact in pag.tagged_artifacts.all():
-            # For this project we don't need to worry about duplicates
-            # but this is an outstanding problem... TODO
-            for metric in artifact.metrics.all():
-                if metric.namespace:
-                    if metric.namespace not in metrics:
-                        metrics[metric.namespace] = metric.as_struct()
-                    else:
-                        api_o["messages"].append("Cannot automatically QC a PAG with multiple objects containing the same metric type...")
-                        api_o["errors"] += 1
-                        return
-
-        # Gather metadata from PAG
-        metadata = {}
-        for artifact in pag.tagged_artifacts.all():
-            curr_meta = artifact.get_metadata_as_struct()
-            for namespace in curr_meta:
-                if namespace not in metadata:
-                    metadata[namespace] = {}
-                for meta_name in curr_meta[namespace]:
-                    if meta_name not in metadata[namespace]:
-                        metadata[namespace][meta_name] = curr_meta[namespace][meta_name]
-                    elif metadata[namespace][meta_name] != curr_meta[namespace][meta_name]:
-                        api_o["messages"].append("Cannot automatically QC a PAG with multiple objects containing the same metadata fields with different values...")
-                        api_o["errors"] += 1
-                        return
-                    else:
-                        pass
-
-        n_fails = 0
-        test_data = {}
-        all_skipped = True # flag to determine at least one QC test was run
-        for test in t_group.tests.all():
-            # Get the latest test version
-            tv = test.versions.order_by('-version_number').first()
-            test_data[tv] = {
-                "results": {},
-                "decisions": {},
-                "is_pass": None,
-                "is_skip": None,
-            }
-
-            is_match = False
-            is_skip = False
-            # Determine if we need to skip this test
-            for tfilter in test.filters.all():
-                meta = metadata.get(tfilter.metadata_namespace, {}).get(tfilter.metadata_name, None)
-                if meta:
-                    meta = str(meta).upper()
-                    if tfilter.op == "EQ":
-                        is_match = meta == tfilter.filter_on_str
-                    elif tfilter.op == "NEQ":
-                        is_match = meta != tfilter.filter_on_str
-                    else:
-                        pass
-                    is_skip = not is_match
-                else:
-                    if tfilter.force_field:
-                        api_o["messages"].append("Cannot automatically QC a PAG that is missing required metadata (%s.%s)" % (tfilter.metadata_namespace, tfilter.metadata_name))
-                        api_o["errors"] += 1
-                        return
-
-            if is_skip:
-                test_data[tv]["is_skip"] = True
-                test_data[tv]["is_pass"] = False
-                continue # to next test
-            else:
-                all_skipped = False
-                test_data[tv]["is_skip"] = False
-
-
-            for rule in tv.rules.all():
-                curr_res = {
-                    "rule": rule,
-                    "test_metric_str": None,
-                    "is_pass": None,
-                    "is_warn": None,
-                    "is_fail": None,
-                }
-                # Determine if the test can be performed
-                if rule.metric_namespace not in metrics:
-                    api_o["messages"].append("Namespace %s not found in metrics" % rule.metric_namespace)
-                    api_o["ignored"].append(rule.metric_namespace)
-                    api_o["errors"] += 1
-                    continue
-                if rule.metric_name not in metrics[rule.metric_namespace] or metrics[rule.metric_namespace][rule.metric_name] is None:
-                    api_o["messages"].append("Metric %s.%s not found in metrics" % (rule.metric_namespace, rule.metric_name))
-                    api_o["ignored"].append(rule.metric_name)
-                    api_o["errors"] += 1
-                    continue
-                curr_metric = metrics[rule.metric_namespace][rule.metric_name]
-                curr_res["test_metric_str"] = str(curr_metric)
-
-                if not rule.warn_min and not rule.warn_max:
-                    curr_res["is_warn"] = False
-                else:
-                    # Check warnings
-                    if rule.warn_min:
-                        if curr_metric < rule.warn_min:
-                            curr_res["is_warn"] = True
-                        else:
-                            curr_res["is_warn"] = False
-                    if not curr_res["is_warn"] and rule.warn_max:
-                        if curr_metric >= rule.warn_max:
-                            curr_res["is_warn"] = True
-                        else:
-                            curr_res["is_warn"] = False
-
-                if not rule.fail_min and not rule.fail_max:
-                    curr_res["is_fail"] = False
-                else:
-                    # Check failures
-                    if rule.fail_min:
-                        if curr_metric < rule.fail_min:
-                            curr_res["is_fail"] = True
-                        else:
-                            curr_res["is_fail"] = False
-
-                    if not curr_res["is_fail"] and rule.fail_max:
-                        if curr_metric >= rule.fail_max:
-                            curr_res["is_fail"] = True
-                        else:
-                            curr_res["is_fail"] = False
-
-                curr_res["is_pass"] = not curr_res["is_fail"]
-                test_data[tv]["results"][rule] = curr_res
-
-            #TODO What if the same rule is checked many times? (It should not be anyway but...)
-            if len(test_data[tv]["results"]) != len(tv.rules.all()):
-                api_o["messages"].append("Refusing to create QC report as not all target metrics could be assessed...")
-                api_o["metrics"] = metrics
-                api_o["errors"] += 1
-                return
-
-            curr_test_fails = 0
-            for decision in tv.decisions.all():
-                curr_dec = {
-                    "decision": decision,
-                    "a": None,
-                    "b": None,
-                    "is_pass": None,
-                    "is_warn": None,
-                    "is_fail": None,
-                }
-
-                results = test_data[tv]["results"]
-                if decision.a not in results:
-                    api_o["messages"].append("Could not make a decision for rule as metric appears to have not been selecting for testing")
-                    api_o["errors"] += 1
-                    return
+        # Gather metrics and metadata from PAG
+        metrics, metadata, message = qc.gather_inputs([pag.id])[pag.id]
+        if message:
+            api_o["messages"].append(message)
+            api_o["errors"] += 1
+            return
 
-                curr_dec["a"] = decision.a
-                if not decision.b:
-                    curr_dec["is_warn"] = results[decision.a]["is_warn"]
-                    curr_dec["is_fail"] = results[decision.a]["is_fail"]
-                else:
-                    curr_dec["b"] = decision.b
-                    if decision.b not in results:
-                        api_o["messages"].append("Could not make a decision for rule as metric appears to have not been selecting for testing")
-                        api_o["errors"] += 1
-                        return
-                    if decision.op == "AND":
-                        curr_dec["is_warn"] = results[decision.a]["is_warn"] or results[decision.a]["is_warn"] # Warnings always roll up
-                        curr_dec["is_fail"] = results[decision.a]["is_fail"] and results[decision.b]["is_fail"]
-                    elif decision.op == "OR":
-                        curr_dec["is_warn"] = results[decision.a]["is_warn"] or results[decision.a]["is_warn"]
-                        curr_dec["is_fail"] = results[decision.a]["is_fail"] or results[decision.b]["is_fail"]
-                    else:
-                        api_o["messages"].append("Unknown decision operator encountered")
-                        api_o["errors"] += 1
-                        return
-                curr_dec["is_pass"] = not curr_dec["is_fail"]
-                if not curr_dec["is_pass"]:
-                    n_fails += 1
-                    curr_test_fails += 1
-                test_data[tv]["decisions"][decision] = curr_dec
-            test_data[tv]["is_pass"] = curr_test_fails == 0
-
-            if len(test_data[tv]["decisions"]) != len(tv.decisions.all()):
-                api_o["messages"].append("Refusing to create QC report as not all target metrics could be assessed...")
-                api_o["errors"] += 1
-                return
+        # Evaluate against the compiled plan of the test group, see majora2.qc
+        evaluated = plan.evaluate(metrics, metadata, api_o)
+        if evaluated is None:
+            return
+        test_data, n_fails, all_skipped = evaluated
 
         if all_skipped:
             # See https://github.com/COG-UK/dipi-group/issues/55 for why we default to using at least one QC test
@@ -707,66 +607,54 @@ def add_qc(request):
             api_o["errors"] += 1
             return
 
-        # Looks good?
-        tz_now_dt = timezone.now()
-        is_pass = n_fails == 0
-        ereport_g, created = models.PAGQualityReportEquivalenceGroup.objects.get_or_create(
-                pag = pag,
-                test_group = t_group,
-        )
-        ereport_g.last_updated = tz_now_dt
-        ereport_g.is_pass = is_pass
-        ereport_g.save()
-
-        # Hack a fact to count good pags quickly
-        if test_name == "cog-uk-elan-minimal-qc" and is_pass:
-            try:
-                util.create_or_increment_fact(namespace="pag", key="minimal_qc_pass")
-            except:
-                pass
+        # Looks good? Write the reports and update the PAG's report group together
+        with transaction.atomic():
+            qc.save_reports(plan, [(pag.id, test_data, n_fails)])
 
-        for tv in test_data:
-            report_g, created = models.PAGQualityReportGroup.objects.get_or_create(
-                    pag = pag,
-                    group = ereport_g,
-                    test_set = tv.test,
-            )
-            report_g.is_pass = test_data[tv]["is_pass"]
-            report_g.is_skip = test_data[tv]["is_skip"]
-            report_g.save()
-            report, created = models.PAGQualityReport.objects.get_or_create(
-                    report_group = report_g,
-                    test_set_version = tv,
-                    is_pass = test_data[tv]["is_pass"],
-                    is_skip = test_data[tv]["is_skip"],
-                    timestamp = tz_now_dt,
-            )
-            report.save()
+        api_o["test_results"] = str(test_data)
+    return wrap_api_v2(request, f, oauth_permission="majora2.add_pagqualityreport majora2.change_pagqualityreport")
 
-            if test_data[tv]["is_skip"]:
-                continue
+def rerun_qc(request):
+    def f(request, api_o, json_data, user=None, partial=False):
+        # Re-evaluate a test group over a list of PAGs at once, see majora2.qc.rerun
+        pag_names = json_data.get("publish_group")
+        test_name = json_data.get("test_name")
 
-            saved_rules = {}
-            for rule, rule_result in test_data[tv]["results"].items():
-                rule_result["report"] = report
-                rule_rec, created = models.PAGQualityReportRuleRecord.objects.get_or_create(
-                        **rule_result
-                )
-                rule_rec.save()
-                saved_rules[rule] = rule_rec
+        if not pag_names or not test_name:
+            api_o["messages"].append("'publish_group' or 'test_name' key missing or empty")
+            api_o["errors"] += 1
+            return
+        if type(pag_names) == str:
+            pag_names = [pag_names]
+        max_pags = getattr(settings, "MAJORA_QC_RERUN_MAX", 1000)
+        if len(pag_names) > max_pags:
+            api_o["messages"].append("Too many PAGs, send at most %d per request" % max_pags)
+            api_o["errors"] += 1
+            return
 
-            for decision, decision_result in test_data[tv]["decisions"].items():
-                decision_result["report"] = report
-                decision_result["a"] = saved_rules[decision_result["a"]]
+        plan = qc.get_plan(test_name)
+        if not plan:
+            api_o["messages"].append("Invalid 'test_name'")
+            api_o["errors"] += 1
+            return
 
-                if decision_result["b"]:
-                    decision_result["b"] = saved_rules[decision_result["b"]]
-                dec_rec, created = models.PAGQualityReportDecisionRecord.objects.get_or_create(
-                        **decision_result
-                )
-                dec_rec.save()
+        pag_ids = dict(models.PublishedArtifactGroup.objects.filter(is_latest=True, published_name__in=pag_names).values_list('published_name', 'id'))
+        for pag_name in pag_names:
+            if pag_name not in pag_ids:
+                api_o["messages"].append("Invalid 'publish_group' %s" % pag_name)
+                api_o["ignored"].append(pag_name)
+                api_o["errors"] += 1
 
-        api_o["test_results"] = str(test_data)
+        api_o["results"] = {}
+        for outcome in qc.rerun(plan, list(pag_ids.values()), dry_run=bool(json_data.get("dry_run", False))):
+            api_o["results"][outcome["published_name"]] = {
+                "was_pass": outcome["was_pass"],
+                "is_pass": outcome["is_pass"],
+                "messages": outcome["messages"],
+            }
+            if outcome["is_pass"] is None:
+                api_o["ignored"].append(outcome["published_name"])
+                api_o["errors"] += 1
     return wrap_api_v2(request, f, oauth_permission="majora2.add_pagqualityreport majora2.change_pagqualityreport")
 
 def add_metrics(request):
@@ -797,39 +685,58 @@ def add_metrics(request):
             api_o["errors"] += 1
             return
 
-        for metric in metrics:
-            metrics[metric]["artifact"] = a.id
-            metrics[metric]["namespace"] = metric
-            if metric == "sequence":
-                m = models.TemporaryMajoraArtifactMetric_Sequence.objects.filter(artifact=a).first()
-                form = forms.M2Metric_SequenceForm(metrics[metric], instance=m)
-            elif metric == "mapping":
-                m = models.TemporaryMajoraArtifactMetric_Mapping.objects.filter(artifact=a).first()
-                form = forms.M2Metric_MappingForm(metrics[metric], instance=m)
-            elif metric == "tile-mapping":
-                m = models.TemporaryMajoraArtifactMetric_Mapping_Tiles.objects.filter(artifact=a).first()
-                form = forms.M2Metric_MappingTileForm(metrics[metric], instance=m)
-            else:
-                api_o["ignored"].append(metric)
-                api_o["messages"].append("'%s' does not describe a valid metric" % metric)
-                api_o["warnings"] += 1
+        updated = handle_metrics_many([(a, metrics)], api_o, namespaces=["sequence", "mapping", "tile-mapping"])
+        if len(updated) > 0:
+            util.mark_pag_exports_stale(artifacts=list(updated))
+    return wrap_api_v2(request, f)
+
+
+def add_metrics_batch(request):
+    def f(request, api_o, json_data, user=None, partial=False):
+
+        artifacts = json_data.get("artifacts")
+        if not artifacts or not isinstance(artifacts, list):
+            api_o["messages"].append("'artifacts' key missing, empty or not a list")
+            api_o["errors"] += 1
+            return
+        max_artifacts = getattr(settings, "MAJORA_METRIC_BATCH_MAX", 500)
+        if len(artifacts) > max_artifacts:
+            api_o["messages"].append("Too many artifacts, send at most %d per request" % max_artifacts)
+            api_o["errors"] += 1
+            return
+        artifacts = [entry if isinstance(entry, dict) else {} for entry in artifacts]
+
+        # Resolve the artifacts of the whole batch at once
+        by_name = {}
+        dice_names = set([entry.get("artifact") for entry in artifacts if entry.get("artifact")])
+        if len(dice_names) > 0:
+            by_name = {a.dice_name: a for a in models.MajoraArtifact.objects.filter(dice_name__in=dice_names)}
+        by_path = {}
+        paths = set([entry.get("artifact_path") for entry in artifacts if entry.get("artifact_path") and not entry.get("artifact")])
+        if len(paths) > 0:
+            #TODO Need a much better way to keep track of paths
+            for a in models.DigitalResourceArtifact.objects.filter(current_path__in=paths).order_by('-id'):
+                by_path[a.current_path] = a
+
+        entries = []
+        for entry in artifacts:
+            artifact = entry.get("artifact", "")
+            artifact_path = entry.get("artifact_path", "")
+            if not artifact and not artifact_path:
+                api_o["messages"].append("'artifact' or 'artifact_path' key missing or empty")
+                api_o["errors"] += 1
                 continue
 
-            if form.is_valid():
-                try:
-                    metric = form.save()
-                    if metric:
-                        api_o["updated"].append(_format_tuple(a))
-                    else:
-                        api_o["ignored"].append(metric)
-                        api_o["errors"] += 1
-                except Exception as e:
-                    api_o["errors"] += 1
-                    api_o["messages"].append(str(e))
-            else:
+            a = by_name.get(artifact) if artifact else by_path.get(artifact_path)
+            if not a:
+                api_o["ignored"].append((artifact, artifact_path))
                 api_o["errors"] += 1
-                api_o["ignored"].append(metric)
-                api_o["messages"].append(form.errors.get_json_data())
+                continue
+            entries.append((a, entry.get("metrics") or {}))
+
+        updated = handle_metrics_many(entries, api_o)
+        if len(updated) > 0:
+            util.mark_pag_exports_stale(artifacts=list(updated))
     return wrap_api_v2(request, f)
 
 
@@ -970,148 +877,202 @@ class BiosampleArtifactEndpointView(MajoraEndpointView):
             api_o["messages"].append("'biosamples' key missing or empty")
             api_o["errors"] += 1
 
-        for biosample in biosamples:
-            try:
-                sample_id = biosample.get("central_sample_id")
-                initial = fixed_data.fill_fixed_data("api.artifact.biosample.add", user)
-
-                # Fetch objects for update (if applicable)
-                supp = None
-                sample_p = None
-                source = None
-                bs = models.BiosampleArtifact.objects.filter(central_sample_id=sample_id).first()
-                if bs:
-                    if hasattr(bs, "created"):
-                        sample_p = bs.created
-                    if hasattr(bs.created, "coguk_supp"):
-                        supp = bs.created.coguk_supp
-                    if hasattr(bs, "primary_group"):
-                        source = bs.primary_group
-
-                if partial:
-                    if not bs:
-                        api_o["errors"] += 1
-                        api_o["ignored"].append(sample_id)
-                        api_o["messages"].append("Cannot use `partial` on new BiosampleArtifact %s" % sample_id)
-                        continue
-                    if not sample_p or not sample_p.submission_user:
-                        api_o["errors"] += 1
-                        api_o["ignored"].append(sample_id)
-                        api_o["messages"].append("Cannot use `partial` on empty BiosampleArtifact %s" % sample_id)
-                        continue
-
-                # Pre screen the cog uk supplementary form
-                coguk_supp_form = forms.COGUK_BiosourceSamplingProcessSupplement_ModelForm(biosample, initial=initial, instance=supp, partial=partial)
-                if not coguk_supp_form.is_valid():
-                    api_o["errors"] += 1
-                    api_o["ignored"].append(sample_id)
-                    api_o["messages"].append(coguk_supp_form.errors.get_json_data())
-                    continue
+        initial_fixed = fixed_data.fill_fixed_data("api.artifact.biosample.add", user)
+        samples, sources = self.prefetch(biosamples)
+        dirty = set([])
+        stale_samples = []
 
-                # Pre screen the sample collection process form
-                sample_process_form = forms.BiosourceSamplingProcessModelForm(biosample, initial=initial, instance=sample_p, partial=partial)
-                if not sample_process_form.is_valid():
-                    api_o["errors"] += 1
-                    api_o["ignored"].append(sample_id)
-                    api_o["messages"].append(sample_process_form.errors.get_json_data())
-                    continue
+        with transaction.atomic():
+            for biosample in biosamples:
+                try:
+                    # Each sample gets its own savepoint so a failure part way through
+                    # does not leave a half-written sample behind
+                    with transaction.atomic():
+                        sample_id = biosample.get("central_sample_id")
+                        initial = dict(initial_fixed)
+
+                        # Fetch objects for update (if applicable)
+                        # Samples that did not make it through a previous iteration (eg. a
+                        # duplicate in the request) may have been modified in memory, so go back to the DB
+                        if sample_id in dirty:
+                            samples[sample_id] = models.BiosampleArtifact.objects.filter(central_sample_id=sample_id).first()
+                        dirty.add(sample_id)
+
+                        supp = None
+                        sample_p = None
+                        source = None
+                        bs = samples.get(sample_id)
+                        if bs:
+                            if hasattr(bs, "created"):
+                                sample_p = bs.created
+                            if hasattr(bs.created, "coguk_supp"):
+                                supp = bs.created.coguk_supp
+                            if hasattr(bs, "primary_group"):
+                                source = bs.primary_group
+
+                        if partial:
+                            if not bs:
+                                api_o["errors"] += 1
+                                api_o["ignored"].append(sample_id)
+                                api_o["messages"].append("Cannot use `partial` on new BiosampleArtifact %s" % sample_id)
+                                continue
+                            if not sample_p or not sample_p.submission_user:
+                                api_o["errors"] += 1
+                                api_o["ignored"].append(sample_id)
+                                api_o["messages"].append("Cannot use `partial` on empty BiosampleArtifact %s" % sample_id)
+                                continue
 
-                # Handle new sample
-                sample_form = forms.BiosampleArtifactModelForm(biosample, initial=initial, instance=bs, partial=partial)
-                if not sample_form.is_valid():
-                    api_o["errors"] += 1
-                    api_o["ignored"].append(sample_id)
-                    api_o["messages"].append(sample_form.errors.get_json_data())
-                    continue
+                        # Pre screen the cog uk supplementary form
+                        coguk_supp_form = forms.COGUK_BiosourceSamplingProcessSupplement_ModelForm(biosample, initial=initial, instance=supp, partial=partial)
+                        if not coguk_supp_form.is_valid():
+                            api_o["errors"] += 1
+                            api_o["ignored"].append(sample_id)
+                            api_o["messages"].append(coguk_supp_form.errors.get_json_data())
+                            continue
+
+                        # Pre screen the sample collection process form
+                        sample_process_form = forms.BiosourceSamplingProcessModelForm(biosample, initial=initial, instance=sample_p, partial=partial)
+                        if not sample_process_form.is_valid():
+                            api_o["errors"] += 1
+                            api_o["ignored"].append(sample_id)
+                            api_o["messages"].append(sample_process_form.errors.get_json_data())
+                            continue
+
+                        # Handle new sample
+                        sample_form = forms.BiosampleArtifactModelForm(biosample, initial=initial, instance=bs, partial=partial)
+                        if not sample_form.is_valid():
+                            api_o["errors"] += 1
+                            api_o["ignored"].append(sample_id)
+                            api_o["messages"].append(sample_form.errors.get_json_data())
+                            continue
+
+                        # Hit it
+                        sample = sample_form.save(commit=False)
+                        if not sample:
+                            api_o["errors"] += 1
+                            api_o["ignored"].append(sample_id)
+                            continue
+
+                        # Create (or fetch) the biosample source (host)
+                        #TODO There is a form for this but it seems overkill for one field
+                        source_created = None
+                        biosample_source_id = biosample.get("biosample_source_id")
+                        if biosample_source_id:
+                            source = sources.get(biosample_source_id)
+                            if not source or source.secondary_id != biosample_source_id or source.source_type != initial.get("source_type") or not source.physical:
+                                source, source_created = models.BiosampleSource.objects.get_or_create(
+                                        dice_name=biosample_source_id,
+                                        secondary_id=biosample_source_id,
+                                        source_type = initial.get("source_type"), # previously fetched from form
+                                        physical=True,
+                                )
+                                source.save()
+
+                        # Create and save the sample collection process
+                        sample_p = sample_process_form.save(commit=False)
+                        if not sample_p.who:
+                            submission_org = user.profile.institute if hasattr(user, "profile") and not user.profile.institute.code.startswith("?") else None
+                            if submission_org:
+                                sample_p.submitted_by = submission_org.name
+                                sample_p.submission_org = submission_org
+                            sample_p.who = user
+                            sample_p.when = sample_p.collection_date if sample_p.collection_date else sample_p.received_date
+                            sample_p.submission_user = user
+                        sample_p.save()
+
+                        # Update remaining sample fields
+                        sample.dice_name = sample.central_sample_id
+                        sample.primary_group = source
+                        sample.save()
+
+                        # Bind sample and sample collection process if sample_p is new
+                        if not sample.created:
+                            sample.created = sample_p
+                            if sample_p.records.count() == 0:
+                                sampling_rec = models.BiosourceSamplingProcessRecord(
+                                    process=sample_p,
+                                    in_group=sample.primary_group,
+                                    out_artifact=sample,
+                                )
+                                sampling_rec.save()
+                            sample.save()
+
+                        # Create and link the supplementary model data
+                        coguk_supp = coguk_supp_form.save(commit=False)
+                        coguk_supp.sampling = sample.created
+                        coguk_supp.save()
+
+                        # Hack to fix source if it has been changed at some point
+                        #TODO This only works in the cog context where we can assume 1:1 between sample and collection
+                        if source and sample.created:
+                            for record in sample.created.records.all():
+                                if record.in_group_id != source.id and record.out_artifact_id == sample.id:
+                                    record.in_group = source
+                                    record.save()
+
+                        updated_metadata_l = handle_metadata(biosample.get("metadata", {}), 'artifact', sample.dice_name, user, api_o)
+                        updated_metrics_l = handle_metrics(biosample.get("metrics", {}), 'artifact', sample, user, api_o) #TODO clean this as it duplicates the add_metric view
+
+                        if not bs and sample:
+                            # Created
+                            if api_o:
+                                api_o["new"].append(_format_tuple(sample))
+                                TatlVerb(request=request.treq, verb="CREATE", content_object=sample).save()
+                        else:
+                            stale_samples.append(sample.id)
+                            changed_data_d = forms.MajoraPossiblePartialModelForm.merge_changed_data(
+                                    coguk_supp_form, sample_process_form, sample_form
+                            )
+                            changed_data_d["changed_metadata"] = updated_metadata_l
+                            changed_data_d["flashed_metrics"] = updated_metrics_l
+
+                            if api_o:
+                                api_o["updated"].append(_format_tuple(sample))
+                                TatlVerb(request=request.treq, verb="UPDATE", content_object=sample, extra_context=json.dumps(changed_data_d)).save()
+                        if source_created:
+                            if api_o:
+                                api_o["new"].append(_format_tuple(source))
+                                TatlVerb(request=request.treq, verb="CREATE", content_object=source).save()
+
+                        samples[sample_id] = sample
+                        dirty.discard(sample_id)
 
-                # Hit it
-                sample = sample_form.save(commit=False)
-                if not sample:
+                except Exception as e:
                     api_o["errors"] += 1
-                    api_o["ignored"].append(sample_id)
-                    continue
-
-                # Create (or fetch) the biosample source (host)
-                #TODO There is a form for this but it seems overkill for one field
-                source_created = None
-                biosample_source_id = biosample.get("biosample_source_id")
-                if biosample_source_id:
-                    source, source_created = models.BiosampleSource.objects.get_or_create(
-                            dice_name=biosample_source_id,
-                            secondary_id=biosample_source_id,
-                            source_type = initial.get("source_type"), # previously fetched from form
-                            physical=True,
-                    )
-                    source.save()
-
-                # Create and save the sample collection process
-                sample_p = sample_process_form.save(commit=False)
-                if not sample_p.who:
-                    submission_org = user.profile.institute if hasattr(user, "profile") and not user.profile.institute.code.startswith("?") else None
-                    if submission_org:
-                        sample_p.submitted_by = submission_org.name
-                        sample_p.submission_org = submission_org
-                    sample_p.who = user
-                    sample_p.when = sample_p.collection_date if sample_p.collection_date else sample_p.received_date
-                    sample_p.submission_user = user
-                sample_p.save()
-
-                # Update remaining sample fields
-                sample.dice_name = sample.central_sample_id
-                sample.primary_group = source
-                sample.save()
-
-                # Bind sample and sample collection process if sample_p is new
-                if not sample.created:
-                    sample.created = sample_p
-                    if sample_p.records.count() == 0:
-                        sampling_rec = models.BiosourceSamplingProcessRecord(
-                            process=sample_p,
-                            in_group=sample.primary_group,
-                            out_artifact=sample,
-                        )
-                        sampling_rec.save()
-                    sample.save()
-
-                # Create and link the supplementary model data
-                coguk_supp = coguk_supp_form.save(commit=False)
-                coguk_supp.sampling = sample.created
-                coguk_supp.save()
-
-                # Hack to fix source if it has been changed at some point
-                #TODO This only works in the cog context where we can assume 1:1 between sample and collection
-                if source and sample.created:
-                    for record in sample.created.records.all():
-                        if record.in_group != source and record.out_artifact == sample:
-                            record.in_group = source
-                            record.save()
-
-                updated_metadata_l = handle_metadata(biosample.get("metadata", {}), 'artifact', sample.dice_name, user, api_o)
-                updated_metrics_l = handle_metrics(biosample.get("metrics", {}), 'artifact', sample, user, api_o) #TODO clean this as it duplicates the add_metric view
-
-                if not bs and sample:
-                    # Created
-                    if api_o:
-                        api_o["new"].append(_format_tuple(sample))
-                        TatlVerb(request=request.treq, verb="CREATE", content_object=sample).save()
-                else:
-                    changed_data_d = forms.MajoraPossiblePartialModelForm.merge_changed_data(
-                            coguk_supp_form, sample_process_form, sample_form
-                    )
-                    changed_data_d["changed_metadata"] = updated_metadata_l
-                    changed_data_d["flashed_metrics"] = updated_metrics_l
+                    api_o["messages"].append(str(e))
 
-                    if api_o:
-                        api_o["updated"].append(_format_tuple(sample))
-                        TatlVerb(request=request.treq, verb="UPDATE", content_object=sample, extra_context=json.dumps(changed_data_d)).save()
-                if source_created:
-                    if api_o:
-                        api_o["new"].append(_format_tuple(source))
-                        TatlVerb(request=request.treq, verb="CREATE", content_object=source).save()
+            if len(stale_samples) > 0:
+                util.mark_pag_exports_stale(artifacts=stale_samples)
 
-            except Exception as e:
-                api_o["errors"] += 1
-                api_o["messages"].append(str(e))
+    def prefetch(self, biosamples):
+        # Load the existing samples (with their collection processes, supplements and
+        # records) and sources named by the request up front, rather than per sample
+        sample_ids = set([])
+        source_ids = set([])
+        for biosample in biosamples:
+            if isinstance(biosample, dict):
+                if biosample.get("central_sample_id"):
+                    sample_ids.add(biosample["central_sample_id"])
+                if biosample.get("biosample_source_id"):
+                    source_ids.add(biosample["biosample_source_id"])
+
+        samples = {bs.central_sample_id: bs for bs in models.BiosampleArtifact.objects.filter(central_sample_id__in=sample_ids)}
+        processes = models.BiosourceSamplingProcess.objects.filter(
+                id__in=[bs.created_id for bs in samples.values() if bs.created_id]
+        ).select_related('coguk_supp', 'submission_user').prefetch_related('records')
+        processes = {p.id: p for p in processes}
+        for bs in samples.values():
+            if bs.created_id in processes:
+                bs.created = processes[bs.created_id]
+
+        sources = {s.dice_name: s for s in models.BiosampleSource.objects.filter(
+                Q(dice_name__in=source_ids) | Q(id__in=[bs.primary_group_id for bs in samples.values() if bs.primary_group_id])
+        )}
+        sources_by_id = {s.id: s for s in sources.values()}
+        for bs in samples.values():
+            if bs.primary_group_id in sources_by_id:
+                bs.primary_group = sources_by_id[bs.primary_group_id]
+        return samples, sources
 
 
 def add_library(request):
@@ -1222,6 +1183,9 @@ def add_library(request):
                 api_o["errors"] += 1
                 api_o["messages"].append(str(e))
 
+        # Library fields are exported with the PAGs of its samples
+        util.mark_pag_exports_stale(artifacts=models.LibraryPoolingProcessRecord.objects.filter(out_artifact=library).values('in_artifact'))
+
     return wrap_api_v2(request, f, oauth_permission="majora2.add_biosampleartifact majora2.change_biosampleartifact majora2.add_libraryartifact majora2.change_libraryartifact majora2.add_librarypoolingprocess majora2.change_librarypoolingprocess")
 
 def add_sequencing(request):
@@ -1270,6 +1234,8 @@ def add_sequencing(request):
                 api_o["errors"] += 1
                 api_o["messages"].append(str(e))
 
+        util.mark_pag_exports_stale(artifacts=models.LibraryPoolingProcessRecord.objects.filter(out_artifact__dice_name=library_name).values('in_artifact'))
+
     return wrap_api_v2(request, f, oauth_permission="majora2.change_libraryartifact majora2.add_dnasequencingprocess majora2.change_dnasequencingprocess")
 
 def add_digitalresource(request):
@@ -1279,12 +1245,7 @@ def add_digitalresource(request):
         if not node_name and user and hasattr(user, "profile"):
             node_name = user.profile.institute.code
             # Just add the node if it does not exist?
-            node, created = models.DigitalResourceNode.objects.get_or_create(
-                unique_name = node_name,
-                dice_name = node_name,
-                meta_name = node_name,
-                node_name = node_name,
-            )
+            node = util.get_node(node_name, create=True)
             json_data["node_name"] = node.dice_name
 
         # Try to add file
@@ -1308,6 +1269,64 @@ def add_digitalresource(request):
 
     return wrap_api_v2(request, f, oauth_permission="majora2.add_digitalresourceartifact majora2.change_digitalresourceartifact")
 
+def add_digitalresources(request):
+    def f(request, api_o, json_data, user=None, partial=False):
+
+        files = json_data.get("files")
+        if not files or not isinstance(files, list):
+            api_o["messages"].append("'files' key missing, empty or not a list")
+            api_o["errors"] += 1
+            return
+        max_files = getattr(settings, "MAJORA_FILE_BATCH_MAX", 500)
+        if len(files) > max_files:
+            api_o["messages"].append("Too many files, send at most %d per request" % max_files)
+            api_o["errors"] += 1
+            return
+
+        # Keys outside of files are defaults for every file, eg. node_name or pipe_hook
+        defaults = {k: v for k, v in json_data.items() if k not in ["files", "token", "username", "client_name", "client_version", "sudo_as"]}
+        if not defaults.get("node_name") and user and hasattr(user, "profile"):
+            node = util.get_node(user.profile.institute.code, create=True)
+            defaults["node_name"] = node.dice_name
+
+        initial = fixed_data.fill_fixed_data("api.artifact.digitalresource.add", user)
+        outcomes = []
+        valid = []
+        for file_data in files:
+            if not isinstance(file_data, dict):
+                outcomes.append({"path": None, "status": "invalid", "messages": ["File is not an object"]})
+                continue
+            data = dict(defaults)
+            data.update(file_data)
+            form = forms.TestFileBatchForm(data, initial=initial)
+            if form.is_valid():
+                form.cleaned_data.update(initial)
+                valid.append((len(outcomes), form, data))
+                outcomes.append(None)
+            else:
+                outcomes.append({"path": data.get("path"), "status": "invalid", "messages": [form.errors.get_json_data()]})
+
+        if len(valid) > 0:
+            # The batch is registered all or nothing
+            try:
+                with transaction.atomic():
+                    results = form_handlers.handle_testdigitalresources([form for i, form, data in valid], user=user, api_o=api_o, request=request)
+            except Exception as e:
+                results = [{"path": form.cleaned_data["path"], "status": "error", "messages": [str(e)]} for i, form, data in valid]
+
+            for (i, form, data), result in zip(valid, results):
+                outcomes[i] = result
+                if result.get("id") and data.get("metadata"):
+                    handle_metadata(data["metadata"], 'artifact', result["id"], user, api_o)
+
+        for outcome in outcomes:
+            if outcome["status"] in ["invalid", "error"]:
+                api_o["errors"] += 1
+                api_o["ignored"].append(outcome["path"])
+        api_o["files"] = outcomes
+
+    return wrap_api_v2(request, f, oauth_permission="majora2.add_digitalresourceartifact majora2.change_digitalresourceartifact")
+
 
 def add_tag(request):
     def f(request, api_o, json_data, user=None, partial=False):
@@ -1391,6 +1410,8 @@ def add_pag_accession(request):
                 pag.save()
                 api_o["messages"].append("PAG marked as public")
 
+            util.mark_pag_exports_stale(pags=[pag.id])
+
     return wrap_api_v2(request, f, oauth_permission="majora2.add_temporaryaccessionrecord majora2.change_temporaryaccessionrecord")
 
 def get_outbound_summary(request):
@@ -1566,7 +1587,11 @@ def get_pag_by_qc_celery(request):
                 basic_task = False
 
         if basic_task:
-            celery_task = tasks.task_get_pag_v2.delay(None, api_o, json_data, user=user.pk, response_uuid=api_o["request"])
+            if json_data.get("stream"):
+                # Spool the result set to disk and stream it back as NDJSON from api.majora.task.get
+                celery_task = tasks.task_get_pag_v2_stream.delay(None, api_o, json_data, user=user.pk, response_uuid=api_o["request"])
+            else:
+                celery_task = tasks.task_get_pag_v2.delay(None, api_o, json_data, user=user.pk, response_uuid=api_o["request"])
 
         if celery_task:
             api_o["tasks"].append(celery_task.id)
@@ -1642,7 +1667,27 @@ def get_task_result(request):
             "cleaned": cleaned,
         }
 
-    return wrap_api_v2(request, f)
+        # Stream spooled NDJSON results back, with the api_o envelope as the first line
+        stream_path = api_o.get("get", {}).get("stream")
+        if stream_path:
+            api_o["get"]["stream"] = True
+            if not os.path.exists(stream_path):
+                api_o["errors"] += 1
+                api_o["messages"].append("Task result stream is no longer available")
+                return
+            return StreamingHttpResponse(_stream_ndjson_result(api_o, stream_path), content_type="application/x-ndjson")
+
+    return wrap_api_v2(request, f, stream=True)
+
+def _stream_ndjson_result(api_o, stream_path):
+    try:
+        yield json.dumps(api_o) + "\n"
+        with open(stream_path) as fh:
+            for line in fh:
+                yield line
+    finally:
+        # Results are read once, the same as the task result itself which has been forgotten
+        os.unlink(stream_path)
 
 def get_mag(request):
     def f(request, api_o, json_data, user=None, partial=False):
@@ -1662,11 +1707,13 @@ def get_mag(request):
             api_o["errors"] += 1
             return
 
-        if (mag.children.count() > 100 or mag.groups.count() > 100 or mag.out_glinks.count() > 100) and not json_data.get("force"):
-            api_o["messages"].append("This MAG contains more than 100 groups or artifacts.")
-            api_o["error_code"] = "BIGMAG:%d" % max(mag.children.count(), mag.groups.count(), mag.out_glinks.count())
-            api_o["errors"] += 1
-            return
+        if not json_data.get("force"):
+            n_biggest = max(mag.children.count(), mag.groups.count(), mag.out_glinks.count())
+            if n_biggest > 100:
+                api_o["messages"].append("This MAG contains more than 100 groups or artifacts, list it a page at a time with api.group.mag.list")
+                api_o["error_code"] = "BIGMAG:%d" % n_biggest
+                api_o["errors"] += 1
+                return
 
 
         from .serializers import MAGSerializer
@@ -1674,6 +1721,116 @@ def get_mag(request):
 
     return wrap_api_v2(request, f)
 
+def list_mag(request):
+    def f(request, api_o, json_data, user=None, partial=False):
+        # List the groups and then the files below a MAG a page at a time, resuming from the
+        # cursor of the last page. The recursive mode lists the whole subtree by group_path
+        cursor = None
+        if json_data.get("cursor"):
+            try:
+                cursor = util.parse_page_cursor(json_data["cursor"])
+            except ValueError as e:
+                api_o["messages"].append(str(e))
+                api_o["errors"] += 1
+                return
+            path = cursor.get("path")
+            recursive = cursor.get("recursive", False)
+        else:
+            path = json_data.get("path")
+            recursive = bool(json_data.get("recursive", False))
+
+        if not path or len(path) == 0 or "://" not in path:
+            api_o["messages"].append("'path' key missing, empty or malformed")
+            api_o["errors"] += 1
+            return
+
+        max_page_size = getattr(settings, "MAJORA_MAG_PAGE_SIZE", 1000)
+        try:
+            page_size = json_data.get("page_size")
+            page_size = max_page_size if page_size is None else min(int(page_size), max_page_size)
+            if page_size < 1:
+                raise ValueError()
+        except (TypeError, ValueError):
+            api_o["messages"].append("'page_size' must be a positive integer")
+            api_o["errors"] += 1
+            return
+
+        node_name, mag_path = path.split("://")
+        mag = util.get_mag(node_name, mag_path, by_hard_path=True, prefetch=False)
+        if not mag:
+            api_o["messages"].append("Invalid path.")
+            api_o["errors"] += 1
+            return
+        if recursive and mag.group_path is None:
+            api_o["messages"].append("This MAG has no group_path to list its subtree by, run backfill_mag_paths")
+            api_o["errors"] += 1
+            return
+
+        api_o["mag"] = {
+            "id": str(mag.id),
+            "name": mag.name,
+            "group_kind": mag.group_kind,
+            "group_path": mag.group_path,
+            "parent_group": str(mag.parent_group_id) if mag.parent_group_id else None,
+            "root_group": str(mag.root_group_id) if mag.root_group_id else None,
+        }
+
+        if recursive:
+            # Range scan the indexed group_path_prefix, the whole path only filters prefixes that were cut short
+            prefix = mag.group_path + "/"
+            groups = models.DigitalResourceGroup.objects.filter(
+                    root_group_id=mag.root_group_id,
+                    group_path_prefix__startswith=models.prefix_group_path(prefix),
+                    group_path__startswith=prefix,
+            )
+            group_order = ["group_path_prefix", "id"]
+            artifacts = models.DigitalResourceArtifact.objects.filter(
+                    Q(primary_group_id=mag.id) | Q(
+                        primary_group__root_group_id=mag.root_group_id,
+                        primary_group__group_path_prefix__startswith=models.prefix_group_path(prefix),
+                        primary_group__group_path__startswith=prefix,
+                    ),
+            )
+            artifact_order = ["primary_group_id", "current_name", "id"]
+        else:
+            groups = models.DigitalResourceGroup.objects.filter(parent_group_id=mag.id)
+            group_order = ["sort_name", "id"]
+            artifacts = models.DigitalResourceArtifact.objects.filter(primary_group_id=mag.id)
+            artifact_order = ["current_name", "id"]
+        groups = groups.annotate(sort_name=Coalesce("current_name", Value(""))).values("id", "current_name", "group_path", "group_path_prefix", "parent_group_id", "physical", "sort_name")
+        artifacts = artifacts.values("id", "current_name", "current_extension", "current_kind", "current_path", "current_hash", "current_size", "primary_group_id")
+
+        # Groups come first, a page that finishes them carries on into the files
+        api_o["groups"] = []
+        api_o["artifacts"] = []
+        kind = cursor.get("kind", "groups") if cursor else "groups"
+        after = cursor.get("after") if cursor else None
+        if kind == "groups":
+            rows, after = util.keyset_page(groups, group_order, page_size, after=after)
+            for row in rows:
+                del row["sort_name"]
+                del row["group_path_prefix"]
+                row["id"] = str(row["id"])
+                row["parent_group_id"] = str(row["parent_group_id"]) if row["parent_group_id"] else None
+            api_o["groups"] = rows
+            page_size -= len(rows)
+            if after is None:
+                kind = "artifacts"
+        if kind == "artifacts" and page_size > 0:
+            rows, after = util.keyset_page(artifacts, artifact_order, page_size, after=after)
+            for row in rows:
+                row["id"] = str(row["id"])
+                row["primary_group_id"] = str(row["primary_group_id"]) if row["primary_group_id"] else None
+            api_o["artifacts"] = rows
+            if after is None:
+                kind = None
+
+        api_o["cursor"] = None
+        if kind:
+            api_o["cursor"] = util.make_page_cursor({"path": path, "recursive": recursive, "kind": kind, "after": after})
+
+    return wrap_api_v2(request, f)
+
 def suppress_pag(request):
     def f(request, api_o, json_data, user=None, partial=False):
         pag_names = json_data.get("publish_group")
@@ -1730,6 +1887,7 @@ def suppress_pag(request):
             pag.suppressed_date = timezone.now()
             pag.suppressed_reason = reason.upper()
             pag.save()
+            util.mark_pag_exports_stale(pags=[pag.id])
             api_o["updated"].append(_format_tuple(pag))
             TatlVerb(request=request.treq, verb="SUPPRESS", content_object=pag).save()
 
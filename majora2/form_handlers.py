@@ -55,6 +55,62 @@ def handle_testmetadata(form, user=None, api_o=None, request=None):
     mr.save()
     return mr, created, updated
 
+def handle_testmetadata_bulk(target_type, target, metadata_forms, user=None, api_o=None, request=None):
+    # Upsert the validated TestMetadataValueForms for a single resolved target,
+    # reading the existing records in one query and writing the changes in bulk.
+    # Returns (record, created, updated) for each form, as handle_testmetadata
+    restricted_tags = getattr(fixed_data, "RESTRICTED_METADATA", [])
+
+    target_q = {"artifact": None, "group": None, "process": None}
+    target_q[target_type] = target
+
+    existing = {}
+    for mr in models.MajoraMetaRecord.objects.filter(
+            meta_tag__in=set([form.cleaned_data["tag"] for form in metadata_forms]),
+            value_type="str",
+            **target_q
+    ):
+        existing[(mr.meta_tag, mr.meta_name)] = mr
+
+    results = []
+    to_create = []
+    to_update = []
+    for form in metadata_forms:
+        tag = form.cleaned_data.get("tag")
+        name = form.cleaned_data.get("name")
+        value = form.cleaned_data.get("value")
+        timestamp = form.cleaned_data.get("timestamp")
+        restricted = tag in restricted_tags
+
+        mr = existing.get((tag, name))
+        created = mr is None
+        updated = False
+        if created:
+            mr = models.MajoraMetaRecord(meta_tag=tag, meta_name=name, value_type="str", **target_q)
+            mr.pre_save_polymorphic()
+            existing[(tag, name)] = mr
+            to_create.append(mr)
+
+        dirty = False
+        if mr.value != value:
+            updated = True
+            dirty = True
+            mr.value = value
+            mr.timestamp = timestamp
+        if mr.restricted != restricted:
+            dirty = True
+            mr.restricted = restricted
+
+        if dirty and not created:
+            to_update.append(mr)
+        results.append((mr, created, updated))
+
+    if len(to_create) > 0:
+        models.MajoraMetaRecord.objects.bulk_create(to_create)
+    if len(to_update) > 0:
+        models.MajoraMetaRecord.objects.bulk_update(to_update, ["value", "timestamp", "restricted"])
+    return results
+
 def handle_testsequencing(form, user=None, api_o=None, request=None):
 
     sequencing_id = form.cleaned_data.get("sequencing_id")
@@ -291,22 +347,13 @@ def handle_testdigitalresource(form, user=None, api_o=None, request=None):
     node = form.cleaned_data["node_name"]
 
     path = form.cleaned_data["path"]
-    lpath = path.split( form.cleaned_data["sep"] )[1:-1]
 
-    # Get the directory
-    parent = util.get_mag(node.node_name, path, sep=form.cleaned_data["sep"], artifact=True, by_hard_path=True, prefetch=False)
+    # Get the directory, repeated registrations into the same directory are served by the MAG cache
+    parent = util.resolve_mag(node, path, sep=form.cleaned_data["sep"], artifact=True, create=False)
     if not parent:
         if api_o:
             api_o["messages"].append("MAG not found from hard path")
-        parent = node
-        for i, dir_name in enumerate(lpath):
-            dir_g, created = models.DigitalResourceGroup.objects.get_or_create(
-                    #group_path=form.cleaned_data["sep"].join(lpath),
-                    current_name=dir_name,
-                    root_group=node,
-                    parent_group=parent,
-                    physical=True)
-            parent = dir_g
+        parent = util.resolve_mag(node, path, sep=form.cleaned_data["sep"], artifact=True)
 
     if form.cleaned_data.get("artifact_uuid"):
         res, created = models.DigitalResourceArtifact.objects.get_or_create(
@@ -355,22 +402,31 @@ def handle_testdigitalresource(form, user=None, api_o=None, request=None):
 
         bio.save()
 
+        bridge = form.cleaned_data.get("bridge_artifact")
         for sg in form.cleaned_data.get("source_group"):
             bior, created = models.MajoraArtifactProcessRecord.objects.get_or_create(
                 process = bio,
                 in_group = sg,
                 out_artifact = res,
+                defaults = {
+                    "bridge_artifact": bridge,
+                },
             )
-            bior.bridge_artifact = form.cleaned_data.get("bridge_artifact")
-            bior.save()
+            if not created and bior.bridge_artifact_id != (bridge.pk if bridge else None):
+                bior.bridge_artifact = bridge
+                bior.save()
         for sa in form.cleaned_data.get("source_artifact"):
             bior, created = models.MajoraArtifactProcessRecord.objects.get_or_create(
                 process = bio,
                 in_artifact = sa,
                 out_artifact = res,
+                defaults = {
+                    "bridge_artifact": bridge,
+                },
             )
-            bior.bridge_artifact = form.cleaned_data.get("bridge_artifact")
-            bior.save()
+            if not created and bior.bridge_artifact_id != (bridge.pk if bridge else None):
+                bior.bridge_artifact = bridge
+                bior.save()
             try:
                 bio.when = sa.created.when
                 bio.save()
@@ -412,6 +468,9 @@ def handle_testdigitalresource(form, user=None, api_o=None, request=None):
             TatlVerb(request=request.treq, verb="UPDATE", content_object=res).save()
 
 
+    # Any PAG this resource is published in will need its export rebuilt
+    util.mark_pag_exports_stale(artifacts=[res.id])
+
     if created and api_o:
         api_o["new"].append(_format_tuple(res))
         TatlVerb(request=request.treq, verb="CREATE", content_object=res).save()
@@ -419,3 +478,242 @@ def handle_testdigitalresource(form, user=None, api_o=None, request=None):
         api_o["updated"].append(_format_tuple(res))
         TatlVerb(request=request.treq, verb="UPDATE", content_object=res).save()
     return res, created
+
+def handle_testdigitalresources(forms, user=None, api_o=None, request=None):
+    # Register a batch of validated TestFileBatchForms, as handle_testdigitalresource would one at a time,
+    # but resolving the sources, directories, processes and PAGs of the whole batch with a handful of queries.
+    # Callers should hold a transaction around the batch. Returns an outcome dict for each form, in order
+    outcomes = [None] * len(forms)
+    now = timezone.now()
+
+    # Sources and bridges are found by dice_name for the whole batch
+    artifact_names = set([])
+    group_names = set([])
+    for form in forms:
+        artifact_names.update(form.cleaned_data["source_artifact"])
+        if form.cleaned_data.get("bridge_artifact"):
+            artifact_names.add(form.cleaned_data["bridge_artifact"])
+        group_names.update(form.cleaned_data["source_group"])
+    artifacts = {}
+    if len(artifact_names) > 0:
+        artifacts = {a.dice_name: a for a in models.MajoraArtifact.objects.non_polymorphic().filter(dice_name__in=artifact_names).select_related('created')}
+    groups = {}
+    if len(group_names) > 0:
+        groups = {g.dice_name: g for g in models.MajoraArtifactGroup.objects.non_polymorphic().filter(dice_name__in=group_names)}
+
+    todo = []
+    for i, form in enumerate(forms):
+        missing = [x for x in form.cleaned_data["source_artifact"] if x not in artifacts]
+        missing += [x for x in form.cleaned_data["source_group"] if x not in groups]
+        if form.cleaned_data.get("bridge_artifact") and form.cleaned_data["bridge_artifact"] not in artifacts:
+            missing.append(form.cleaned_data["bridge_artifact"])
+        if len(missing) > 0:
+            outcomes[i] = {
+                "path": form.cleaned_data["path"],
+                "status": "invalid",
+                "messages": ["Select a valid choice. %s is not one of the available choices." % x for x in missing],
+            }
+        else:
+            todo.append(i)
+
+    # Each directory is resolved once, however many files land in it
+    parents = {}
+    for i in todo:
+        cd = forms[i].cleaned_data
+        key = (cd["node_name"].pk, cd["sep"], cd["path"].rsplit(cd["sep"], 1)[0])
+        if key not in parents:
+            parents[key] = util.resolve_mag(cd["node_name"], cd["path"], sep=cd["sep"], artifact=True)
+        cd["parent"] = parents[key]
+
+    # Fetch the files that already exist, by UUID or by their name in their directory
+    uuids = set([forms[i].cleaned_data["artifact_uuid"] for i in todo if forms[i].cleaned_data.get("artifact_uuid")])
+    by_uuid = {}
+    if len(uuids) > 0:
+        by_uuid = {r.id: r for r in models.DigitalResourceArtifact.objects.filter(id__in=uuids)}
+    named = [forms[i].cleaned_data for i in todo if not forms[i].cleaned_data.get("artifact_uuid")]
+    by_name = {}
+    if len(named) > 0:
+        for r in models.DigitalResourceArtifact.objects.filter(
+                primary_group__in=set([cd["parent"].pk for cd in named]),
+                current_name__in=set([cd["current_name"] for cd in named])):
+            by_name[(r.primary_group_id, r.current_name, r.current_extension)] = r
+
+    # One process per pipe_hook, shared by every file that has sources
+    hooks = {}
+    for i in todo:
+        cd = forms[i].cleaned_data
+        if len(cd["source_artifact"]) > 0 or len(cd["source_group"]) > 0:
+            hooks.setdefault(cd["pipe_hook"], cd)
+    bios = {}
+    if len(hooks) > 0:
+        bios = {b.hook_name: b for b in models.AbstractBioinformaticsProcess.objects.filter(hook_name__in=hooks.keys())}
+    for hook_name, cd in hooks.items():
+        if hook_name not in bios:
+            bio = models.AbstractBioinformaticsProcess(
+                hook_name = hook_name,
+                pipe_kind = cd["pipe_kind"] or "Pipeline", # for ease of finding later
+                pipe_name = cd["pipe_name"],
+                pipe_version = cd["pipe_version"],
+            )
+            bios[hook_name] = bio
+        bios[hook_name].who = user # use the uploading user, not the sequencing submitting user
+        bios[hook_name].when = now
+        bios[hook_name].save()
+
+    # Create or update the files, new files are saved one by one as they span two tables
+    resources = {}
+    created = {}
+    changed = {}
+    for i in todo:
+        cd = forms[i].cleaned_data
+        res = None
+        if cd.get("artifact_uuid"):
+            res = by_uuid.get(cd["artifact_uuid"])
+            if res is None:
+                res = models.DigitalResourceArtifact(id=cd["artifact_uuid"])
+                by_uuid[res.id] = res
+        else:
+            key = (cd["parent"].pk, cd["current_name"], cd["current_fext"])
+            res = by_name.get(key)
+            if res is None:
+                res = models.DigitalResourceArtifact(primary_group=cd["parent"], current_name=cd["current_name"], current_extension=cd["current_fext"])
+                by_name[key] = res
+        res.primary_group = cd["parent"]
+        res.current_name = cd["current_name"]
+        res.current_extension = cd["current_fext"]
+
+        if res.current_hash != cd["current_hash"] or res.current_size != cd["current_size"]:
+            changed[res.id] = True
+        res.dice_name = str(res.id)
+        res.current_path = cd["path"]
+        res.current_hash = cd["current_hash"]
+        res.current_size = cd["current_size"]
+        res.current_kind = cd["resource_type"]
+
+        if res._state.adding:
+            if cd["pipe_hook"] in bios and (len(cd["source_artifact"]) > 0 or len(cd["source_group"]) > 0):
+                res.created = bios[cd["pipe_hook"]]
+            res.save()
+            created[res.id] = True
+        resources[i] = res
+
+    # Link the files to their sources, saving only the records that are new or have moved bridge,
+    # each save keeps the lineage closure and quarantine of the file up to date
+    todo_records = [i for i in todo if forms[i].cleaned_data["pipe_hook"] in bios and (len(forms[i].cleaned_data["source_artifact"]) > 0 or len(forms[i].cleaned_data["source_group"]) > 0)]
+    records = {}
+    if len(todo_records) > 0:
+        for r in models.MajoraArtifactProcessRecord.objects.non_polymorphic().filter(
+                process__in=[b.pk for b in bios.values()],
+                out_artifact__in=[resources[i].pk for i in todo_records]):
+            records[(r.process_id, r.in_artifact_id, r.in_group_id, r.out_artifact_id)] = r
+    bio_when = {}
+    for i in todo_records:
+        cd = forms[i].cleaned_data
+        res = resources[i]
+        bio = bios[cd["pipe_hook"]]
+        bridge = artifacts[cd["bridge_artifact"]] if cd.get("bridge_artifact") else None
+        record_created = False
+        sources = [(None, groups[x]) for x in cd["source_group"]] + [(artifacts[x], None) for x in cd["source_artifact"]]
+        for sa, sg in sources:
+            key = (bio.pk, sa.pk if sa else None, sg.pk if sg else None, res.pk)
+            bior = records.get(key)
+            if bior is None:
+                bior = models.MajoraArtifactProcessRecord(process=bio, in_artifact=sa, in_group=sg, out_artifact=res, bridge_artifact=bridge)
+                bior.save()
+                records[key] = bior
+                record_created = True
+            elif bior.bridge_artifact_id != (bridge.pk if bridge else None):
+                bior.bridge_artifact = bridge
+                bior.save()
+            if sa and sa.created:
+                bio_when[bio.pk] = (bio, sa.created.when)
+        if record_created and res.created_id != bio.pk:
+            res.created = bio
+            if res.id not in created:
+                changed[res.id] = True
+    for bio, when in bio_when.values():
+        if when:
+            bio.when = when
+            bio.save()
+
+    # Files that already existed are written back together
+    existing = list({res.id: res for res in resources.values() if res.id not in created}.values())
+    if len(existing) > 0:
+        models.DigitalResourceArtifact.objects.bulk_update(existing, [
+            'dice_name', 'primary_group', 'created', 'current_path', 'current_name', 'current_extension', 'current_hash', 'current_size', 'current_kind',
+        ])
+
+    # Tag the files (and their bridges) into their PAGs
+    # As handle_testdigitalresource, a PAG is owned by the user of the process that created the file,
+    # which is the uploading user for any file linked to its sources by this batch.
+    # Files without a creating process are published by the uploading user
+    publish = [i for i in todo if forms[i].cleaned_data.get("publish_group")]
+    owners = {bio.pk: bio.who_id for bio in bios.values()}
+    unknown = set([resources[i].created_id for i in publish if resources[i].created_id]) - set(owners)
+    if len(unknown) > 0:
+        owners.update(models.MajoraArtifactProcess.objects.filter(id__in=unknown).values_list('id', 'who_id'))
+    pag_keys = {}
+    for i in publish:
+        res = resources[i]
+        owner_id = owners[res.created_id] if res.created_id else user.pk
+        pag_keys[i] = (forms[i].cleaned_data["publish_group"], owner_id)
+
+    pags = {}
+    new_pags = []
+    bridges = {}
+    if len(pag_keys) > 0:
+        for pag in models.PublishedArtifactGroup.objects.filter(
+                published_name__in=set(x[0] for x in pag_keys.values()),
+                owner_id__in=set(x[1] for x in pag_keys.values()),
+                published_version=1, is_latest=True):
+            pags[(pag.published_name, pag.owner_id)] = pag
+        for key in set(pag_keys.values()):
+            pag = pags.get(key)
+            if pag is None:
+                pag = models.PublishedArtifactGroup(published_name=key[0], published_version=1, is_latest=True, owner_id=key[1])
+                new_pags.append(pag)
+                pags[key] = pag
+            if not pag.published_date:
+                pag.published_date = now.date()
+                pag.save()
+
+        through = models.MajoraArtifact.groups.through
+        links = set([])
+        for i in publish:
+            cd = forms[i].cleaned_data
+            pag = pags[pag_keys[i]]
+            links.add((resources[i].pk, pag.pk))
+            if cd.get("bridge_artifact"):
+                bridge = artifacts[cd["bridge_artifact"]]
+                links.add((bridge.pk, pag.pk))
+                if pag in new_pags:
+                    bridges[bridge.pk] = bridge
+        through.objects.bulk_create([through(majoraartifact_id=a, majoraartifactgroup_id=g) for a, g in links], ignore_conflicts=True)
+
+    # Any PAG these resources are published in will need its export rebuilt
+    util.mark_pag_exports_stale(artifacts=[res.id for res in resources.values()])
+
+    if api_o:
+        for pag in new_pags:
+            api_o["new"].append(_format_tuple(pag))
+            TatlVerb(request=request.treq, verb="CREATE", content_object=pag).save()
+        for bridge in bridges.values():
+            api_o["updated"].append(_format_tuple(bridge))
+            TatlVerb(request=request.treq, verb="UPDATE", content_object=bridge).save()
+
+    reported = set([])
+    for i in todo:
+        res = resources[i]
+        if res.id in created:
+            status = "created"
+        elif res.id in changed:
+            status = "updated"
+        else:
+            status = "unchanged"
+        outcomes[i] = {"path": forms[i].cleaned_data["path"], "status": status, "id": str(res.id), "messages": []}
+
+        if api_o and res.id not in reported and status != "unchanged":
+            reported.add(res.id)
+            api_o["new" if status == "created" else "updated"].append(_format_tuple(res))
+            TatlVerb(request=request.treq, verb="CREATE" if status == "created" else "UPDATE", content_object=res).save()
+    return outcomes
@@ -14,6 +14,7 @@ from crispy_forms.bootstrap import FormActions
 from .account_views import generate_username
 from . import models
 from . import fixed_data
+from . import util
 
 import re
 
@@ -263,25 +264,24 @@ class RegistrationForm(forms.Form):
 class M2Metric_SequenceForm(forms.ModelForm):
     class Meta:
         model = models.TemporaryMajoraArtifactMetric_Sequence
-        exclude = []
+        exclude = ["artifact"] # set on the instance by the handler
 
 class M2Metric_MappingForm(forms.ModelForm):
     class Meta:
         model = models.TemporaryMajoraArtifactMetric_Mapping
-        exclude = []
+        exclude = ["artifact"] # set on the instance by the handler
 
 class M2Metric_MappingTileForm(forms.ModelForm):
     class Meta:
         model = models.TemporaryMajoraArtifactMetric_Mapping_Tiles
-        exclude = []
+        exclude = ["artifact"] # set on the instance by the handler
 
 class M2Metric_ThresholdCycleForm(forms.ModelForm):
     class Meta:
         model = models.TemporaryMajoraArtifactMetric_ThresholdCycle
-        exclude = []
+        exclude = ["artifact"] # set on the instance by the handler
 
 class M2MetricRecord_ThresholdCycleForm(forms.Form): # should probably be a modelform, but w/e
-    artifact_metric = forms.ModelChoiceField(queryset=models.TemporaryMajoraArtifactMetric_ThresholdCycle.objects.all(), required=True)
     ct_value = forms.FloatField(required=True, min_value=0.0)
     test_kit = forms.ChoiceField(
             choices=[
@@ -343,18 +343,23 @@ class M2MetricRecord_ThresholdCycleForm(forms.Form): # should probably be a mode
             required=False,
     )
 
-class TestMetadataForm(forms.Form):
-    artifact = forms.ModelChoiceField(queryset=models.MajoraArtifact.objects.all(), required=False, to_field_name="dice_name")
-    group = forms.ModelChoiceField(queryset=models.MajoraArtifactGroup.objects.all(), required=False, to_field_name="dice_name")
-    process = forms.ModelChoiceField(queryset=models.MajoraArtifactProcess.objects.all(), required=False)
-    #pgroup
-
+class TestMetadataValueForm(forms.Form):
+    # Validates a single metadata key without resolving what it is attached to,
+    # see handle_testmetadata_bulk
     tag = forms.CharField(max_length=64)
     name = forms.CharField(max_length=64)
     value = forms.CharField(max_length=128, required=False)
 
     timestamp = forms.DateTimeField()
 
+class TestMetadataForm(TestMetadataValueForm):
+    artifact = forms.ModelChoiceField(queryset=models.MajoraArtifact.objects.all(), required=False, to_field_name="dice_name")
+    group = forms.ModelChoiceField(queryset=models.MajoraArtifactGroup.objects.all(), required=False, to_field_name="dice_name")
+    process = forms.ModelChoiceField(queryset=models.MajoraArtifactProcess.objects.all(), required=False)
+    #pgroup
+
+    field_order = ["artifact", "group", "process", "tag", "name", "value", "timestamp"]
+
     def clean(self):
         cleaned_data = super().clean()
         if not (cleaned_data.get("artifact") or cleaned_data.get("group") or cleaned_data.get("process")):
@@ -910,7 +915,7 @@ class TestFileForm(forms.Form):
     pipe_version = forms.CharField(max_length=48, required=False)
 
     #node_uuid = forms.ModelChoiceField(queryset=models.DigitalResourceNode.objects.all())
-    node_name = forms.ModelChoiceField(queryset=models.DigitalResourceNode.objects.all(), to_field_name="unique_name", required=False)
+    node_name = forms.CharField(max_length=128, required=False) # resolved to a DigitalResourceNode by clean_node_name
     path = forms.CharField(max_length=1024)
     sep = forms.CharField(max_length=2)
     current_name = forms.CharField(max_length=512)
@@ -927,3 +932,28 @@ class TestFileForm(forms.Form):
             ("consensus", "consensus"),
         ],
     )
+
+    def clean_node_name(self):
+        node_name = self.cleaned_data.get("node_name")
+        if not node_name:
+            return None
+        node = util.get_node(node_name)
+        if not node:
+            raise forms.ValidationError("Select a valid choice. That choice is not one of the available choices.")
+        return node
+
+class DiceNameListField(forms.Field):
+    # A list of dice_names, left unresolved so a batch of forms can look them up together
+    def to_python(self, value):
+        if value in self.empty_values:
+            return []
+        if not isinstance(value, (list, tuple)):
+            raise forms.ValidationError("Enter a list of values.")
+        return [str(x) for x in value if x not in self.empty_values]
+
+class TestFileBatchForm(TestFileForm):
+    # Validates one file of a batch registration without touching the database for its sources,
+    # form_handlers.handle_testdigitalresources resolves the dice_names of the whole batch at once
+    bridge_artifact = forms.CharField(max_length=96, required=False)
+    source_artifact = DiceNameListField(required=False)
+    source_group = DiceNameListField(required=False)
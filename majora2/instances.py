@@ -0,0 +1,81 @@
+from django.contrib.contenttypes.models import ContentType
+from django.db.models.constants import LOOKUP_SEP
+
+from polymorphic.models import PolymorphicModel
+
+# Bulk resolution of polymorphic instances
+# Iterating a polymorphic queryset already fetches the real instances with one query per
+# subclass, but following a foreign key to a polymorphic model (eg. record.in_artifact)
+# costs at least one query for every row. These helpers gather the targets of a set of
+# rows first, and fetch each subclass once for all of them.
+
+def real_instances(objs):
+    # Cast instances of a polymorphic base class (eg. from non_polymorphic querysets) to their
+    # real classes, returned in the same order. Instances that are already real are left alone
+    pks_by_model = {}
+    for obj in objs:
+        if obj is None:
+            continue
+        model = ContentType.objects.get_for_id(obj.polymorphic_ctype_id).model_class()
+        if model is not None and model is not obj.__class__:
+            if model not in pks_by_model:
+                pks_by_model[model] = set([])
+            pks_by_model[model].add(obj.pk)
+
+    real = {}
+    for model, pks in pks_by_model.items():
+        for obj in model.objects.non_polymorphic().filter(pk__in=pks):
+            real[obj.pk] = obj
+    return [real.get(obj.pk, obj) if obj is not None else None for obj in objs]
+
+def resolve_related(objs, *fields):
+    # Attach the real instances of the foreign keys named in fields to each of objs, fetching
+    # each subclass once for the lot. Keys to the same model (eg. in_artifact and out_artifact)
+    # are fetched together, and fields may follow keys further with __ (eg. in_artifact__created)
+    objs = [obj for obj in objs if obj is not None]
+    if len(objs) == 0 or len(fields) == 0:
+        return objs
+
+    paths = {}
+    for path in fields:
+        name, _, rest = path.partition(LOOKUP_SEP)
+        if name not in paths:
+            paths[name] = []
+        if rest:
+            paths[name].append(rest)
+
+    # Gather the keys of every field by the model they point to
+    keys = {}
+    for name in paths:
+        field = objs[0]._meta.get_field(name)
+        model = field.related_model
+        if model not in keys:
+            keys[model] = set([])
+        for obj in objs:
+            pk = getattr(obj, field.attname)
+            if pk is not None:
+                keys[model].add(pk)
+
+    targets = {}
+    for model, pks in keys.items():
+        if len(pks) == 0:
+            continue
+        if issubclass(model, PolymorphicModel):
+            fetched = real_instances(list(model.objects.non_polymorphic().filter(pk__in=pks)))
+        else:
+            fetched = model._default_manager.filter(pk__in=pks)
+        targets[model] = {x.pk: x for x in fetched}
+
+    for name, rest in paths.items():
+        field = objs[0]._meta.get_field(name)
+        related = []
+        for obj in objs:
+            pk = getattr(obj, field.attname)
+            if pk is None:
+                continue
+            target = targets[field.related_model][pk]
+            field.set_cached_value(obj, target)
+            related.append(target)
+        if len(rest) > 0:
+            resolve_related(list({id(x): x for x in related}.values()), *rest)
+    return objs
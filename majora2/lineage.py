@@ -0,0 +1,455 @@
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import connections, router
+from django.db.models import Q
+
+from . import instances
+from . import models
+
+# Provenance graph engine for walking MajoraArtifactProcessRecords
+# The upstream graph is loaded breadth-first, one IN query per level of ancestry, and
+# the polymorphic processes it touches are resolved in bulk once it has been loaded.
+# The walk over the loaded graph then returns exactly what the old one-node-at-a-time
+# recursion of process_tree_up used to, without the queries.
+# The downstream graph is fetched with a single recursive CTE where the database
+# supports one, before process_tree_down is rebuilt from it in memory.
+# Questions about every artifact connected to another are answered by the
+# MajoraArtifactClosure table maintained at the bottom of this module.
+
+ARTIFACT = "artifact"
+GROUP = "group"
+
+def node_for(obj):
+    if isinstance(obj, models.MajoraArtifactGroup):
+        return (GROUP, obj.pk)
+    return (ARTIFACT, obj.pk)
+
+
+class UpstreamGraph(object):
+    def __init__(self, roots):
+        self.records = {} # node -> records leading to that node, newest process first
+        self.processes = {} # process id -> real process instance
+        self.depth = 0
+        self._walks = {}
+        self.load([node_for(root) for root in roots])
+        self.resolve_processes()
+
+    def load(self, frontier):
+        frontier = set(frontier)
+        for node in frontier:
+            self.records[node] = []
+
+        while len(frontier) > 0:
+            artifact_ids = set(x[1] for x in frontier if x[0] == ARTIFACT)
+            group_ids = set(x[1] for x in frontier if x[0] == GROUP)
+
+            q = Q()
+            if len(artifact_ids) > 0:
+                q |= Q(out_artifact_id__in=artifact_ids)
+            if len(group_ids) > 0:
+                q |= Q(out_group_id__in=group_ids)
+
+            next_frontier = set([])
+            records = models.MajoraArtifactProcessRecord.objects.non_polymorphic().filter(q).order_by('-process__when')
+            for record in records:
+                # A record may lead to both an artifact and a group on this level
+                if record.out_artifact_id in artifact_ids:
+                    self.records[(ARTIFACT, record.out_artifact_id)].append(record)
+                if record.out_group_id in group_ids:
+                    self.records[(GROUP, record.out_group_id)].append(record)
+
+                for parent in self.parents(record):
+                    if parent not in self.records:
+                        self.records[parent] = []
+                        next_frontier.add(parent)
+            frontier = next_frontier
+            self.depth += 1
+
+    def resolve_processes(self):
+        records = set()
+        for node_records in self.records.values():
+            records.update(node_records)
+        for record in instances.resolve_related(records, 'process'):
+            self.processes[record.process_id] = record.process
+
+    @staticmethod
+    def parents(record):
+        # in_group is visited before in_artifact, as process_tree_up always has
+        parents = []
+        if record.in_group_id:
+            parents.append((GROUP, record.in_group_id))
+        if record.in_artifact_id:
+            parents.append((ARTIFACT, record.in_artifact_id))
+        return parents
+
+    def walk(self, node, path=None):
+        # Returns the processes above node in process_tree_up order, each node's
+        # processes are listed once. The walk refuses to step back into a node
+        # already on its path so a cyclic graph cannot recurse forever
+        if node in self._walks:
+            return self._walks[node]
+        if path is None:
+            path = set([])
+        path = path | set([node])
+
+        a = []
+        added = set([])
+        for record in self.records.get(node, []):
+            for parent in self.parents(record):
+                if record.process_id not in added:
+                    a.append(self.processes[record.process_id])
+                    added.add(record.process_id)
+                if parent not in path:
+                    children = self.walk(parent, path)
+                    a.extend(children)
+                    added.update(x.id for x in children)
+        a.reverse()
+
+        self._walks[node] = a
+        return a
+
+    def process_tree(self, root):
+        return self.walk(node_for(root))
+
+
+def process_tree(root):
+    return UpstreamGraph([root]).process_tree(root)
+
+def connected_artifacts(root):
+    # The artifacts below root, farthest first, then the artifacts above it, nearest first
+    rows = models.MajoraArtifactClosure.objects.filter(
+        Q(ancestor_artifact_id=root.pk, descendant_artifact__isnull=False) | Q(descendant_artifact_id=root.pk, ancestor_artifact__isnull=False)
+    ).values_list('ancestor_artifact_id', 'descendant_artifact_id', 'depth')
+
+    below = {}
+    above = {}
+    for ancestor_id, descendant_id, depth in rows:
+        if ancestor_id == root.pk:
+            below[descendant_id] = min(depth, below.get(descendant_id, depth))
+        else:
+            above[ancestor_id] = min(depth, above.get(ancestor_id, depth))
+    if len(below) == 0 and len(above) == 0:
+        return []
+
+    artifacts = {a.id: a for a in models.MajoraArtifact.objects.filter(id__in=set(below) | set(above))}
+    a = [artifacts[x] for x in sorted(below, key=lambda x: (-below[x], str(x)))]
+    a.extend(artifacts[x] for x in sorted(above, key=lambda x: (above[x], str(x))) if x not in below)
+    return a
+
+
+def supports_recursive_cte(connection):
+    if not getattr(settings, "MAJORA_LINEAGE_USE_CTE", True):
+        return False
+    if connection.vendor == "postgresql":
+        return True
+    if connection.vendor == "mysql":
+        if connection.mysql_is_mariadb:
+            return connection.mysql_version >= (10, 2, 2)
+        return connection.mysql_version >= (8, 0, 1)
+    if connection.vendor == "sqlite":
+        import sqlite3
+        return sqlite3.sqlite_version_info >= (3, 8, 3)
+    return False
+
+def downstream_records_sql(connection):
+    # Selects the ids of every record below the node in %s, following both the
+    # out_artifact and out_group of each record. Artifact and group UUIDs share the
+    # node_id column, UNION drops the nodes that have already been visited
+    qn = connection.ops.quote_name
+    opts = models.MajoraArtifactProcessRecord._meta
+    table = qn(opts.db_table)
+    pk = qn(opts.pk.column)
+    in_artifact, in_group, out_artifact, out_group = [qn(opts.get_field(f).column) for f in ["in_artifact", "in_group", "out_artifact", "out_group"]]
+
+    return """
+        WITH RECURSIVE downstream(node_id) AS (
+            SELECT %s
+            UNION
+            SELECT CASE WHEN k.n = 0 THEN r.{out_artifact} ELSE r.{out_group} END
+            FROM downstream d
+            JOIN {table} r ON (r.{in_artifact} = d.node_id OR r.{in_group} = d.node_id)
+            CROSS JOIN (SELECT 0 AS n UNION ALL SELECT 1 AS n) k
+            WHERE (k.n = 0 AND r.{out_artifact} IS NOT NULL) OR (k.n = 1 AND r.{out_group} IS NOT NULL)
+        )
+        SELECT r.{pk} FROM {table} r
+        WHERE r.{in_artifact} IN (SELECT node_id FROM downstream) OR r.{in_group} IN (SELECT node_id FROM downstream)
+    """.format(table=table, pk=pk, in_artifact=in_artifact, in_group=in_group, out_artifact=out_artifact, out_group=out_group)
+
+
+class DownstreamGraph(object):
+    def __init__(self, root):
+        self.root = node_for(root)
+        self.records = {} # node -> records leaving that node, newest process first
+        self.depth = 0
+
+        db = router.db_for_read(models.MajoraArtifactProcessRecord)
+        connection = connections[db]
+        if supports_recursive_cte(connection):
+            self.load_cte(root, connection)
+        else:
+            self.load_batched()
+        self.resolve()
+
+    def _add(self, records):
+        for record in records:
+            if record.in_artifact_id:
+                self.records.setdefault((ARTIFACT, record.in_artifact_id), []).append(record)
+            if record.in_group_id:
+                self.records.setdefault((GROUP, record.in_group_id), []).append(record)
+
+    def load_cte(self, root, connection):
+        # Fetch the whole downstream edge set with one recursive query
+        # RawSQL would be wrapped in a second set of brackets as the right hand side
+        # of an __in lookup, turning the CTE into a scalar subquery, so use extra
+        opts = models.MajoraArtifactProcessRecord._meta
+        root_id = root._meta.pk.get_db_prep_value(root.pk, connection)
+        records = models.MajoraArtifactProcessRecord.objects.non_polymorphic().extra(
+            where=["%s.%s IN (%s)" % (connection.ops.quote_name(opts.db_table), connection.ops.quote_name(opts.pk.column), downstream_records_sql(connection))],
+            params=[root_id],
+        ).order_by('-process__when')
+        self._add(records)
+
+    def load_batched(self):
+        # Fall back to fetching the edges one level at a time
+        frontier = set([self.root])
+        visited = set([self.root])
+        while len(frontier) > 0:
+            artifact_ids = set(x[1] for x in frontier if x[0] == ARTIFACT)
+            group_ids = set(x[1] for x in frontier if x[0] == GROUP)
+
+            q = Q()
+            if len(artifact_ids) > 0:
+                q |= Q(in_artifact_id__in=artifact_ids)
+            if len(group_ids) > 0:
+                q |= Q(in_group_id__in=group_ids)
+
+            records = list(models.MajoraArtifactProcessRecord.objects.non_polymorphic().filter(q).order_by('-process__when'))
+            self._add(records)
+
+            frontier = set([])
+            for record in records:
+                for child in self.children(record):
+                    if child not in visited:
+                        visited.add(child)
+                        frontier.add(child)
+            self.depth += 1
+
+    @staticmethod
+    def children(record):
+        children = []
+        if record.out_artifact_id:
+            children.append((ARTIFACT, record.out_artifact_id))
+        if record.out_group_id:
+            children.append((GROUP, record.out_group_id))
+        return children
+
+    def resolve(self):
+        # Attach the real processes, their users and the out artifacts and groups to
+        # each record so rendering the tree does not go back to the database
+        records = set()
+        for node_records in self.records.values():
+            records.update(node_records)
+        if len(records) == 0:
+            return
+
+        instances.resolve_related(records, 'process', 'out_artifact', 'out_group')
+        processes = set(r.process for r in records)
+        user_ids = set(p.who_id for p in processes if p.who_id)
+        if len(user_ids) > 0:
+            users = {u.id: u for u in User.objects.filter(id__in=user_ids).select_related('profile__institute')}
+            for p in processes:
+                if p.who_id:
+                    p.who = users[p.who_id]
+
+    def walk(self, node, seen, crossed_bridges, path):
+        # Rebuilds the nested [{record: children}] of the old build_process_tree_down,
+        # whose artifact and group variants differed in which nodes they marked as seen
+        path = path | set([node])
+        records = self.records.get(node, [])
+
+        # Detect whether we can cross any bridges
+        current_bridges = set((ARTIFACT, r.bridge_artifact_id) for r in records if r.out_artifact_id and r.bridge_artifact_id)
+        can_cross = len(current_bridges & crossed_bridges) > 0
+
+        a = []
+        for record in records:
+            add = 0
+            children = []
+            out_artifact = (ARTIFACT, record.out_artifact_id)
+            if record.out_artifact_id and out_artifact not in seen and out_artifact not in path:
+                # Do not cross to the other side of a bridge that should not be crossed
+                if (record.bridge_artifact_id is None) or ((ARTIFACT, record.bridge_artifact_id) in crossed_bridges) or not can_cross:
+                    children.extend(self.walk(out_artifact, seen, crossed_bridges, path))
+                    if node[0] == GROUP:
+                        seen.add(out_artifact)
+                    add = 1
+
+            out_group = (GROUP, record.out_group_id)
+            if record.out_group_id and out_group not in path and (node[0] == GROUP or out_group not in seen):
+                children.extend(self.walk(out_group, seen, crossed_bridges, path))
+                seen.add(out_group)
+                add = 1
+
+            if add:
+                a.append({record: children})
+        return a
+
+    def process_tree_down(self):
+        return self.walk(self.root, set([self.root]), set([self.root]), set([]))
+
+
+def process_tree_down(root):
+    return DownstreamGraph(root).process_tree_down()
+
+
+def derive_quarantine_sources(artifacts):
+    # Returns the id of the nearest quarantined artifact at or above each artifact, or None
+    # An artifact with a root_artifact only inherits the quarantine of its root, otherwise
+    # the nearest quarantined ancestor is found from the MajoraArtifactClosure
+    sources = {}
+    rooted = []
+    walked = []
+    for artifact in artifacts:
+        if artifact.quarantined:
+            sources[artifact.pk] = artifact.pk
+        elif artifact.root_artifact_id:
+            rooted.append(artifact)
+        else:
+            walked.append(artifact)
+            sources[artifact.pk] = None
+
+    if len(rooted) > 0:
+        quarantined = set(models.MajoraArtifact.objects.filter(id__in=set(a.root_artifact_id for a in rooted), quarantined=True).values_list('id', flat=True))
+        for artifact in rooted:
+            sources[artifact.pk] = artifact.root_artifact_id if artifact.root_artifact_id in quarantined else None
+
+    if len(walked) > 0:
+        nearest = models.MajoraArtifactClosure.objects.filter(
+            descendant_artifact_id__in=[a.pk for a in walked],
+            ancestor_artifact__quarantined=True,
+        ).order_by('depth', 'ancestor_artifact_id').values_list('descendant_artifact_id', 'ancestor_artifact_id')
+        for artifact_id, source_id in nearest:
+            if not sources[artifact_id]:
+                sources[artifact_id] = source_id
+    return sources
+
+
+# Closure table maintenance
+# Each MajoraArtifactClosure row says that descendant is below ancestor, depth records
+# away, on a path that leaves the ancestor with via_process. Adding a record u -> v adds
+# a row for every ancestor of u (and u) and every descendant of v (and v).
+# Bridged records (eg. a consensus made from a whole run's sequencing group, bridged
+# to its biosample) only carry the lineage of nodes related to their bridge_artifact,
+# that is the bridge, its ancestors and its descendants, so the closure of one sample
+# does not fan out to every other sample on its run. The first bridge on each path is
+# kept on the row so that the paths it is later extended by can be checked the same way.
+
+def _closure_q(side, nodes):
+    q = Q()
+    for kind in [ARTIFACT, GROUP]:
+        ids = set(x[1] for x in nodes if x[0] == kind)
+        if len(ids) > 0:
+            q |= Q(**{"%s_%s_id__in" % (side, kind): ids})
+    return q
+
+def _closure_node(row, side):
+    artifact_id = getattr(row, "%s_artifact_id" % side)
+    if artifact_id:
+        return (ARTIFACT, artifact_id)
+    return (GROUP, getattr(row, "%s_group_id" % side))
+
+def _closure_kwargs(side, node):
+    return {"%s_%s_id" % (side, node[0]): node[1]}
+
+def _related_nodes(bridge_ids):
+    # Returns each bridge artifact with the set of nodes above or below it
+    related = {bridge_id: set([(ARTIFACT, bridge_id)]) for bridge_id in bridge_ids}
+    if len(bridge_ids) > 0:
+        for row in models.MajoraArtifactClosure.objects.filter(Q(ancestor_artifact_id__in=bridge_ids) | Q(descendant_artifact_id__in=bridge_ids)):
+            if row.ancestor_artifact_id in related:
+                related[row.ancestor_artifact_id].add(_closure_node(row, "descendant"))
+            if row.descendant_artifact_id in related:
+                related[row.descendant_artifact_id].add(_closure_node(row, "ancestor"))
+    return related
+
+def add_closure_edge(record):
+    # Add the closure rows for a new record, returns the number of rows created
+    ins = UpstreamGraph.parents(record)
+    outs = [x for x in DownstreamGraph.children(record) if x not in ins]
+    if len(ins) == 0 or len(outs) == 0:
+        return 0
+
+    # Everything above the record (with the record's own in nodes) and everything below it
+    ups = {u: [(u, record.process_id, 0, None)] for u in ins}
+    for row in models.MajoraArtifactClosure.objects.filter(_closure_q("descendant", ins)):
+        ups[_closure_node(row, "descendant")].append((_closure_node(row, "ancestor"), row.via_process_id, row.depth, row.bridge_artifact_id))
+    downs = {v: {v: (0, None)} for v in outs}
+    for row in models.MajoraArtifactClosure.objects.filter(_closure_q("ancestor", outs)):
+        d = _closure_node(row, "descendant")
+        v = _closure_node(row, "ancestor")
+        if d not in downs[v] or row.depth < downs[v][d][0]:
+            downs[v][d] = (row.depth, row.bridge_artifact_id)
+
+    bridge_ids = set([record.bridge_artifact_id]) if record.bridge_artifact_id else set()
+    for v in outs:
+        bridge_ids.update(x[1] for x in downs[v].values() if x[1])
+    related = _related_nodes(bridge_ids)
+
+    candidates = {}
+    for u in ins:
+        for v in outs:
+            for a, via, a_depth, a_bridge in ups[u]:
+                for d, (d_depth, d_bridge) in downs[v].items():
+                    if a == d:
+                        continue
+                    # The record itself always joins its in and out nodes
+                    if a != u and record.bridge_artifact_id and a not in related[record.bridge_artifact_id]:
+                        continue
+                    if d_bridge and a not in related[d_bridge]:
+                        continue
+
+                    depth = a_depth + 1 + d_depth
+                    key = (a, d, via)
+                    if key not in candidates or depth < candidates[key][0]:
+                        candidates[key] = (depth, a_bridge or record.bridge_artifact_id or d_bridge)
+    if len(candidates) == 0:
+        return 0
+
+    # Keep the shortest path for rows that already exist
+    ancestors = set(x[0] for x in candidates)
+    descendants = set(x[1] for x in candidates)
+    for row in models.MajoraArtifactClosure.objects.filter(_closure_q("ancestor", ancestors)).filter(_closure_q("descendant", descendants)):
+        key = (_closure_node(row, "ancestor"), _closure_node(row, "descendant"), row.via_process_id)
+        if key in candidates:
+            depth, bridge_id = candidates.pop(key)
+            if depth < row.depth:
+                row.depth = depth
+                row.save(update_fields=["depth"])
+
+    rows = []
+    for (a, d, via), (depth, bridge_id) in candidates.items():
+        kwargs = _closure_kwargs("ancestor", a)
+        kwargs.update(_closure_kwargs("descendant", d))
+        rows.append(models.MajoraArtifactClosure(via_process_id=via, depth=depth, bridge_artifact_id=bridge_id, **kwargs))
+    models.MajoraArtifactClosure.objects.bulk_create(rows)
+    return len(rows)
+
+def rebuild_closure(nodes):
+    # Rebuild the closure rows of nodes and everything below them, after a record
+    # between them has been changed or removed
+    nodes = set(nodes)
+    if len(nodes) == 0:
+        return 0
+    for row in models.MajoraArtifactClosure.objects.filter(_closure_q("ancestor", nodes)):
+        nodes.add(_closure_node(row, "descendant"))
+    models.MajoraArtifactClosure.objects.filter(_closure_q("descendant", nodes)).delete()
+
+    q = Q()
+    for kind in [ARTIFACT, GROUP]:
+        ids = set(x[1] for x in nodes if x[0] == kind)
+        if len(ids) > 0:
+            q |= Q(**{"out_%s_id__in" % kind: ids})
+    n_rows = 0
+    for record in models.MajoraArtifactProcessRecord.objects.non_polymorphic().filter(q).order_by('process__majora_timestamp', 'id'):
+        n_rows += add_closure_edge(record)
+    return n_rows
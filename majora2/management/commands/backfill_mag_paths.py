@@ -0,0 +1,63 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from majora2 import models
+
+class Command(BaseCommand):
+    help = "Populate the group_path, group_path_hash and group_path_prefix of every MAG below a DigitalResourceNode"
+    def add_arguments(self, parser):
+        parser.add_argument("--dry-run", help="Report the MAGs that would change without saving them", action="store_true")
+        parser.add_argument("--batch-size", help="Number of MAGs to update per query [1000]", type=int, default=1000)
+
+    def handle(self, *args, **options):
+        if options["batch_size"] < 1:
+            raise CommandError("--batch-size must be positive")
+
+        n_groups = n_conflicts = 0
+        changed = []
+        for node_id in models.DigitalResourceNode.objects.values_list('id', flat=True):
+            # Walk down from the node a level at a time, the path of each MAG is the path of its parent
+            # with its own name, and the first MAG to claim a path keeps it if siblings share a name
+            claimed = {}
+            paths = {node_id: None}
+            frontier = [node_id]
+            while len(frontier) > 0:
+                rows = []
+                for i in range(0, len(frontier), options["batch_size"]):
+                    for group_id, parent_id, current_name, root_id, group_path, group_path_hash, group_path_prefix in models.DigitalResourceGroup.objects.non_polymorphic().filter(
+                            parent_group_id__in=frontier[i:i + options["batch_size"]],
+                    ).order_by('id').values_list('id', 'parent_group_id', 'current_name', 'root_group_id', 'group_path', 'group_path_hash', 'group_path_prefix'):
+                        if group_id in paths:
+                            continue # parent_group loops back on itself
+                        path = current_name if paths[parent_id] is None else "%s/%s" % (paths[parent_id], current_name)
+                        rows.append((group_id, path, root_id, group_path, group_path_hash, group_path_prefix))
+                # Prefer the MAG that already holds a path
+                rows.sort(key=lambda x: x[1] != x[3])
+
+                frontier = []
+                for group_id, path, root_id, group_path, group_path_hash, group_path_prefix in rows:
+                    n_groups += 1
+                    paths[group_id] = path
+                    frontier.append(group_id)
+
+                    if path in claimed:
+                        n_conflicts += 1
+                        self.stdout.write("%s\t%s\tshares its path with %s" % (group_id, path, claimed[path]))
+                        path = None
+                    else:
+                        claimed[path] = group_id
+
+                    path_hash = models.hash_group_path(path)
+                    path_prefix = models.prefix_group_path(path)
+                    if group_path != path or group_path_hash != path_hash or group_path_prefix != path_prefix or root_id != node_id:
+                        changed.append(models.MajoraArtifactGroup(id=group_id, group_path=path, group_path_hash=path_hash, group_path_prefix=path_prefix, root_group_id=node_id))
+
+        n_changed = len(changed)
+        if not options["dry_run"] and n_changed > 0:
+            with transaction.atomic():
+                # Clear the hashes first, so MAGs can swap paths without tripping the unique constraint
+                for i in range(0, n_changed, options["batch_size"]):
+                    models.MajoraArtifactGroup.objects.non_polymorphic().filter(id__in=[g.id for g in changed[i:i + options["batch_size"]]]).update(group_path_hash=None)
+                models.MajoraArtifactGroup.objects.non_polymorphic().bulk_update(changed, ['group_path', 'group_path_hash', 'group_path_prefix', 'root_group'], batch_size=options["batch_size"])
+
+        self.stdout.write("%d MAGs checked, %d %s, %d sharing a path" % (n_groups, n_changed, "to update" if options["dry_run"] else "updated", n_conflicts))
@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from majora2 import lineage
+from majora2 import models
+
+class Command(BaseCommand):
+    help = "Rebuild the MajoraArtifactClosure table from every process record"
+    def add_arguments(self, parser):
+        parser.add_argument("--chunk-size", help="Number of process records to add per transaction [1000]", type=int, default=1000)
+
+    def handle(self, *args, **options):
+        if options["chunk_size"] < 1:
+            raise CommandError("--chunk-size must be positive")
+
+        models.MajoraArtifactClosure.objects.all().delete()
+
+        # Records are replayed in the order their processes were registered, so bridges
+        # are judged against the same lineage they would have been when they were added
+        record_ids = list(models.MajoraArtifactProcessRecord.objects.order_by('process__majora_timestamp', 'id').values_list('id', flat=True))
+        n_rows = 0
+        for i in range(0, len(record_ids), options["chunk_size"]):
+            chunk = record_ids[i:i + options["chunk_size"]]
+            records = {r.id: r for r in models.MajoraArtifactProcessRecord.objects.non_polymorphic().filter(id__in=chunk)}
+            with transaction.atomic():
+                for record_id in chunk:
+                    n_rows += lineage.add_closure_edge(records[record_id])
+
+        self.stdout.write("%d process records added, %d closure rows created" % (len(record_ids), n_rows))
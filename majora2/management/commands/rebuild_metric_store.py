@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from majora2 import metric_store
+from majora2 import models
+
+class Command(BaseCommand):
+    help = "Rebuild the MajoraArtifactMetricStore table from every artifact metric"
+    def add_arguments(self, parser):
+        parser.add_argument("--chunk-size", help="Number of artifacts to refresh per transaction [1000]", type=int, default=1000)
+
+    def handle(self, *args, **options):
+        if options["chunk_size"] < 1:
+            raise CommandError("--chunk-size must be positive")
+
+        models.MajoraArtifactMetricStore.objects.all().delete()
+
+        artifact_ids = list(models.TemporaryMajoraArtifactMetric.objects.non_polymorphic().order_by('artifact_id').values_list('artifact_id', flat=True).distinct())
+        n_rows = 0
+        for i in range(0, len(artifact_ids), options["chunk_size"]):
+            with transaction.atomic():
+                n_rows += metric_store.refresh(artifact_ids[i:i + options["chunk_size"]])
+
+        self.stdout.write("%d artifacts with metrics, %d store rows written" % (len(artifact_ids), n_rows))
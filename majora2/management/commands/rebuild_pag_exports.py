@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+
+from majora2 import models
+from majora2 import tasks
+from majora2 import util
+
+def _rebuild_chunk(pag_ids):
+    return len(tasks._refresh_pag_export_documents(pag_ids))
+
+class Command(BaseCommand):
+    help = "Rebuild the materialised PAG export documents"
+    def add_arguments(self, parser):
+        parser.add_argument("--workers", help="Number of processes to rebuild with [1]", type=util.positive_int, default=1)
+        parser.add_argument("--chunk-size", help="Number of PAGs to rebuild at a time [1000]", type=util.positive_int, default=1000)
+        parser.add_argument("--stale-only", help="Only rebuild documents that are missing or stale", action="store_true")
+
+    def handle(self, *args, **options):
+        pags = models.PublishedArtifactGroup.objects.all()
+        if options["stale_only"]:
+            pags = pags.filter(Q(export_document__isnull=True) | Q(export_document__is_stale=True) | Q(export_document__last_built__isnull=True))
+        else:
+            models.PAGExportDocument.objects.filter(is_stale=False).update(is_stale=True)
+
+        pag_ids = list(pags.order_by('id').values_list('id', flat=True))
+        chunks = [pag_ids[i:i + options["chunk_size"]] for i in range(0, len(pag_ids), options["chunk_size"])]
+
+        n_built = 0
+        for n in util.map_in_pool(_rebuild_chunk, chunks, options["workers"]):
+            n_built += n
+
+        self.stdout.write("%d PAGs selected, %d export documents built" % (len(pag_ids), n_built))
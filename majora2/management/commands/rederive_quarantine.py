@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from majora2 import lineage
+from majora2 import models
+from majora2 import util
+
+class Command(BaseCommand):
+    help = "Re-derive the effective quarantine source of every artifact from the process graph"
+    def add_arguments(self, parser):
+        parser.add_argument("--check", help="Report artifacts whose stored quarantine source is wrong without fixing them", action="store_true")
+        parser.add_argument("--chunk-size", help="Number of artifacts to derive at a time [1000]", type=int, default=1000)
+
+    def handle(self, *args, **options):
+        if options["chunk_size"] < 1:
+            raise CommandError("--chunk-size must be positive")
+
+        artifact_ids = list(models.MajoraArtifact.objects.order_by('id').values_list('id', flat=True))
+        n_wrong = 0
+        for i in range(0, len(artifact_ids), options["chunk_size"]):
+            artifacts = list(models.MajoraArtifact.objects.non_polymorphic().filter(id__in=artifact_ids[i:i + options["chunk_size"]]))
+            if options["check"]:
+                sources = lineage.derive_quarantine_sources(artifacts)
+                for artifact in artifacts:
+                    if artifact.effective_quarantine_source_id != sources[artifact.pk]:
+                        n_wrong += 1
+                        self.stdout.write("%s\t%s\t%s" % (artifact.pk, artifact.effective_quarantine_source_id, sources[artifact.pk]))
+            else:
+                n_wrong += util.update_quarantine_sources(artifacts)
+
+        if options["check"]:
+            self.stdout.write("%d artifacts checked, %d with the wrong quarantine source" % (len(artifact_ids), n_wrong))
+            if n_wrong > 0:
+                raise CommandError("Quarantine sources are inconsistent, run rederive_quarantine without --check to fix them")
+        else:
+            self.stdout.write("%d artifacts checked, %d quarantine sources updated" % (len(artifact_ids), n_wrong))
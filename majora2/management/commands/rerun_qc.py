@@ -0,0 +1,50 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from majora2 import models
+from majora2 import qc
+
+class Command(BaseCommand):
+    help = "Re-evaluate a QC test group over many PAGs, eg. after its thresholds have changed"
+    def add_arguments(self, parser):
+        parser.add_argument("test_name", help="Slug of the PAGQualityTestEquivalenceGroup")
+        parser.add_argument("--pag", help="published_name of a PAG to QC, may be repeated [every latest PAG already QC'd by the test group]", action="append")
+        parser.add_argument("--chunk-size", help="Number of PAGs to evaluate and write at a time [1000]", type=int, default=1000)
+        parser.add_argument("--dry-run", help="Report the PAGs that would flip between pass and fail without writing any reports", action="store_true")
+
+    def handle(self, *args, **options):
+        if options["chunk_size"] < 1:
+            raise CommandError("--chunk-size must be positive")
+
+        plan = qc.get_plan(options["test_name"])
+        if not plan:
+            raise CommandError("No such test group %s" % options["test_name"])
+
+        pags = models.PublishedArtifactGroup.objects.filter(is_latest=True, is_suppressed=False)
+        if options["pag"]:
+            pags = pags.filter(published_name__in=options["pag"])
+        else:
+            pags = pags.filter(quality_groups__test_group=plan.test_group)
+        pag_ids = list(pags.order_by('id').values_list('id', flat=True).distinct())
+
+        n_failed = n_to_pass = n_to_fail = 0
+        for i in range(0, len(pag_ids), options["chunk_size"]):
+            for outcome in qc.rerun(plan, pag_ids[i:i + options["chunk_size"]], dry_run=options["dry_run"]):
+                if outcome["is_pass"] is None:
+                    n_failed += 1
+                    self.stdout.write("%s\tNOT QC'D\t%s" % (outcome["published_name"], " ".join(outcome["messages"])))
+                elif bool(outcome["was_pass"]) != outcome["is_pass"]:
+                    if outcome["is_pass"]:
+                        n_to_pass += 1
+                    else:
+                        n_to_fail += 1
+                    self.stdout.write("%s\t%s\t%s" % (
+                        outcome["published_name"],
+                        "NEW" if outcome["was_pass"] is None else ("PASS" if outcome["was_pass"] else "FAIL"),
+                        "PASS" if outcome["is_pass"] else "FAIL",
+                    ))
+
+        self.stdout.write("%d PAGs evaluated, %d could not be QC'd, %d %s to pass, %d %s to fail" % (
+            len(pag_ids), n_failed,
+            n_to_pass, "would flip" if options["dry_run"] else "flipped",
+            n_to_fail, "would flip" if options["dry_run"] else "flipped",
+        ))
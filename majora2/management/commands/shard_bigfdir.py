@@ -1,15 +1,112 @@
 import sys
+import os
 import json
+import itertools
 
 from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
 from django.utils import timezone
 
 from majora2 import models
 from majora2 import util
+from tatl import audit
 from tatl import models as tmodels
 
 from django.contrib.auth.models import User
 
+def _read_checkpoint(checkpoint, start):
+    # A checkpoint holds the manifest line to carry on from
+    if checkpoint and os.path.exists(checkpoint):
+        with open(checkpoint) as fh:
+            return max(start, int(fh.read().strip() or start))
+    return start
+
+def _write_checkpoint(checkpoint, line_no):
+    if not checkpoint:
+        return
+    with open(checkpoint + ".tmp", "w") as fh:
+        fh.write("%d\n" % line_no)
+    os.replace(checkpoint + ".tmp", checkpoint)
+
+def _move_chunk(treq_id, node, rows):
+    # Move a chunk of manifest rows (old_mag, old_name, new_mag, new_name, new_path) in one transaction,
+    # returning an exit code for each: 0 moved, 1 no source MAG, 2 no file or destination MAG
+    exits = [0] * len(rows)
+    with transaction.atomic():
+        src_mags = util.resolve_mags(node, [row[0] for row in rows], create=False)
+        dras = {}
+        names = set([row[1] for row in rows])
+        src_ids = set([mag.pk for mag in src_mags.values() if mag])
+        if len(src_ids) > 0:
+            for dra in models.DigitalResourceArtifact.objects.filter(primary_group__in=src_ids, current_name__in=names):
+                dras[(dra.primary_group_id, dra.current_name)] = dra
+
+        dest_paths = []
+        for i, row in enumerate(rows):
+            if not src_mags[row[0]]:
+                exits[i] = 1
+            elif (src_mags[row[0]].pk, row[1]) not in dras:
+                exits[i] = 2
+            else:
+                dest_paths.append(row[2])
+        dest_mags = util.resolve_mags(node, dest_paths)
+
+        moved = {}
+        for i, row in enumerate(rows):
+            if exits[i] != 0:
+                continue
+            dest_mag_o = dest_mags[row[2]]
+            if not dest_mag_o:
+                exits[i] = 2
+                continue
+            dra = dras[(src_mags[row[0]].pk, row[1])]
+            dra.current_path = row[4]
+            dra.primary_group = dest_mag_o
+            moved[dra.id] = dra
+
+        if len(moved) > 0:
+            models.DigitalResourceArtifact.objects.bulk_update(list(moved.values()), ['current_path', 'primary_group'])
+            util.invalidate_mag_cache()
+            util.mark_pag_exports_stale(artifacts=list(moved.keys()))
+
+            # Flex verbs, written with their post_save so each move is still logged
+            treq = tmodels.TatlRequest.objects.get(pk=treq_id)
+            audit.write_records([
+                tmodels.TatlVerb(request=treq, verb="UPDATE", content_object=dra, extra_context=json.dumps({}))
+                for dra in moved.values()
+            ])
+    return exits
+
+def _move_range(filename, node_name, treq_id, start, end, chunk_size, checkpoint):
+    # Move the rows of manifest lines [start, end), committing and checkpointing every chunk_size lines
+    # Returns the number of lines read and files moved
+    node = util.get_node(node_name)
+    line_no = _read_checkpoint(checkpoint, start)
+    n_lines = n_moved = 0
+    with open(filename) as fh:
+        lines = itertools.islice(fh, line_no, end)
+        while True:
+            chunk = list(itertools.islice(lines, chunk_size))
+            if len(chunk) == 0:
+                break
+            rows = []
+            for line in chunk:
+                new_mv, old_mag, old_name, new_mag, new_name, new_path = line.strip().split('\t')
+                if int(new_mv) > 0:
+                    rows.append((old_mag, old_name, new_mag, new_name, new_path))
+            if len(rows) > 0:
+                for exit, row in zip(_move_chunk(treq_id, node, rows), rows):
+                    print(exit, row[0], row[1])
+                    if exit == 0:
+                        n_moved += 1
+            line_no += len(chunk)
+            n_lines += len(chunk)
+            _write_checkpoint(checkpoint, line_no)
+    return n_lines, n_moved
+
+def _move_range_worker(args):
+    return _move_range(*args)
+
 class Command(BaseCommand):
     help = "Read a shard manifest and move the associated Digital Resource Artifacts"
     def add_arguments(self, parser):
@@ -18,77 +115,57 @@ class Command(BaseCommand):
         parser.add_argument("--view-name", help="TatlRequest.view_name", required=True)
         parser.add_argument("--param", help="key:value to add to TatlRequest.params", action='append', nargs=2, metavar=('key', 'value'))
         parser.add_argument("--node", help="DigitalResourceNode", default="climb")
+        parser.add_argument("--chunk-size", help="Number of manifest lines to move per transaction [1000]", type=util.positive_int, default=1000)
+        parser.add_argument("--start", help="First manifest line to move, counting from 0 [0]", type=int, default=0)
+        parser.add_argument("--end", help="Stop before this manifest line [end of manifest]", type=int)
+        parser.add_argument("--workers", help="Number of processes to split the manifest lines between [1]", type=util.positive_int, default=1)
+        parser.add_argument("--checkpoint", help="Record progress to this file (one file per worker, suffixed with its range), and resume from it when run again with the same arguments")
 
 
     def handle(self, *args, **options):
-
-        mag_cache = {}
-
         user = User.objects.get(username=options["username"])
         if not user:
             sys.stderr.write("No such user\n")
             sys.exit(1)
 
-        params_d = {x[0]: x[1] for x in options["param"]}
+        params_d = {x[0]: x[1] for x in options["param"] or []}
         try:
             json_params = json.dumps(params_d)
         except:
             sys.stderr.write("Could not transform --param to JSON\n")
             sys.exit(1)
 
+        node = util.get_node(options["node"])
+        if not node:
+            sys.stderr.write("No such node\n")
+            sys.exit(1)
+
         treq = tmodels.TatlRequest(user=user, view_name=options["view_name"], is_api=False)
         treq.status_code = 0
         treq.params = json_params
         treq.timestamp = timezone.now()
         treq.save()
 
-        fh = open(options["filename"])
-
-        for line in fh:
-            new_mv, old_mag, old_name, new_mag, new_name, new_path = line.strip().split('\t')
-            if int(new_mv) > 0:
-                exit, dra = self.mv(mag_cache=mag_cache, treq=treq, node=options["node"], src_mag=old_mag, src_name=old_name, dest_mag=new_mag, dest_name=new_name, dest_path=new_path)
-                print(exit, old_mag, old_name)
-
-    def mv(self, mag_cache, treq, node, src_mag, src_name, dest_mag, dest_name, dest_path):
-        src_mag_o = None
-        if src_mag not in mag_cache:
-            src_mag_o = util.get_mag(node, src_mag)
-            if src_mag_o:
-                mag_cache[src_mag] = src_mag_o
-        else:
-            src_mag_o = mag_cache[src_mag]
-
-        if not src_mag_o:
-            return 1, None
-
-        try:
-            dra = models.DigitalResourceArtifact.objects.get(primary_group=src_mag_o, current_name=src_name)
-        except models.DigitalResourceArtifact.DoesNotExist:
-            return 2, None
-
-        dest_mag_o = None
-        if dest_mag not in mag_cache:
-            dest_mag_o = util.get_mag(node, dest_mag)
-            if dest_mag_o:
-                mag_cache[dest_mag] = dest_mag_o
-        else:
-            dest_mag_o = mag_cache[dest_mag]
-
-        if not dest_mag_o:
-            mags, mags_created = util.mkmag(root=models.DigitalResourceNode.objects.get(unique_name=node), path=dest_mag)
-            dest_mag_o = mags[-1]
-
-        if not dest_mag_o:
-            return 2, None
-
-        dra.current_path = dest_path
-        dra.primary_group = dest_mag_o
-        dra.save()
-
-        # Flex verb
-        tmodels.TatlVerb(request=treq, verb="UPDATE", content_object=dra,
-            extra_context = json.dumps({
-            }),
-        ).save()
-        return 0, dra
+        start = options["start"]
+        end = options["end"]
+        if end is None:
+            with open(options["filename"]) as fh:
+                end = sum(1 for line in fh)
+        if start < 0 or end < start:
+            raise CommandError("--start and --end must give a range of manifest lines")
+
+        # Workers take disjoint ranges of the manifest, each with its own checkpoint
+        step = -(-(end - start) // options["workers"])
+        ranges = [(i, min(i + step, end)) for i in range(start, end, step)] if step > 0 else []
+        jobs = [
+            (options["filename"], options["node"], treq.id, r_start, r_end, options["chunk_size"],
+                "%s.%d-%d" % (options["checkpoint"], r_start, r_end) if options["checkpoint"] else None)
+            for r_start, r_end in ranges
+        ]
+
+        n_lines = n_moved = 0
+        for n, m in util.map_in_pool(_move_range_worker, jobs, options["workers"]):
+            n_lines += n
+            n_moved += m
+
+        self.stdout.write("%d manifest lines read, %d files moved" % (n_lines, n_moved))
@@ -0,0 +1,120 @@
+import threading
+from contextlib import contextmanager
+
+from . import models
+
+# Columnar copy of the TemporaryMajoraArtifactMetric models, see models.MajoraArtifactMetricStore
+# Each metric model writes through to its artifact's row (see receivers.py), and callers that
+# bypass signals with bulk_update must touch the artifacts they wrote. Readers get every metric
+# of an artifact from a single row, rather than joining through each metric table in turn.
+# The store is filled by its migration, and can be refilled with the rebuild_metric_store command.
+
+# Metric models, the prefix of their columns in the store, the namespace they are read
+# as by QC (if any), and the fields that are copied
+# QC used to key each metric by its own namespace field. Every metric the API writes takes its
+# namespace from api_views.METRIC_FORMS, which maps one namespace to each of these models, so
+# the namespace is fixed per model here rather than stored per row. Dehum metrics are not
+# written by the API, so they have no namespace here and are not offered to QC
+SOURCES = [
+    (models.TemporaryMajoraArtifactMetric_Sequence, "sequence", "sequence", [
+        "num_seqs", "num_bases", "pc_acgt", "pc_masked", "pc_invalid", "longest_gap", "longest_ungap",
+    ]),
+    (models.TemporaryMajoraArtifactMetric_Mapping, "mapping", "mapping", [
+        "num_pos", "num_maps", "num_unmaps", "median_cov", "mean_cov",
+        "pc_pos_cov_gte1", "pc_pos_cov_gte5", "pc_pos_cov_gte10", "pc_pos_cov_gte20", "pc_pos_cov_gte50", "pc_pos_cov_gte100", "pc_pos_cov_gte200",
+    ]),
+    (models.TemporaryMajoraArtifactMetric_Mapping_Tiles, "tiles", "tile-mapping", [
+        "n_tiles",
+        "pc_tiles_medcov_gte1", "pc_tiles_medcov_gte5", "pc_tiles_medcov_gte10", "pc_tiles_medcov_gte20", "pc_tiles_medcov_gte50", "pc_tiles_medcov_gte100", "pc_tiles_medcov_gte200",
+    ]),
+    (models.TemporaryMajoraArtifactMetric_ThresholdCycle, "ct", "ct", [
+        "num_tests", "min_ct", "max_ct",
+    ]),
+    (models.TemporaryMajoraArtifactMetric_Dehum, "dehum", None, [
+        "total_dropped", "n_hits", "n_clipped", "n_known", "n_collateral",
+    ]),
+]
+SOURCE_MODELS = [source[0] for source in SOURCES]
+COLUMNS = ["%s_%s" % (prefix, field) for model, prefix, namespace, fields in SOURCES for field in ["n_metrics"] + fields]
+
+_deferred = threading.local()
+
+def refresh(artifact_ids):
+    # Rewrite the store rows of the given artifacts from their metrics, with one query per metric
+    # model and a bulk write of the rows. Artifacts left without metrics lose their row.
+    # Returns the number of rows written
+    artifact_ids = set(artifact_ids) - {None}
+    if len(artifact_ids) == 0:
+        return 0
+    store = models.MajoraArtifactMetricStore
+
+    rows = {}
+    for model, prefix, namespace, fields in SOURCES:
+        # Iterate backwards so the first metric of each kind wins, like get_metrics_as_struct
+        for values in model.objects.filter(artifact_id__in=artifact_ids).order_by('-id').values('artifact_id', *fields):
+            row = rows.setdefault(values["artifact_id"], {column: 0 if column.endswith("_n_metrics") else None for column in COLUMNS})
+            row["%s_n_metrics" % prefix] += 1
+            for field in fields:
+                row["%s_%s" % (prefix, field)] = values[field]
+
+    existing = set(store.objects.filter(artifact_id__in=artifact_ids).values_list('artifact_id', flat=True))
+    emptied = existing - set(rows)
+    if len(emptied) > 0:
+        store.objects.filter(artifact_id__in=emptied).delete()
+
+    to_create = []
+    to_update = []
+    for artifact_id, row in rows.items():
+        store_row = store(artifact_id=artifact_id, **row)
+        if artifact_id in existing:
+            to_update.append(store_row)
+        else:
+            to_create.append(store_row)
+    if len(to_create) > 0:
+        store.objects.bulk_create(to_create)
+    if len(to_update) > 0:
+        store.objects.bulk_update(to_update, COLUMNS)
+    return len(rows)
+
+def touch(artifact_ids):
+    # Refresh the rows of these artifacts now, or when the enclosing deferred block ends
+    pending = getattr(_deferred, "artifact_ids", None)
+    if pending is not None:
+        pending.update(artifact_ids)
+    else:
+        refresh(artifact_ids)
+
+@contextmanager
+def deferred():
+    # Collect the artifacts touched inside the block and refresh them together on the way out,
+    # so writing many metrics does not refresh the same rows over and over
+    if getattr(_deferred, "artifact_ids", None) is not None:
+        yield
+        return
+    _deferred.artifact_ids = set()
+    try:
+        yield
+        artifact_ids = _deferred.artifact_ids
+    finally:
+        _deferred.artifact_ids = None
+    refresh(artifact_ids)
+
+def get_structs(artifact_ids):
+    # Return the metrics of each artifact as {namespace: (struct, n_metrics)}, with the struct shaped
+    # like the as_struct of the first metric of that kind, and n_metrics the number of metrics of that
+    # kind the artifact has. Read from the store with one query. Ct records are not kept in the store.
+    structs = {}
+    if len(artifact_ids) == 0:
+        return structs
+    for row in models.MajoraArtifactMetricStore.objects.filter(artifact_id__in=artifact_ids).values('artifact_id', *COLUMNS):
+        artifact_structs = structs.setdefault(row["artifact_id"], {})
+        for model, prefix, namespace, fields in SOURCES:
+            if not namespace or row["%s_n_metrics" % prefix] == 0:
+                continue
+            metric = model(**{field: row["%s_%s" % (prefix, field)] for field in fields})
+            if isinstance(metric, models.TemporaryMajoraArtifactMetric_ThresholdCycle):
+                struct = {field: getattr(metric, field) for field in fields}
+            else:
+                struct = metric.as_struct()
+            artifact_structs[namespace] = (struct, row["%s_n_metrics" % prefix])
+    return structs
@@ -0,0 +1,23 @@
+# Generated by Django 2.2.27 on 2026-10-18 11:48
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('majora2', '0152_backfill_dnasequencingprocessrecord_uniquename'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PAGExportDocument',
+            fields=[
+                ('pag', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='export_document', serialize=False, to='majora2.PublishedArtifactGroup')),
+                ('document', models.TextField(blank=True, null=True)),
+                ('is_stale', models.BooleanField(db_index=True, default=True)),
+                ('last_built', models.DateTimeField(blank=True, null=True)),
+            ],
+        ),
+    ]
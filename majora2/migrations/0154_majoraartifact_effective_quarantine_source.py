@@ -0,0 +1,19 @@
+# Generated by Django 2.2.27 on 2026-10-18 12:32
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('majora2', '0153_pagexportdocument'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='majoraartifact',
+            name='effective_quarantine_source',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='quarantined_descendants', to='majora2.MajoraArtifact'),
+        ),
+    ]
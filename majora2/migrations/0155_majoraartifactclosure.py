@@ -0,0 +1,27 @@
+# Generated by Django 2.2.27 on 2026-10-18 12:36
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('majora2', '0154_majoraartifact_effective_quarantine_source'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MajoraArtifactClosure',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('depth', models.PositiveIntegerField()),
+                ('ancestor_artifact', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='closure_descendants', to='majora2.MajoraArtifact')),
+                ('ancestor_group', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='closure_descendants', to='majora2.MajoraArtifactGroup')),
+                ('bridge_artifact', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='closure_bridges', to='majora2.MajoraArtifact')),
+                ('descendant_artifact', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='closure_ancestors', to='majora2.MajoraArtifact')),
+                ('descendant_group', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='closure_ancestors', to='majora2.MajoraArtifactGroup')),
+                ('via_process', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='closure_paths', to='majora2.MajoraArtifactProcess')),
+            ],
+        ),
+    ]
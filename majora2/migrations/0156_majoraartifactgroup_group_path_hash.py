@@ -0,0 +1,37 @@
+# Generated by Django 2.2.27 on 2026-10-18 12:47
+
+import hashlib
+
+from django.db import migrations, models
+
+
+def hash_group_paths(apps, schema_editor):
+    # Hash the paths that are already set, backfill_mag_paths fills in the rest
+    MajoraArtifactGroup = apps.get_model('majora2', 'MajoraArtifactGroup')
+    for group_id, group_path in MajoraArtifactGroup.objects.filter(group_path__isnull=False).values_list('id', 'group_path').iterator():
+        MajoraArtifactGroup.objects.filter(id=group_id).update(group_path_hash=hashlib.sha256(group_path.encode()).hexdigest())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('majora2', '0155_majoraartifactclosure'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='majoraartifactgroup',
+            name='group_path_hash',
+            field=models.CharField(blank=True, editable=False, max_length=64, null=True),
+        ),
+        migrations.AlterField(
+            model_name='majoraartifactgroup',
+            name='group_path',
+            field=models.CharField(blank=True, max_length=1024, null=True),
+        ),
+        migrations.RunPython(hash_group_paths, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='majoraartifactgroup',
+            constraint=models.UniqueConstraint(fields=('root_group', 'group_path_hash'), name='unique_group_path_per_root'),
+        ),
+    ]
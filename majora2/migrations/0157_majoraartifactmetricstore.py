@@ -0,0 +1,104 @@
+# Generated by Django 2.2.27 on 2026-10-18 13:23
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+# A frozen copy of metric_store.SOURCES as it was when the store was added, so later changes
+# to the store module do not change what this migration does
+SOURCES = [
+    ('TemporaryMajoraArtifactMetric_Sequence', "sequence", [
+        "num_seqs", "num_bases", "pc_acgt", "pc_masked", "pc_invalid", "longest_gap", "longest_ungap",
+    ]),
+    ('TemporaryMajoraArtifactMetric_Mapping', "mapping", [
+        "num_pos", "num_maps", "num_unmaps", "median_cov", "mean_cov",
+        "pc_pos_cov_gte1", "pc_pos_cov_gte5", "pc_pos_cov_gte10", "pc_pos_cov_gte20", "pc_pos_cov_gte50", "pc_pos_cov_gte100", "pc_pos_cov_gte200",
+    ]),
+    ('TemporaryMajoraArtifactMetric_Mapping_Tiles', "tiles", [
+        "n_tiles",
+        "pc_tiles_medcov_gte1", "pc_tiles_medcov_gte5", "pc_tiles_medcov_gte10", "pc_tiles_medcov_gte20", "pc_tiles_medcov_gte50", "pc_tiles_medcov_gte100", "pc_tiles_medcov_gte200",
+    ]),
+    ('TemporaryMajoraArtifactMetric_ThresholdCycle', "ct", [
+        "num_tests", "min_ct", "max_ct",
+    ]),
+    ('TemporaryMajoraArtifactMetric_Dehum', "dehum", [
+        "total_dropped", "n_hits", "n_clipped", "n_known", "n_collateral",
+    ]),
+]
+COLUMNS = ["%s_%s" % (prefix, field) for model, prefix, fields in SOURCES for field in ["n_metrics"] + fields]
+
+
+def fill_metric_store(apps, schema_editor):
+    # Copy the existing metrics into the store, so QC and exports can read them straight away
+    # Each row counts the metrics of each kind and copies the first of them, as metric_store.refresh
+    TemporaryMajoraArtifactMetric = apps.get_model('majora2', 'TemporaryMajoraArtifactMetric')
+    MajoraArtifactMetricStore = apps.get_model('majora2', 'MajoraArtifactMetricStore')
+    artifact_ids = list(TemporaryMajoraArtifactMetric.objects.order_by('artifact_id').values_list('artifact_id', flat=True).distinct())
+    for i in range(0, len(artifact_ids), 1000):
+        chunk = artifact_ids[i:i + 1000]
+        rows = {}
+        for model, prefix, fields in SOURCES:
+            # Iterate backwards so the first metric of each kind wins
+            for values in apps.get_model('majora2', model).objects.filter(artifact_id__in=chunk).order_by('-id').values('artifact_id', *fields):
+                row = rows.setdefault(values["artifact_id"], {column: 0 if column.endswith("_n_metrics") else None for column in COLUMNS})
+                row["%s_n_metrics" % prefix] += 1
+                for field in fields:
+                    row["%s_%s" % (prefix, field)] = values[field]
+        MajoraArtifactMetricStore.objects.bulk_create([MajoraArtifactMetricStore(artifact_id=artifact_id, **row) for artifact_id, row in rows.items()])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('majora2', '0156_majoraartifactgroup_group_path_hash'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MajoraArtifactMetricStore',
+            fields=[
+                ('artifact', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='metric_store', serialize=False, to='majora2.MajoraArtifact')),
+                ('sequence_n_metrics', models.PositiveSmallIntegerField(default=0)),
+                ('sequence_num_seqs', models.PositiveIntegerField(blank=True, null=True)),
+                ('sequence_num_bases', models.PositiveIntegerField(blank=True, null=True)),
+                ('sequence_pc_acgt', models.FloatField(blank=True, null=True)),
+                ('sequence_pc_masked', models.FloatField(blank=True, null=True)),
+                ('sequence_pc_invalid', models.FloatField(blank=True, null=True)),
+                ('sequence_longest_gap', models.PositiveIntegerField(blank=True, null=True)),
+                ('sequence_longest_ungap', models.PositiveIntegerField(blank=True, null=True)),
+                ('mapping_n_metrics', models.PositiveSmallIntegerField(default=0)),
+                ('mapping_num_pos', models.PositiveIntegerField(blank=True, null=True)),
+                ('mapping_num_maps', models.PositiveIntegerField(blank=True, null=True)),
+                ('mapping_num_unmaps', models.PositiveIntegerField(blank=True, null=True)),
+                ('mapping_median_cov', models.FloatField(blank=True, null=True)),
+                ('mapping_mean_cov', models.FloatField(blank=True, null=True)),
+                ('mapping_pc_pos_cov_gte1', models.FloatField(blank=True, null=True)),
+                ('mapping_pc_pos_cov_gte5', models.FloatField(blank=True, null=True)),
+                ('mapping_pc_pos_cov_gte10', models.FloatField(blank=True, null=True)),
+                ('mapping_pc_pos_cov_gte20', models.FloatField(blank=True, null=True)),
+                ('mapping_pc_pos_cov_gte50', models.FloatField(blank=True, null=True)),
+                ('mapping_pc_pos_cov_gte100', models.FloatField(blank=True, null=True)),
+                ('mapping_pc_pos_cov_gte200', models.FloatField(blank=True, null=True)),
+                ('tiles_n_metrics', models.PositiveSmallIntegerField(default=0)),
+                ('tiles_n_tiles', models.PositiveSmallIntegerField(blank=True, null=True)),
+                ('tiles_pc_tiles_medcov_gte1', models.FloatField(blank=True, null=True)),
+                ('tiles_pc_tiles_medcov_gte5', models.FloatField(blank=True, null=True)),
+                ('tiles_pc_tiles_medcov_gte10', models.FloatField(blank=True, null=True)),
+                ('tiles_pc_tiles_medcov_gte20', models.FloatField(blank=True, null=True)),
+                ('tiles_pc_tiles_medcov_gte50', models.FloatField(blank=True, null=True)),
+                ('tiles_pc_tiles_medcov_gte100', models.FloatField(blank=True, null=True)),
+                ('tiles_pc_tiles_medcov_gte200', models.FloatField(blank=True, null=True)),
+                ('ct_n_metrics', models.PositiveSmallIntegerField(default=0)),
+                ('ct_num_tests', models.PositiveIntegerField(blank=True, null=True)),
+                ('ct_min_ct', models.FloatField(blank=True, null=True)),
+                ('ct_max_ct', models.FloatField(blank=True, null=True)),
+                ('dehum_n_metrics', models.PositiveSmallIntegerField(default=0)),
+                ('dehum_total_dropped', models.PositiveIntegerField(blank=True, null=True)),
+                ('dehum_n_hits', models.PositiveIntegerField(blank=True, null=True)),
+                ('dehum_n_clipped', models.PositiveIntegerField(blank=True, null=True)),
+                ('dehum_n_known', models.PositiveIntegerField(blank=True, null=True)),
+                ('dehum_n_collateral', models.PositiveIntegerField(blank=True, null=True)),
+            ],
+        ),
+        migrations.RunPython(fill_metric_store, migrations.RunPython.noop),
+    ]
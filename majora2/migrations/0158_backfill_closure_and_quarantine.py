@@ -0,0 +1,177 @@
+from django.db import migrations
+from django.db.models import Q
+
+
+# The closure table (0155) is created empty, and effective_quarantine_source (0154) is derived
+# from it, so both are filled here, closure first. The logic is a frozen copy of
+# lineage.add_closure_edge and lineage.derive_quarantine_sources as they were when these
+# fields were added, so later changes to those functions do not change what this migration does.
+# The rebuild_lineage_closure and rederive_quarantine commands refill them with the live code.
+
+ARTIFACT = "artifact"
+GROUP = "group"
+CHUNK_SIZE = 1000
+
+
+def _parents(record):
+    parents = []
+    if record.in_group_id:
+        parents.append((GROUP, record.in_group_id))
+    if record.in_artifact_id:
+        parents.append((ARTIFACT, record.in_artifact_id))
+    return parents
+
+def _children(record):
+    children = []
+    if record.out_artifact_id:
+        children.append((ARTIFACT, record.out_artifact_id))
+    if record.out_group_id:
+        children.append((GROUP, record.out_group_id))
+    return children
+
+def _closure_q(side, nodes):
+    q = Q()
+    for kind in [ARTIFACT, GROUP]:
+        ids = set(x[1] for x in nodes if x[0] == kind)
+        if len(ids) > 0:
+            q |= Q(**{"%s_%s_id__in" % (side, kind): ids})
+    return q
+
+def _closure_node(row, side):
+    artifact_id = getattr(row, "%s_artifact_id" % side)
+    if artifact_id:
+        return (ARTIFACT, artifact_id)
+    return (GROUP, getattr(row, "%s_group_id" % side))
+
+def _closure_kwargs(side, node):
+    return {"%s_%s_id" % (side, node[0]): node[1]}
+
+def _related_nodes(Closure, bridge_ids):
+    related = {bridge_id: set([(ARTIFACT, bridge_id)]) for bridge_id in bridge_ids}
+    if len(bridge_ids) > 0:
+        for row in Closure.objects.filter(Q(ancestor_artifact_id__in=bridge_ids) | Q(descendant_artifact_id__in=bridge_ids)):
+            if row.ancestor_artifact_id in related:
+                related[row.ancestor_artifact_id].add(_closure_node(row, "descendant"))
+            if row.descendant_artifact_id in related:
+                related[row.descendant_artifact_id].add(_closure_node(row, "ancestor"))
+    return related
+
+def _add_closure_edge(Closure, record):
+    ins = _parents(record)
+    outs = [x for x in _children(record) if x not in ins]
+    if len(ins) == 0 or len(outs) == 0:
+        return 0
+
+    ups = {u: [(u, record.process_id, 0, None)] for u in ins}
+    for row in Closure.objects.filter(_closure_q("descendant", ins)):
+        ups[_closure_node(row, "descendant")].append((_closure_node(row, "ancestor"), row.via_process_id, row.depth, row.bridge_artifact_id))
+    downs = {v: {v: (0, None)} for v in outs}
+    for row in Closure.objects.filter(_closure_q("ancestor", outs)):
+        d = _closure_node(row, "descendant")
+        v = _closure_node(row, "ancestor")
+        if d not in downs[v] or row.depth < downs[v][d][0]:
+            downs[v][d] = (row.depth, row.bridge_artifact_id)
+
+    bridge_ids = set([record.bridge_artifact_id]) if record.bridge_artifact_id else set()
+    for v in outs:
+        bridge_ids.update(x[1] for x in downs[v].values() if x[1])
+    related = _related_nodes(Closure, bridge_ids)
+
+    candidates = {}
+    for u in ins:
+        for v in outs:
+            for a, via, a_depth, a_bridge in ups[u]:
+                for d, (d_depth, d_bridge) in downs[v].items():
+                    if a == d:
+                        continue
+                    if a != u and record.bridge_artifact_id and a not in related[record.bridge_artifact_id]:
+                        continue
+                    if d_bridge and a not in related[d_bridge]:
+                        continue
+
+                    depth = a_depth + 1 + d_depth
+                    key = (a, d, via)
+                    if key not in candidates or depth < candidates[key][0]:
+                        candidates[key] = (depth, a_bridge or record.bridge_artifact_id or d_bridge)
+    if len(candidates) == 0:
+        return 0
+
+    ancestors = set(x[0] for x in candidates)
+    descendants = set(x[1] for x in candidates)
+    for row in Closure.objects.filter(_closure_q("ancestor", ancestors)).filter(_closure_q("descendant", descendants)):
+        key = (_closure_node(row, "ancestor"), _closure_node(row, "descendant"), row.via_process_id)
+        if key in candidates:
+            depth, bridge_id = candidates.pop(key)
+            if depth < row.depth:
+                row.depth = depth
+                row.save(update_fields=["depth"])
+
+    rows = []
+    for (a, d, via), (depth, bridge_id) in candidates.items():
+        kwargs = _closure_kwargs("ancestor", a)
+        kwargs.update(_closure_kwargs("descendant", d))
+        rows.append(Closure(via_process_id=via, depth=depth, bridge_artifact_id=bridge_id, **kwargs))
+    Closure.objects.bulk_create(rows)
+    return len(rows)
+
+def fill_closure(apps, schema_editor):
+    # Replay every record in the order its process was registered, like rebuild_lineage_closure
+    Closure = apps.get_model('majora2', 'MajoraArtifactClosure')
+    MajoraArtifactProcessRecord = apps.get_model('majora2', 'MajoraArtifactProcessRecord')
+    Closure.objects.all().delete()
+    record_ids = list(MajoraArtifactProcessRecord.objects.order_by('process__majora_timestamp', 'id').values_list('id', flat=True))
+    for i in range(0, len(record_ids), CHUNK_SIZE):
+        chunk = record_ids[i:i + CHUNK_SIZE]
+        records = {r.id: r for r in MajoraArtifactProcessRecord.objects.filter(id__in=chunk)}
+        for record_id in chunk:
+            _add_closure_edge(Closure, records[record_id])
+
+def fill_quarantine_sources(apps, schema_editor):
+    # Point each artifact at itself if quarantined, at its root_artifact if it has one and that
+    # is quarantined, or otherwise at its nearest quarantined ancestor in the closure
+    MajoraArtifact = apps.get_model('majora2', 'MajoraArtifact')
+    Closure = apps.get_model('majora2', 'MajoraArtifactClosure')
+    quarantined = set(MajoraArtifact.objects.filter(quarantined=True).values_list('id', flat=True))
+    if len(quarantined) == 0:
+        return
+
+    artifact_ids = list(MajoraArtifact.objects.order_by('id').values_list('id', flat=True))
+    for i in range(0, len(artifact_ids), CHUNK_SIZE):
+        sources = {}
+        walked = []
+        for artifact_id, root_artifact_id in MajoraArtifact.objects.filter(id__in=artifact_ids[i:i + CHUNK_SIZE]).values_list('id', 'root_artifact_id'):
+            if artifact_id in quarantined:
+                sources[artifact_id] = artifact_id
+            elif root_artifact_id:
+                sources[artifact_id] = root_artifact_id if root_artifact_id in quarantined else None
+            else:
+                walked.append(artifact_id)
+                sources[artifact_id] = None
+
+        if len(walked) > 0:
+            nearest = Closure.objects.filter(
+                descendant_artifact_id__in=walked,
+                ancestor_artifact__quarantined=True,
+            ).order_by('depth', 'ancestor_artifact_id').values_list('descendant_artifact_id', 'ancestor_artifact_id')
+            for artifact_id, source_id in nearest:
+                if not sources[artifact_id]:
+                    sources[artifact_id] = source_id
+
+        changed = {}
+        for artifact_id, source_id in sources.items():
+            if source_id:
+                changed.setdefault(source_id, []).append(artifact_id)
+        for source_id, ids in changed.items():
+            MajoraArtifact.objects.filter(id__in=ids).update(effective_quarantine_source_id=source_id)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('majora2', '0157_majoraartifactmetricstore'),
+    ]
+
+    operations = [
+        migrations.RunPython(fill_closure, migrations.RunPython.noop),
+        migrations.RunPython(fill_quarantine_sources, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 2.2.27 on 2026-10-18 16:02
+
+from django.db import migrations, models
+from django.db.models.functions import Substr
+
+
+def prefix_group_paths(apps, schema_editor):
+    # Cut the prefix of the paths that are already set, backfill_mag_paths fills in the rest
+    MajoraArtifactGroup = apps.get_model('majora2', 'MajoraArtifactGroup')
+    MajoraArtifactGroup.objects.filter(group_path__isnull=False).update(group_path_prefix=Substr('group_path', 1, 255))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('majora2', '0158_backfill_closure_and_quarantine'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='majoraartifactgroup',
+            name='group_path_prefix',
+            field=models.CharField(blank=True, editable=False, max_length=255, null=True),
+        ),
+        migrations.RunPython(prefix_group_paths, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='majoraartifactgroup',
+            index=models.Index(fields=['root_group', 'group_path_prefix', 'id'], name='majora2_mag_root_prefix_idx', opclasses=['uuid_ops', 'varchar_pattern_ops', 'uuid_ops']),
+        ),
+    ]
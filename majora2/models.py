@@ -1,6 +1,7 @@
 import uuid
 import os
 import builtins
+import hashlib
 
 from django.db import models
 from django.conf import settings
@@ -12,19 +13,37 @@ from django.utils import timezone
 from django.contrib.auth.models import Permission
 from django.contrib.contenttypes.fields import GenericRelation
 
+from polymorphic.managers import PolymorphicManager
 from polymorphic.models import PolymorphicModel
+from polymorphic.query import PolymorphicQuerySet
 from .submodels import *
+from . import instances
 
 from oauth2_provider.settings import oauth2_settings
 OAUTH_APPLICATION_MODEL = oauth2_settings.APPLICATION_MODEL
 
+class MajoraPolymorphicQuerySet(PolymorphicQuerySet):
+    def resolve_related(self, *fields):
+        # Evaluate to a list, with the real instances of the polymorphic foreign keys in
+        # fields attached in bulk rather than fetched one row at a time, see instances.resolve_related
+        objs = list(self)
+        instances.resolve_related(objs, *fields)
+        return objs
+
+MajoraPolymorphicManager = PolymorphicManager.from_queryset(MajoraPolymorphicQuerySet)
+
 class MajoraArtifact(PolymorphicModel):
+    objects = MajoraPolymorphicManager()
+
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False) #
     dice_name = models.CharField(max_length=96, blank=True, null=True, unique=True)
     meta_name = models.CharField(max_length=96, blank=True, null=True)
 
     root_artifact = models.ForeignKey('MajoraArtifact', blank=True, null=True, on_delete=models.PROTECT, related_name="descendants")
     quarantined = models.BooleanField(default=False)
+    # The nearest quarantined artifact at or above this one, maintained by util.quarantine_artifact
+    # and util.unquarantine_artifact, and re-derived by the rederive_quarantine command
+    effective_quarantine_source = models.ForeignKey('MajoraArtifact', blank=True, null=True, on_delete=models.SET_NULL, related_name="quarantined_descendants")
 
     primary_group = models.ForeignKey('MajoraArtifactGroup', blank=True, null=True, on_delete=models.PROTECT, related_name="child_artifacts")
     groups = models.ManyToManyField('MajoraArtifactGroup', related_name="tagged_artifacts", blank=True) # represents 'tagged' ResourceGroups
@@ -62,29 +81,15 @@ class MajoraArtifact(PolymorphicModel):
             return self.dice_name
     @property
     def process_history(self):
-        return (self.before_process.all() | self.after_process.all()).order_by('-process__when').get_real_instances()
+        return (self.before_process.all() | self.after_process.all()).order_by('-process__when').resolve_related('process', 'in_artifact', 'in_group', 'out_artifact', 'out_group')
 
     @property
     def process_tree(self):
-        return self.process_tree_up([])
-    def process_tree_up(self, seen=set([])):
-        a = []
-        seen = set(seen)
-
-        for proc in self.after_process.all().order_by('-process__when'):
-            if proc in seen:
-                continue
-
-            if proc.in_group:
-                if proc.process not in a:
-                    a.append(proc.process)
-                a.extend(proc.in_group.process_tree_up(seen))
-            if proc.in_artifact:
-                if proc.process not in a:
-                    a.append(proc.process)
-                a.extend(proc.in_artifact.process_tree_up(seen))
-            seen.add(proc)
-        return reversed(a)
+        return self.process_tree_up()
+    def process_tree_up(self):
+        # Walked breadth-first by majora2.lineage, in O(depth) queries
+        from . import lineage
+        return lineage.process_tree(self)
     @property
     def process_leaf(self):
         a = []
@@ -100,95 +105,32 @@ class MajoraArtifact(PolymorphicModel):
 
     @property
     def process_tree_down(self):
-        return self.build_process_tree_down(set([self]), set([self]))
-    def build_process_tree_down(self, seen, crossed_bridges):
-        a = []
-        add = 0
-
-        # Detect whether we can cross any bridges
-        current_bridges = set([])
-        for proc in self.before_process.all().order_by('-process__when'):
-            if proc.out_artifact and proc.bridge_artifact:
-                current_bridges.add(proc.bridge_artifact)
-        can_cross = False
-        for b in current_bridges:
-            if b in crossed_bridges:
-                can_cross = True
-
-        # Go through each process record attached to this artifact
-        for proc in self.before_process.all().order_by('-process__when'):
-            add = 0
-            children = []
-            if proc.out_artifact:
-                # If this record produces an artifact to share...
-                if proc.out_artifact not in seen:
-                    # ...and we have not already added this artifact to the process tree
-                    if (proc.bridge_artifact is None) or (proc.bridge_artifact in crossed_bridges) or not can_cross:
-                        # ...and this artifact is not the other side of a bridge that should not be crossed
-                        #children.append(proc)
-                        children.extend( proc.out_artifact.build_process_tree_down(seen=seen, crossed_bridges=crossed_bridges) )
-                        #seen.add(proc.out_artifact)
-                        add = 1
-
-            # Delve one group deep
-            child_ = {}
-            c_add = 0
-            if proc.out_group and proc.out_group not in seen:
-                #child_[d_proc] = child_proc.out_group.build_process_tree_down(seen=seen, crossed_bridges=crossed_bridges)
-                children.extend( proc.out_group.build_process_tree_down(seen=seen, crossed_bridges=crossed_bridges) )
-                add = 1
-                seen.add(proc.out_group)
-                #if proc.out_group not in seen:
-                #    if proc.bridge_group is None or proc.bridge_group in seen:
-                #        for child_proc in proc.out_group.before_process.all().order_by('-process__when'):
-                #            child_[child_proc] = child_proc.out_artifact.build_process_tree_down(seen=seen, crossed_bridges=crossed_bridges)
-                #            c_add = 1
-                #        seen.add(proc.out_group)
-
-            if c_add:
-                a.append({proc: [children, child_]})
-            elif add:
-                a.append({proc: children})
-        return a
+        # Fetched in one query and rebuilt by majora2.lineage
+        from . import lineage
+        return lineage.process_tree_down(self)
 
     @property
     def is_quarantined(self):
         if self.quarantined:
             return self
-        else:
-            if self.root_artifact:
-                if self.root_artifact.quarantined:
-                    return self.root_artifact
-            else:
-                for process in self.process_tree:
-                    if process.in_artifact and process.in_artifact != self:
-                        if process.in_artifact.quarantined:
-                            return process.in_artifact
-                    if process.out_artifact and process.out_artifact != self:
-                        if process.out_artifact.quarantined:
-                            return process.out_artifact
+        if self.effective_quarantine_source_id:
+            return self.effective_quarantine_source
         return False
     @property
     def quarantined_reason(self):
-        if self.is_quarantined:
+        source = self.is_quarantined
+        if source:
             try:
-                return MajoraArtifactProcessRecord.objects.filter(Q(in_artifact=self.is_quarantined, instance_of=MajoraArtifactQuarantinedProcessRecord)).order_by("-process__when").last().note
+                return MajoraArtifactProcessRecord.objects.filter(Q(in_artifact=source, instance_of=MajoraArtifactQuarantinedProcessRecord)).order_by("-process__when").last().note
             except:
                 return "Unknown"
         else:
             return ""
     @property
     def artifact_tree(self):
-        a = []
-        for proc in self.process_leaf:
-            if proc.out_artifact:
-                if proc.out_artifact not in a:
-                    a.append(proc.out_artifact)
-        for proc in self.process_tree:
-            if proc.in_artifact:
-                if proc.in_artifact not in a:
-                    a.append(proc.in_artifact)
-        return a
+        # Farthest descendant to nearest, then nearest ancestor to farthest
+        from . import lineage
+        return lineage.connected_artifacts(self)
 
     @classmethod
     def sorto(cls, a):
@@ -201,10 +143,10 @@ class MajoraArtifact(PolymorphicModel):
     def siblings(self):
         #Return tubes that had the same input to their last process
         if self.modified and self.modified.in_artifact:
-            return [x.out_artifact for x in MajoraArtifactProcessRecord.objects.filter(in_artifact=self.modified.in_artifact) if x.out_artifact and x.out_artifact.id != self.id]
+            return [x.out_artifact for x in MajoraArtifactProcessRecord.objects.non_polymorphic().filter(in_artifact=self.modified.in_artifact).resolve_related('out_artifact') if x.out_artifact and x.out_artifact.id != self.id]
     @property
     def children(self):
-        return [x.out_artifact for x in MajoraArtifactProcessRecord.objects.filter(in_artifact=self) if x.out_artifact and x.out_artifact.id != self.id]
+        return [x.out_artifact for x in MajoraArtifactProcessRecord.objects.non_polymorphic().filter(in_artifact=self).resolve_related('out_artifact') if x.out_artifact and x.out_artifact.id != self.id]
     @property
     def observed(self):
         try:
@@ -312,15 +254,36 @@ class MajoraArtifactGroupLink(models.Model):
     to_group = models.ForeignKey('MajoraArtifactGroup', blank=True, null=True, on_delete=models.PROTECT, related_name="in_glinks")
     to_artifact = models.ForeignKey('MajoraArtifact', blank=True, null=True, on_delete=models.PROTECT, related_name="in_glinks")
 
+def hash_group_path(group_path):
+    # group_path is too long to index well on its own, so MAGs are found by the hash of their path
+    if group_path is None:
+        return None
+    return hashlib.sha256(group_path.encode()).hexdigest()
+
+# Subtrees are listed by the leading characters of group_path, which are short enough to index
+# alongside root_group on every backend, where the whole path is not
+GROUP_PATH_PREFIX_LENGTH = 255
+
+def prefix_group_path(group_path):
+    if group_path is None:
+        return None
+    return group_path[:GROUP_PATH_PREFIX_LENGTH]
+
 # TODO This will become the MajoraGroup
 class MajoraArtifactGroup(PolymorphicModel):
+    objects = MajoraPolymorphicManager()
+
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False) #
     unique_name = models.CharField(max_length=128, blank=True, null=True, unique=True) #TODO graduate away from meta_name, needs to be project unique rather than global, but it will work here
 
     dice_name = models.CharField(max_length=96, blank=True, null=True, unique=True)
     meta_name = models.CharField(max_length=96, blank=True, null=True) # TODO force unique?
 
-    group_path = models.CharField(max_length=1024, blank=True, null=True, unique=True)
+    # The "/" joined path of a MAG below its root_group, its hash, which is unique under each root,
+    # and its indexed prefix. Kept in step by save, and backfilled for older groups by the backfill_mag_paths command
+    group_path = models.CharField(max_length=1024, blank=True, null=True)
+    group_path_hash = models.CharField(max_length=64, blank=True, null=True, editable=False)
+    group_path_prefix = models.CharField(max_length=GROUP_PATH_PREFIX_LENGTH, blank=True, null=True, editable=False)
     temp_kind = models.CharField(max_length=48, blank=True, null=True)
 
     root_group = models.ForeignKey('MajoraArtifactGroup', blank=True, null=True, on_delete=models.PROTECT, related_name="descendants")
@@ -332,14 +295,33 @@ class MajoraArtifactGroup(PolymorphicModel):
     #links = models.ManyToManyField('MajoraArtifactGroupLink', related_name="from_groups", blank=True)
     history = GenericRelation("tatl.TatlVerb")
 
+    class Meta(PolymorphicModel.Meta):
+        constraints = [
+            models.UniqueConstraint(fields=["root_group", "group_path_hash"], name="unique_group_path_per_root"),
+        ]
+        indexes = [
+            # Pattern ops let Postgres range scan the prefix, other backends ignore them
+            models.Index(fields=["root_group", "group_path_prefix", "id"], name="majora2_mag_root_prefix_idx", opclasses=["uuid_ops", "varchar_pattern_ops", "uuid_ops"]),
+        ]
+
     def __str__(self):
         return "%s (%s)" % (self.name, self.id)
 
+    def save(self, *args, **kwargs):
+        self.group_path_hash = hash_group_path(self.group_path)
+        self.group_path_prefix = prefix_group_path(self.group_path)
+        update_fields = kwargs.get("update_fields")
+        if update_fields is not None and "group_path" in update_fields:
+            kwargs["update_fields"] = set(update_fields) | set(["group_path_hash", "group_path_prefix"])
+        super().save(*args, **kwargs)
+
     def nuke_tree(self):
+        from . import util
         self.groups.clear()
         for g in self.children.all():
             g.nuke_tree()
         self.delete()
+        util.invalidate_mag_cache()
     @property
     def group_kind(self):
         return 'Artifact Group'
@@ -397,77 +379,16 @@ class MajoraArtifactGroup(PolymorphicModel):
 
     @property
     def process_tree_down(self):
-        return self.build_process_tree_down(set([self]), set([self]))
-    def build_process_tree_down(self, seen, crossed_bridges):
-        a = []
-        add = 0
-
-        # Detect whether we can cross any bridges
-        current_bridges = set([])
-        for proc in self.before_process.all().order_by('-process__when'):
-            if proc.out_artifact and proc.bridge_artifact:
-                current_bridges.add(proc.bridge_artifact)
-        can_cross = False
-        for b in current_bridges:
-            if b in crossed_bridges:
-                can_cross = True
-
-        # Go through each process record attached to this artifact
-        for proc in self.before_process.all().order_by('-process__when'):
-            add = 0
-            children = []
-            if proc.out_artifact:
-                # If this record produces an artifact to share...
-                if proc.out_artifact not in seen:
-                    # ...and we have not already added this artifact to the process tree
-                    if (proc.bridge_artifact is None) or (proc.bridge_artifact in crossed_bridges) or not can_cross:
-                        # ...and this artifact is not the other side of a bridge that should not be crossed
-                        #children.append(proc)
-                        children.extend( proc.out_artifact.build_process_tree_down(seen=seen, crossed_bridges=crossed_bridges) )
-                        seen.add(proc.out_artifact)
-                        add = 1
-
-            # Delve one group deep
-            child_ = {}
-            c_add = 0
-            if proc.out_group:
-                #child_[d_proc] = child_proc.out_group.build_process_tree_down(seen=seen, crossed_bridges=crossed_bridges)
-                children.extend( proc.out_group.build_process_tree_down(seen=seen, crossed_bridges=crossed_bridges) )
-                add = 1
-                seen.add(proc.out_group)
-                #if proc.out_group not in seen:
-                #    if proc.bridge_group is None or proc.bridge_group in seen:
-                #        for child_proc in proc.out_group.before_process.all().order_by('-process__when'):
-                #            child_[child_proc] = child_proc.out_artifact.build_process_tree_down(seen=seen, crossed_bridges=crossed_bridges)
-                #            c_add = 1
-                #        seen.add(proc.out_group)
-
-            if c_add:
-                a.append({proc: [children, child_]})
-            elif add:
-                a.append({proc: children})
-        return a
+        # Fetched in one query and rebuilt by majora2.lineage
+        from . import lineage
+        return lineage.process_tree_down(self)
     @property
     def process_tree(self):
-        return self.process_tree_up([])
-    def process_tree_up(self, seen=set([])):
-        a = []
-        seen = set(seen)
-
-        for proc in self.after_process.all().order_by('-process__when'):
-            if proc in seen:
-                continue
-
-            if proc.in_group:
-                if proc.process not in a:
-                    a.append(proc.process)
-                a.extend(proc.in_group.process_tree_up(seen))
-            if proc.in_artifact:
-                if proc.process not in a:
-                    a.append(proc.process)
-                a.extend(proc.in_artifact.process_tree_up(seen))
-            seen.add(proc)
-        return reversed(a)
+        return self.process_tree_up()
+    def process_tree_up(self):
+        # Walked breadth-first by majora2.lineage, in O(depth) queries
+        from . import lineage
+        return lineage.process_tree(self)
 
 
 class PublishedArtifactGroup(MajoraArtifactGroup):
@@ -581,6 +502,15 @@ class TemporaryAccessionRecord(models.Model):
             "primary_accession": self.primary_accession,
         }
 
+# Materialised PAG export, holding the task_get_pag_v2 JSON line for a PAG so exports
+# do not need to re-join everything. Writes that touch a PAG flag it as stale and it
+# is rebuilt at the next export (or by the rebuild_pag_exports command)
+class PAGExportDocument(models.Model):
+    pag = models.OneToOneField('PublishedArtifactGroup', on_delete=models.CASCADE, primary_key=True, related_name="export_document")
+    document = models.TextField(blank=True, null=True)
+    is_stale = models.BooleanField(default=True, db_index=True)
+    last_built = models.DateTimeField(blank=True, null=True)
+
 
 class PAGQualityTestEquivalenceGroup(models.Model):
     slug = models.SlugField(max_length=64, blank=True, null=True)
@@ -699,6 +629,8 @@ class PAGQualityReportDecisionRecord(models.Model):
 
 # Until Artifacts become less generic in Majora3, we have to encode properties about them somewhere
 class TemporaryMajoraArtifactMetric(PolymorphicModel):
+    objects = MajoraPolymorphicManager()
+
     artifact = models.ForeignKey('MajoraArtifact', on_delete=models.CASCADE, related_name="metrics")
     namespace = models.CharField(max_length=64, blank=True, null=True)
 
@@ -855,6 +787,58 @@ class TemporaryMajoraArtifactMetric_Dehum(TemporaryMajoraArtifactMetric):
     def metric_kind(self):
         return 'Dehumanisation'
 
+# Wide copy of every TemporaryMajoraArtifactMetric of an artifact, one row per artifact with a
+# column per metric field, so exports and QC can read the metrics of many artifacts in one scan
+# The metric models remain the source of truth and write through to it, see majora2.metric_store
+# Only the first metric of each kind is copied, the *_n_metrics columns count how many the artifact has
+class MajoraArtifactMetricStore(models.Model):
+    artifact = models.OneToOneField('MajoraArtifact', on_delete=models.CASCADE, primary_key=True, related_name="metric_store")
+
+    sequence_n_metrics = models.PositiveSmallIntegerField(default=0)
+    sequence_num_seqs = models.PositiveIntegerField(blank=True, null=True)
+    sequence_num_bases = models.PositiveIntegerField(blank=True, null=True)
+    sequence_pc_acgt = models.FloatField(blank=True, null=True)
+    sequence_pc_masked = models.FloatField(blank=True, null=True)
+    sequence_pc_invalid = models.FloatField(blank=True, null=True)
+    sequence_longest_gap = models.PositiveIntegerField(blank=True, null=True)
+    sequence_longest_ungap = models.PositiveIntegerField(blank=True, null=True)
+
+    mapping_n_metrics = models.PositiveSmallIntegerField(default=0)
+    mapping_num_pos = models.PositiveIntegerField(blank=True, null=True)
+    mapping_num_maps = models.PositiveIntegerField(blank=True, null=True)
+    mapping_num_unmaps = models.PositiveIntegerField(blank=True, null=True)
+    mapping_median_cov = models.FloatField(blank=True, null=True)
+    mapping_mean_cov = models.FloatField(blank=True, null=True)
+    mapping_pc_pos_cov_gte1 = models.FloatField(blank=True, null=True)
+    mapping_pc_pos_cov_gte5 = models.FloatField(blank=True, null=True)
+    mapping_pc_pos_cov_gte10 = models.FloatField(blank=True, null=True)
+    mapping_pc_pos_cov_gte20 = models.FloatField(blank=True, null=True)
+    mapping_pc_pos_cov_gte50 = models.FloatField(blank=True, null=True)
+    mapping_pc_pos_cov_gte100 = models.FloatField(blank=True, null=True)
+    mapping_pc_pos_cov_gte200 = models.FloatField(blank=True, null=True)
+
+    tiles_n_metrics = models.PositiveSmallIntegerField(default=0)
+    tiles_n_tiles = models.PositiveSmallIntegerField(blank=True, null=True)
+    tiles_pc_tiles_medcov_gte1 = models.FloatField(blank=True, null=True)
+    tiles_pc_tiles_medcov_gte5 = models.FloatField(blank=True, null=True)
+    tiles_pc_tiles_medcov_gte10 = models.FloatField(blank=True, null=True)
+    tiles_pc_tiles_medcov_gte20 = models.FloatField(blank=True, null=True)
+    tiles_pc_tiles_medcov_gte50 = models.FloatField(blank=True, null=True)
+    tiles_pc_tiles_medcov_gte100 = models.FloatField(blank=True, null=True)
+    tiles_pc_tiles_medcov_gte200 = models.FloatField(blank=True, null=True)
+
+    ct_n_metrics = models.PositiveSmallIntegerField(default=0)
+    ct_num_tests = models.PositiveIntegerField(blank=True, null=True)
+    ct_min_ct = models.FloatField(blank=True, null=True)
+    ct_max_ct = models.FloatField(blank=True, null=True)
+
+    dehum_n_metrics = models.PositiveSmallIntegerField(default=0)
+    dehum_total_dropped = models.PositiveIntegerField(blank=True, null=True)
+    dehum_n_hits = models.PositiveIntegerField(blank=True, null=True)
+    dehum_n_clipped = models.PositiveIntegerField(blank=True, null=True)
+    dehum_n_known = models.PositiveIntegerField(blank=True, null=True)
+    dehum_n_collateral = models.PositiveIntegerField(blank=True, null=True)
+
 
 class DigitalResourceNode(MajoraArtifactGroup):
     node_name = models.CharField(max_length=128)
@@ -889,6 +873,18 @@ class DigitalResourceGroup(MajoraArtifactGroup):
     @property
     def path(self):
         return "/".join([g.current_name for g in self.hierarchy])
+    @property
+    def hierarchy(self):
+        # Fetch the node and every directory above this one by their path hashes at once,
+        # rather than following parent_group a level at a time
+        if self.group_path is None or not self.root_group_id:
+            return super().hierarchy
+        lpath = self.group_path.split("/")
+        prefixes = ["/".join(lpath[:i+1]) for i in range(len(lpath) - 1)]
+        groups = {g.group_path: g for g in DigitalResourceGroup.objects.filter(root_group_id=self.root_group_id, group_path_hash__in=[hash_group_path(x) for x in prefixes])} if len(prefixes) > 0 else {}
+        if len(groups) != len(prefixes):
+            return super().hierarchy
+        return [self.root_group] + [groups[x] for x in prefixes] + [self]
 
 
 
@@ -1240,6 +1236,8 @@ class BiosampleSource(MajoraArtifactGroup):
         }
 
 class MajoraArtifactProcessRecord(PolymorphicModel):
+    objects = MajoraPolymorphicManager()
+
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False) #
     process = models.ForeignKey('MajoraArtifactProcess', on_delete=models.CASCADE, related_name="records")
 
@@ -1259,7 +1257,23 @@ class MajoraArtifactProcessRecord(PolymorphicModel):
     #   so we dont have to roll this out throughout majora unless needed (eg. future race conditions)
     unique_name = models.CharField(max_length=256, null=True, unique=True)
 
+# Transitive closure of the process record graph, one row for each artifact or group
+# below another, and each process that first leads away from the ancestor towards it
+# Maintained by majora2.receivers as records are saved, see lineage.add_closure_edge
+class MajoraArtifactClosure(models.Model):
+    ancestor_artifact = models.ForeignKey('MajoraArtifact', blank=True, null=True, on_delete=models.CASCADE, related_name="closure_descendants")
+    ancestor_group = models.ForeignKey('MajoraArtifactGroup', blank=True, null=True, on_delete=models.CASCADE, related_name="closure_descendants")
+    descendant_artifact = models.ForeignKey('MajoraArtifact', blank=True, null=True, on_delete=models.CASCADE, related_name="closure_ancestors")
+    descendant_group = models.ForeignKey('MajoraArtifactGroup', blank=True, null=True, on_delete=models.CASCADE, related_name="closure_ancestors")
+    depth = models.PositiveIntegerField()
+    via_process = models.ForeignKey('MajoraArtifactProcess', on_delete=models.CASCADE, related_name="closure_paths")
+
+    # The bridge_artifact of the first bridged record on the path, if any
+    bridge_artifact = models.ForeignKey('MajoraArtifact', blank=True, null=True, on_delete=models.CASCADE, related_name="closure_bridges")
+
 class MajoraArtifactProcess(PolymorphicModel):
+    objects = MajoraPolymorphicManager()
+
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False) #
     when = models.DateTimeField(blank=True, null=True)
     #when_time_valid = models.BooleanField()
@@ -1305,7 +1319,7 @@ class MajoraArtifactProcess(PolymorphicModel):
     @property
     def ordered_artifacts(self):
         ret = {}
-        for record in self.records.all().prefetch_related('in_artifact'):
+        for record in self.records.non_polymorphic().resolve_related('in_artifact__created', 'in_group'):
             if record.in_group:
                 if record.in_group.kind not in ret:
                     ret[record.in_group.kind] = set([])
@@ -1750,6 +1764,8 @@ class ProfileAPIKey(models.Model):
 #TODO How to properly link models?
 #TODO MajoraCoreObject could be inherited by artifact, group etc.
 class MajoraMetaRecord(PolymorphicModel):
+    objects = MajoraPolymorphicManager()
+
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
 
     artifact = models.ForeignKey('MajoraArtifact', blank=True, null=True, on_delete=models.CASCADE, related_name="metadata")
@@ -78,6 +78,7 @@ def list_accessions(request):
 
 
 def view_facts(request):
+    util.flush_facts() # include counts still held by this process
     qs = models.MajoraFact.objects.filter(restricted=False).values("namespace", "key", "value_type", "value", "counter", "timestamp")
     qs_json = json.dumps(list(qs), default=str) # use default to co-erce ts
     return HttpResponse(qs_json, content_type="application/json")
@@ -86,7 +87,7 @@ def view_facts(request):
 @cache_page(60 * 90)
 def render_architect(request):
     try:
-        util.create_or_increment_fact(namespace="tatl", key="cached_architects")
+        util.buffer_fact(namespace="tatl", key="cached_architects")
     except:
         pass
     return HttpResponse('<img src="data:image/png;base64,%s" />' % public_util.select_egg())
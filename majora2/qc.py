@@ -0,0 +1,458 @@
+from django.db import transaction
+from django.utils import timezone
+
+from . import metric_store
+from . import models
+from . import util
+
+# Compiled QC plans
+# A plan holds everything add_qc needs to evaluate a PAG against a PAGQualityTestEquivalenceGroup:
+# the latest version of each of its tests, with their filters, rules (with their thresholds) and
+# decisions, fetched with a fixed handful of queries. Plans are cached by each process and stamped
+# with a generation, kept in the qc.plan_generation fact and bumped whenever a QC definition changes
+# (see majora2.receivers), so evaluating a PAG costs one fact lookup rather than the QC definition queries
+
+# Passing PAGs of this test group are counted by the pag.minimal_qc_pass fact
+MINIMAL_QC_SLUG = "cog-uk-elan-minimal-qc"
+
+class QCTestPlan(object):
+    def __init__(self, test, version, filters, rules, decisions):
+        self.test = test
+        self.version = version
+        self.filters = filters
+        self.rules = rules
+        self.decisions = decisions
+
+        # Thresholds that are unset (or zero) are not checked, as they never have been
+        self.thresholds = {
+            rule.pk: (rule.warn_min or None, rule.warn_max or None, rule.fail_min or None, rule.fail_max or None)
+            for rule in rules
+        }
+
+class QCPlan(object):
+    def __init__(self, test_group, tests):
+        self.test_group = test_group
+        self.tests = tests
+
+    def evaluate(self, metrics, metadata, api_o):
+        # Evaluate a PAG's metrics and metadata (see gather_inputs) against this plan
+        # Returns the results of each test version, the number of failed decisions and whether every
+        # test was skipped, or None if the PAG cannot be QC'd, with the reasons added to api_o
+        return self.evaluate_batch([(metrics, metadata)], [api_o])[0]
+
+    def evaluate_batch(self, rows, api_os):
+        # Evaluate a batch of PAGs, rows are (metrics, metadata) and api_os collect the messages of each
+        # This is plain Python and does the same work per PAG as evaluating them one by one, the
+        # rules and decisions are just walked once per batch rather than once per PAG. What makes a
+        # batch cheaper is loading its inputs (gather_inputs) and writing its reports (save_reports)
+        # with a fixed number of queries, not this loop
+        n = len(rows)
+        failed = [False] * n
+        n_fails = [0] * n
+        all_skipped = [True] * n # flag to determine at least one QC test was run
+        test_data = [{} for i in range(n)]
+
+        for test_plan in self.tests:
+            tv = test_plan.version
+
+            active = []
+            for i, (metrics, metadata) in enumerate(rows):
+                if failed[i]:
+                    continue
+                test_data[i][tv] = {
+                    "results": {},
+                    "decisions": {},
+                    "is_pass": None,
+                    "is_skip": None,
+                }
+                is_skip = self._is_skip(test_plan, metadata, api_os[i])
+                if is_skip is None:
+                    failed[i] = True
+                elif is_skip:
+                    test_data[i][tv]["is_skip"] = True
+                    test_data[i][tv]["is_pass"] = False
+                else:
+                    all_skipped[i] = False
+                    test_data[i][tv]["is_skip"] = False
+                    active.append(i)
+
+            for rule in test_plan.rules:
+                column = []
+                for i in active:
+                    metrics = rows[i][0]
+                    api_o = api_os[i]
+                    # Determine if the test can be performed
+                    if rule.metric_namespace not in metrics:
+                        api_o["messages"].append("Namespace %s not found in metrics" % rule.metric_namespace)
+                        api_o["ignored"].append(rule.metric_namespace)
+                        api_o["errors"] += 1
+                        continue
+                    if rule.metric_name not in metrics[rule.metric_namespace] or metrics[rule.metric_namespace][rule.metric_name] is None:
+                        api_o["messages"].append("Metric %s.%s not found in metrics" % (rule.metric_namespace, rule.metric_name))
+                        api_o["ignored"].append(rule.metric_name)
+                        api_o["errors"] += 1
+                        continue
+                    column.append((i, metrics[rule.metric_namespace][rule.metric_name]))
+
+                thresholds = test_plan.thresholds[rule.pk]
+                for (i, value), (is_warn, is_fail) in zip(column, [check_thresholds(value, *thresholds) for i, value in column]):
+                    test_data[i][tv]["results"][rule] = {
+                        "rule": rule,
+                        "test_metric_str": str(value),
+                        "is_pass": not is_fail,
+                        "is_warn": is_warn,
+                        "is_fail": is_fail,
+                    }
+
+            #TODO What if the same rule is checked many times? (It should not be anyway but...)
+            assessed = []
+            for i in active:
+                if len(test_data[i][tv]["results"]) != len(test_plan.rules):
+                    api_os[i]["messages"].append("Refusing to create QC report as not all target metrics could be assessed...")
+                    api_os[i]["metrics"] = rows[i][0]
+                    api_os[i]["errors"] += 1
+                    failed[i] = True
+                else:
+                    assessed.append(i)
+
+            curr_test_fails = {i: 0 for i in assessed}
+            for decision in test_plan.decisions:
+                column = []
+                for i in assessed:
+                    if failed[i]:
+                        continue
+                    results = test_data[i][tv]["results"]
+                    if decision.a not in results or (decision.b and decision.b not in results):
+                        api_os[i]["messages"].append("Could not make a decision for rule as metric appears to have not been selecting for testing")
+                        api_os[i]["errors"] += 1
+                        failed[i] = True
+                    elif decision.b and decision.op not in ["AND", "OR"]:
+                        api_os[i]["messages"].append("Unknown decision operator encountered")
+                        api_os[i]["errors"] += 1
+                        failed[i] = True
+                    else:
+                        column.append((i, results[decision.a], results[decision.b] if decision.b else None))
+
+                op = decision.op if decision.b else None
+                decided = [decide(op, a["is_warn"], a["is_fail"], b["is_warn"] if b else None, b["is_fail"] if b else None) for i, a, b in column]
+                for (i, a, b), (is_warn, is_fail) in zip(column, decided):
+                    if is_fail:
+                        n_fails[i] += 1
+                        curr_test_fails[i] += 1
+                    test_data[i][tv]["decisions"][decision] = {
+                        "decision": decision,
+                        "a": decision.a,
+                        "b": decision.b,
+                        "is_pass": not is_fail,
+                        "is_warn": is_warn,
+                        "is_fail": is_fail,
+                    }
+            for i in assessed:
+                test_data[i][tv]["is_pass"] = curr_test_fails[i] == 0
+
+        return [None if failed[i] else (test_data[i], n_fails[i], all_skipped[i]) for i in range(n)]
+
+    def _is_skip(self, test_plan, metadata, api_o):
+        # Whether the filters of a test skip this PAG, or None if it is missing metadata a filter needs
+        is_match = False
+        is_skip = False
+        for tfilter in test_plan.filters:
+            meta = metadata.get(tfilter.metadata_namespace, {}).get(tfilter.metadata_name, None)
+            if meta:
+                meta = str(meta).upper()
+                if tfilter.op == "EQ":
+                    is_match = meta == tfilter.filter_on_str
+                elif tfilter.op == "NEQ":
+                    is_match = meta != tfilter.filter_on_str
+                else:
+                    pass
+                is_skip = not is_match
+            else:
+                if tfilter.force_field:
+                    api_o["messages"].append("Cannot automatically QC a PAG that is missing required metadata (%s.%s)" % (tfilter.metadata_namespace, tfilter.metadata_name))
+                    api_o["errors"] += 1
+                    return None
+        return is_skip
+
+def check_thresholds(value, warn_min, warn_max, fail_min, fail_max):
+    # Returns whether value warns and fails against a rule's thresholds
+    # A value warns (or fails) below the min, or at or above the max, and is clear if neither is set
+    is_warn = (warn_min is not None and value < warn_min) or (warn_max is not None and value >= warn_max)
+    is_fail = (fail_min is not None and value < fail_min) or (fail_max is not None and value >= fail_max)
+    return is_warn, is_fail
+
+def decide(op, a_warn, a_fail, b_warn=None, b_fail=None):
+    # Combine the results of a decision's rules, a decision without an op just takes a's result
+    # NOTE Warnings only roll up from a, which is how decisions have always been recorded
+    if op == "AND":
+        return a_warn, a_fail and b_fail
+    elif op == "OR":
+        return a_warn, a_fail or b_fail
+    return a_warn, a_fail
+
+def compile_plan(test_group):
+    # Fetch the latest version of every test in test_group with its filters, rules and decisions
+    tests = list(models.PAGQualityTest.objects.filter(group=test_group).order_by('id'))
+    test_ids = [test.id for test in tests]
+
+    latest = {}
+    for tv in models.PAGQualityTestVersion.objects.filter(test_id__in=test_ids).order_by('test_id', '-version_number', 'id'):
+        if tv.test_id not in latest:
+            latest[tv.test_id] = tv
+    filters = {}
+    for tfilter in models.PAGQualityTestFilter.objects.filter(test_id__in=test_ids).order_by('id'):
+        filters.setdefault(tfilter.test_id, []).append(tfilter)
+    rules = {}
+    rules_by_id = {}
+    for rule in models.PAGQualityTestRule.objects.filter(test__in=latest.values()).order_by('id'):
+        rules.setdefault(rule.test_id, []).append(rule)
+        rules_by_id[rule.id] = rule
+    decisions = {}
+    for decision in models.PAGQualityBasicTestDecision.objects.filter(test__in=latest.values()).order_by('id'):
+        # Share the rule instances, so the decisions can be matched to the rule results by identity
+        decision.a = rules_by_id.get(decision.a_id) or decision.a
+        if decision.b_id:
+            decision.b = rules_by_id.get(decision.b_id) or decision.b
+        decisions.setdefault(decision.test_id, []).append(decision)
+
+    test_plans = []
+    for test in tests:
+        tv = latest.get(test.id)
+        if tv is None:
+            continue
+        tv.test = test
+        test_plans.append(QCTestPlan(test, tv, filters.get(test.id, []), rules.get(tv.id, []), decisions.get(tv.id, [])))
+    return QCPlan(test_group, test_plans)
+
+# Plans are shared by every request the process serves, so treat them as read only
+_plan_cache = util.LocalLRUCache("MAJORA_QC_PLAN_CACHE_SIZE", "MAJORA_QC_PLAN_CACHE_TTL", default_size=100, default_ttl=3600)
+
+def get_plan(slug):
+    # Returns the compiled plan of the PAGQualityTestEquivalenceGroup with this slug, or None
+    # A plan compiled against older QC definitions is never used once the change commits
+    gen = util.get_generation("qc", "plan_generation")
+    entry = _plan_cache.get(slug)
+    if entry is not None and entry[0] == gen:
+        return entry[1]
+
+    test_group = models.PAGQualityTestEquivalenceGroup.objects.filter(slug=slug).first()
+    if not test_group:
+        return None
+    plan = compile_plan(test_group)
+    util._cache_on_commit(_plan_cache, slug, (gen, plan))
+    return plan
+
+def invalidate_plans():
+    # Drop the compiled plans of this process, and bump the generation so every other process drops theirs
+    # Called inside the transaction that changes a definition, the bump commits (or rolls back) with it
+    _plan_cache.clear()
+    util.bump_generation("qc", "plan_generation")
+
+def gather_inputs(pag_ids):
+    # Gather the metrics and metadata of the artifacts tagged by each PAG, as add_qc evaluates them,
+    # with a fixed number of queries however many PAGs there are. Returns a dict of each PAG's id to its
+    # (metrics, metadata, message), message says why the PAG cannot be QC'd, or is None
+    pag_artifacts = {pag_id: [] for pag_id in pag_ids}
+    through = models.MajoraArtifact.groups.through
+    for artifact_id, pag_id in through.objects.filter(majoraartifactgroup_id__in=pag_ids).values_list('majoraartifact_id', 'majoraartifactgroup_id'):
+        pag_artifacts[pag_id].append(artifact_id)
+    artifact_ids = set([artifact_id for artifact_ids in pag_artifacts.values() for artifact_id in artifact_ids])
+
+    # Metrics come from the columnar store, one row per artifact
+    metrics = metric_store.get_structs(artifact_ids)
+    metadata = {}
+    if len(artifact_ids) > 0:
+        for artifact_id, meta_tag, meta_name, value in models.MajoraMetaRecord.objects.non_polymorphic().filter(artifact_id__in=artifact_ids, restricted=False).values_list('artifact_id', 'meta_tag', 'meta_name', 'value'):
+            metadata.setdefault(artifact_id, {}).setdefault(meta_tag, {})[meta_name] = value
+
+    inputs = {}
+    for pag_id, artifact_ids in pag_artifacts.items():
+        pag_metrics = {}
+        pag_metadata = {}
+        message = None
+        for artifact_id in artifact_ids:
+            # For this project we don't need to worry about duplicates
+            # but this is an outstanding problem... TODO
+            for namespace, (struct, n_metrics) in metrics.get(artifact_id, {}).items():
+                if namespace not in pag_metrics and n_metrics == 1:
+                    pag_metrics[namespace] = struct
+                else:
+                    message = "Cannot automatically QC a PAG with multiple objects containing the same metric type..."
+        if message is None:
+            for artifact_id in artifact_ids:
+                curr_meta = metadata.get(artifact_id, {})
+                for namespace in curr_meta:
+                    if namespace not in pag_metadata:
+                        pag_metadata[namespace] = {}
+                    for meta_name in curr_meta[namespace]:
+                        if meta_name not in pag_metadata[namespace]:
+                            pag_metadata[namespace][meta_name] = curr_meta[namespace][meta_name]
+                        elif pag_metadata[namespace][meta_name] != curr_meta[namespace][meta_name]:
+                            message = "Cannot automatically QC a PAG with multiple objects containing the same metadata fields with different values..."
+        inputs[pag_id] = (pag_metrics, pag_metadata, message)
+    return inputs
+
+def save_reports(plan, evaluated, now=None, count_flips=False):
+    # Write the reports of many PAGs evaluated against plan, evaluated is a list of (pag_id, test_data, n_fails)
+    # Every row is built in memory and inserted with bulk_create, a fixed number of queries for the lot,
+    # and the PAGs' report groups are updated in place. Callers must hold a transaction around this.
+    # With count_flips, the minimal_qc_pass fact only moves by the PAGs that flipped, rather than every pass
+    # Returns a dict of each PAG's id to whether it passed before (None if it had not been QC'd)
+    if now is None:
+        now = timezone.now()
+    pag_ids = [pag_id for pag_id, test_data, n_fails in evaluated]
+    if len(pag_ids) == 0:
+        return {}
+
+    # Lock the PAGs' report groups, so concurrent QC of the same PAG is applied one after the other
+    ereport_gs = {}
+    for ereport_g in models.PAGQualityReportEquivalenceGroup.objects.select_for_update().filter(pag_id__in=pag_ids, test_group=plan.test_group).order_by('id'):
+        ereport_gs.setdefault(ereport_g.pag_id, ereport_g)
+    was_pass = {pag_id: ereport_gs[pag_id].is_pass if pag_id in ereport_gs else None for pag_id in pag_ids}
+
+    new_ereport_gs = [models.PAGQualityReportEquivalenceGroup(pag_id=pag_id, test_group=plan.test_group) for pag_id in pag_ids if pag_id not in ereport_gs]
+    models.PAGQualityReportEquivalenceGroup.objects.bulk_create(new_ereport_gs)
+    if len(new_ereport_gs) > 0:
+        # bulk_create does not return primary keys on every backend, so fetch them back
+        for ereport_g in models.PAGQualityReportEquivalenceGroup.objects.filter(pag_id__in=[g.pag_id for g in new_ereport_gs], test_group=plan.test_group):
+            ereport_gs[ereport_g.pag_id] = ereport_g
+    for pag_id, test_data, n_fails in evaluated:
+        ereport_gs[pag_id].is_pass = n_fails == 0
+        ereport_gs[pag_id].last_updated = now
+    models.PAGQualityReportEquivalenceGroup.objects.bulk_update([ereport_gs[pag_id] for pag_id in pag_ids], ['is_pass', 'last_updated'])
+
+    # One report group per PAG and test
+    group_ids = [ereport_gs[pag_id].id for pag_id in pag_ids]
+    report_gs = {}
+    for report_g in models.PAGQualityReportGroup.objects.filter(group_id__in=group_ids).order_by('id'):
+        report_gs.setdefault((report_g.group_id, report_g.test_set_id), report_g)
+    new_report_gs = []
+    old_report_gs = []
+    for pag_id, test_data, n_fails in evaluated:
+        for tv in test_data:
+            key = (ereport_gs[pag_id].id, tv.test_id)
+            if key not in report_gs:
+                report_gs[key] = models.PAGQualityReportGroup(pag_id=pag_id, group_id=key[0], test_set_id=key[1])
+                new_report_gs.append(report_gs[key])
+            else:
+                old_report_gs.append(report_gs[key])
+            report_gs[key].is_pass = test_data[tv]["is_pass"]
+            report_gs[key].is_skip = test_data[tv]["is_skip"]
+    models.PAGQualityReportGroup.objects.bulk_update(old_report_gs, ['is_pass', 'is_skip'])
+    models.PAGQualityReportGroup.objects.bulk_create(new_report_gs)
+    if len(new_report_gs) > 0:
+        for report_g_id, group_id, test_set_id in models.PAGQualityReportGroup.objects.filter(group_id__in=group_ids).order_by('id').values_list('id', 'group_id', 'test_set_id'):
+            if report_gs[(group_id, test_set_id)].id is None:
+                report_gs[(group_id, test_set_id)].id = report_g_id
+
+    # A new report for every PAG and test version, stamped with now so they can be found again
+    reports = {}
+    for pag_id, test_data, n_fails in evaluated:
+        for tv in test_data:
+            report_g = report_gs[(ereport_gs[pag_id].id, tv.test_id)]
+            reports[(report_g.id, tv.id)] = models.PAGQualityReport(
+                    report_group_id=report_g.id,
+                    test_set_version_id=tv.id,
+                    is_pass=test_data[tv]["is_pass"],
+                    is_skip=test_data[tv]["is_skip"],
+                    timestamp=now,
+            )
+    models.PAGQualityReport.objects.bulk_create(reports.values())
+    report_ids = {}
+    for report_id, report_group_id, tv_id in models.PAGQualityReport.objects.filter(report_group_id__in=[k[0] for k in reports], timestamp=now).values_list('id', 'report_group_id', 'test_set_version_id'):
+        report_ids[(report_group_id, tv_id)] = report_id
+
+    rule_records = []
+    for pag_id, test_data, n_fails in evaluated:
+        for tv in test_data:
+            if test_data[tv]["is_skip"]:
+                continue
+            report_id = report_ids[(report_gs[(ereport_gs[pag_id].id, tv.test_id)].id, tv.id)]
+            for rule, rule_result in test_data[tv]["results"].items():
+                rule_records.append(models.PAGQualityReportRuleRecord(
+                        report_id=report_id,
+                        rule_id=rule.id,
+                        test_metric_str=rule_result["test_metric_str"],
+                        is_pass=rule_result["is_pass"],
+                        is_warn=rule_result["is_warn"],
+                        is_fail=rule_result["is_fail"],
+                ))
+    models.PAGQualityReportRuleRecord.objects.bulk_create(rule_records)
+    rule_record_ids = {}
+    if len(rule_records) > 0:
+        for rule_record_id, report_id, rule_id in models.PAGQualityReportRuleRecord.objects.filter(report_id__in=report_ids.values()).values_list('id', 'report_id', 'rule_id'):
+            rule_record_ids[(report_id, rule_id)] = rule_record_id
+
+    decision_records = []
+    for pag_id, test_data, n_fails in evaluated:
+        for tv in test_data:
+            if test_data[tv]["is_skip"]:
+                continue
+            report_id = report_ids[(report_gs[(ereport_gs[pag_id].id, tv.test_id)].id, tv.id)]
+            for decision, decision_result in test_data[tv]["decisions"].items():
+                decision_records.append(models.PAGQualityReportDecisionRecord(
+                        report_id=report_id,
+                        decision_id=decision.id,
+                        a_id=rule_record_ids[(report_id, decision.a_id)],
+                        b_id=rule_record_ids[(report_id, decision.b_id)] if decision.b_id else None,
+                        is_pass=decision_result["is_pass"],
+                        is_warn=decision_result["is_warn"],
+                        is_fail=decision_result["is_fail"],
+                ))
+    models.PAGQualityReportDecisionRecord.objects.bulk_create(decision_records)
+
+    util.mark_pag_exports_stale(pags=pag_ids)
+
+    # Hack a fact to count good pags quickly, every passing evaluation counts as add_qc always has
+    if plan.test_group.slug == MINIMAL_QC_SLUG:
+        if count_flips:
+            delta = len([pag_id for pag_id, test_data, n_fails in evaluated if n_fails == 0 and not was_pass[pag_id]])
+            delta -= len([pag_id for pag_id, test_data, n_fails in evaluated if n_fails > 0 and was_pass[pag_id]])
+        else:
+            delta = len([pag_id for pag_id, test_data, n_fails in evaluated if n_fails == 0])
+        util.adjust_fact(namespace="pag", key="minimal_qc_pass", delta=delta)
+    return was_pass
+
+def rerun(plan, pag_ids, dry_run=False):
+    # Re-evaluate the PAGs against plan with their current metrics and metadata, and unless dry_run is set,
+    # write their reports. Returns a dict for each PAG, in order, with its published_name, whether it passed
+    # before (was_pass, None if it had not been QC'd) and passes now (is_pass, None if it could not be QC'd),
+    # and any messages
+    names = dict(models.PublishedArtifactGroup.objects.filter(id__in=pag_ids).values_list('id', 'published_name'))
+    pag_ids = [pag_id for pag_id in pag_ids if pag_id in names]
+    inputs = gather_inputs(pag_ids)
+
+    outcomes = []
+    rows = []
+    for pag_id in pag_ids:
+        metrics, metadata, message = inputs[pag_id]
+        outcome = {"pag_id": pag_id, "published_name": names[pag_id], "was_pass": None, "is_pass": None, "messages": []}
+        outcomes.append(outcome)
+        if message:
+            outcome["messages"].append(message)
+        else:
+            rows.append((outcome, metrics, metadata))
+
+    evaluated = []
+    api_os = [{"errors": 0, "messages": outcome["messages"], "ignored": []} for outcome, metrics, metadata in rows]
+    results = plan.evaluate_batch([(metrics, metadata) for outcome, metrics, metadata in rows], api_os)
+    for (outcome, metrics, metadata), result in zip(rows, results):
+        if result is None:
+            continue
+        test_data, n_fails, all_skipped = result
+        if all_skipped:
+            # See https://github.com/COG-UK/dipi-group/issues/55 for why we default to using at least one QC test
+            outcome["messages"].append("Cowardly refusing to create QC report as no tests were performed...")
+            continue
+        outcome["is_pass"] = n_fails == 0
+        evaluated.append((outcome["pag_id"], test_data, n_fails))
+
+    if dry_run:
+        was_pass = dict(models.PAGQualityReportEquivalenceGroup.objects.filter(pag_id__in=pag_ids, test_group=plan.test_group).order_by('-id').values_list('pag_id', 'is_pass'))
+    else:
+        with transaction.atomic():
+            # Re-QC'ing a PAG does not publish it again, so only its flips are counted
+            was_pass = save_reports(plan, evaluated, count_flips=True)
+    for outcome in outcomes:
+        outcome["was_pass"] = was_pass.get(outcome["pag_id"])
+    return outcomes
@@ -1,12 +1,20 @@
 import time
 
 from django.dispatch import receiver
+from django.db.models.signals import pre_save, post_save, post_delete, m2m_changed
+from django.contrib.auth.models import User, Group
 from django.conf import settings
 from django.urls import reverse
 from django.utils import timezone
+from django.db import transaction
+from django.db.models import Q
 
 from . import models
+from . import lineage
+from . import metric_store
+from . import qc
 from . import signals
+from . import util
 
 from django_slack import slack_message
 from django.core.mail import send_mail
@@ -222,3 +230,97 @@ def recv_activated_registration(sender, username, email, **kwargs):
         [email],
         fail_silently=False,
     )
+
+
+# Drop cached API key validations when anything they depend on changes
+@receiver(post_save, sender=models.ProfileAPIKey)
+def invalidate_api_key_auth_key(sender, instance, **kwargs):
+    util.invalidate_api_key_auth(instance.profile_id)
+
+@receiver(post_save, sender=models.Profile)
+def invalidate_api_key_auth_profile(sender, instance, **kwargs):
+    util.invalidate_api_key_auth(instance.pk)
+
+@receiver(post_save, sender=User)
+def invalidate_api_key_auth_user(sender, instance, **kwargs):
+    if hasattr(instance, "profile"):
+        util.invalidate_api_key_auth(instance.profile.pk)
+
+@receiver(m2m_changed, sender=User.user_permissions.through)
+@receiver(m2m_changed, sender=User.groups.through)
+@receiver(m2m_changed, sender=Group.permissions.through)
+def invalidate_api_key_auth_perms(sender, instance, action, **kwargs):
+    if action in ["post_add", "post_remove", "post_clear"]:
+        util.invalidate_api_key_auth()
+
+
+# Keep the MajoraArtifactClosure in step with the process records, see lineage.add_closure_edge
+CLOSURE_FIELDS = ["in_artifact_id", "in_group_id", "out_artifact_id", "out_group_id", "bridge_artifact_id"]
+
+@receiver(pre_save)
+def stash_closure_record_endpoints(sender, instance, raw=False, **kwargs):
+    if raw or not isinstance(instance, models.MajoraArtifactProcessRecord) or instance._state.adding:
+        return
+    instance._closure_endpoints = models.MajoraArtifactProcessRecord.objects.non_polymorphic().filter(pk=instance.pk).values(*CLOSURE_FIELDS).first()
+
+@receiver(post_save)
+def update_closure_on_record(sender, instance, created, raw=False, **kwargs):
+    if raw or not isinstance(instance, models.MajoraArtifactProcessRecord):
+        return
+    if created:
+        lineage.add_closure_edge(instance)
+        return
+
+    previous = getattr(instance, "_closure_endpoints", None)
+    instance._closure_endpoints = None
+    if previous and any(previous[f] != getattr(instance, f) for f in CLOSURE_FIELDS):
+        nodes = lineage.DownstreamGraph.children(instance)
+        if previous["out_artifact_id"]:
+            nodes.append((lineage.ARTIFACT, previous["out_artifact_id"]))
+        if previous["out_group_id"]:
+            nodes.append((lineage.GROUP, previous["out_group_id"]))
+        lineage.rebuild_closure(nodes)
+
+# Quarantine flows down new process records, see util.refresh_quarantine
+@receiver(post_save)
+def propagate_quarantine_on_record(sender, instance, created, raw=False, **kwargs):
+    if raw or not created or not isinstance(instance, models.MajoraArtifactProcessRecord):
+        return
+    if not instance.out_artifact_id or instance.out_artifact_id == instance.in_artifact_id:
+        return
+    if instance.in_artifact_id:
+        quarantined = models.MajoraArtifact.objects.filter(pk=instance.in_artifact_id).filter(Q(quarantined=True) | Q(effective_quarantine_source__isnull=False)).exists()
+        if quarantined:
+            util.refresh_quarantine(models.MajoraArtifact.objects.get(pk=instance.out_artifact_id))
+
+# Drop compiled QC plans when any QC definition changes, see majora2.qc
+QC_DEFINITION_MODELS = [
+    models.PAGQualityTestEquivalenceGroup,
+    models.PAGQualityTest,
+    models.PAGQualityTestFilter,
+    models.PAGQualityTestVersion,
+    models.PAGQualityTestRule,
+    models.PAGQualityBasicTestDecision,
+]
+
+@receiver(post_save)
+@receiver(post_delete)
+def invalidate_qc_plans(sender, instance, raw=False, **kwargs):
+    if sender not in QC_DEFINITION_MODELS:
+        return
+    qc.invalidate_plans()
+
+# Write metrics through to the MajoraArtifactMetricStore, see majora2.metric_store
+@receiver(post_save)
+def update_metric_store(sender, instance, raw=False, **kwargs):
+    if raw or sender not in metric_store.SOURCE_MODELS:
+        return
+    metric_store.touch([instance.artifact_id])
+
+@receiver(post_delete)
+def update_metric_store_on_delete(sender, instance, **kwargs):
+    if sender not in metric_store.SOURCE_MODELS:
+        return
+    # Wait for the commit, as the metric may be going along with its artifact
+    artifact_id = instance.artifact_id
+    transaction.on_commit(lambda: metric_store.refresh([artifact_id]))
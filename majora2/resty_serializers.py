@@ -2,7 +2,7 @@ from rest_framework import serializers
 from rest_polymorphic.serializers import PolymorphicSerializer
 
 from django.apps import apps
-from django.db.models import Q
+from django.db.models import Q, prefetch_related_objects
 
 from majora2 import models
 
@@ -109,7 +109,7 @@ class RestyBiosourceSamplingProcessSerializer(DynamicDataviewModelSerializer):
         return obj.submission_org.code if obj.submission_org else None
 
     def get_biosources(self, obj):
-        return RestyBiosampleSourceSerializer([x.in_group for x in obj.records.filter(in_group__biosamplesource__isnull=False).order_by('id').prefetch_related('in_group')], many=True, context=self.context).data
+        return RestyBiosampleSourceSerializer([x.in_group for x in obj.records.non_polymorphic().filter(in_group__biosamplesource__isnull=False).order_by('id').resolve_related('in_group')], many=True, context=self.context).data
 
 class AbstractBioinformaticsProcessSerializer(DynamicDataviewModelSerializer):
     class Meta:
@@ -153,7 +153,9 @@ class RestyDNASequencingProcessSerializer(DynamicDataviewModelSerializer):
             return None
 
     def get_libraries(self, obj):
-        return RestyLibraryArtifactSerializer([a.in_artifact for a in obj.records.filter(in_artifact__libraryartifact__isnull=False).prefetch_related('in_artifact__metadata')], many=True, context=self.context).data
+        libraries = [a.in_artifact for a in obj.records.non_polymorphic().filter(in_artifact__libraryartifact__isnull=False).resolve_related('in_artifact')]
+        prefetch_related_objects(libraries, 'metadata')
+        return RestyLibraryArtifactSerializer(libraries, many=True, context=self.context).data
 
 class RestyProcessSerializer(PolymorphicSerializer):
     resource_type_field_name = 'process_model'
@@ -252,7 +254,7 @@ class RestyLibraryArtifactSerializer(BaseRestyArtifactSerializer):
         return {}
     def get_biosamples(self, obj):
         if obj.created:
-            return RestyBiosampleArtifactSerializer([x.in_artifact for x in obj.created.records.filter(in_artifact__biosampleartifact__isnull=False).order_by('id').prefetch_related('in_artifact__created')], many=True, context=self.context).data
+            return RestyBiosampleArtifactSerializer([x.in_artifact for x in obj.created.records.non_polymorphic().filter(in_artifact__biosampleartifact__isnull=False).order_by('id').resolve_related('in_artifact__created')], many=True, context=self.context).data
         return {}
 
 
@@ -307,9 +309,15 @@ class RestyPublishedArtifactGroupSerializer(DynamicDataviewModelSerializer):
     def get_process_records(self, obj):
         self.context["backward"] = False
 
-        ids = obj.tagged_artifacts.values_list('id', flat=True)
-        wide_ids = []
-        for d in models.MajoraArtifactProcessRecord.objects.filter(Q(in_artifact__id__in=ids) | Q(out_artifact__id__in=ids)).values('in_artifact', 'out_artifact', 'in_group', 'out_group'):
-            wide_ids.extend(d.values())
-        wide_ids = set(wide_ids)
-        return RestyProcessRecordSerializer(models.MajoraArtifactProcessRecord.objects.filter(Q(in_artifact__id__in=wide_ids) | Q(out_artifact__id__in=wide_ids)).distinct().prefetch_related('process'), many=True, context=self.context).data
+        # Widen to the artifacts one record away with the lineage closure
+        ids = list(obj.tagged_artifacts.values_list('id', flat=True))
+        wide_ids = set(ids)
+        for ancestor_id, descendant_id in models.MajoraArtifactClosure.objects.filter(
+                Q(ancestor_artifact__id__in=ids) | Q(descendant_artifact__id__in=ids),
+                depth=1,
+                ancestor_artifact__isnull=False,
+                descendant_artifact__isnull=False,
+        ).values_list('ancestor_artifact_id', 'descendant_artifact_id'):
+            wide_ids.add(ancestor_id)
+            wide_ids.add(descendant_id)
+        return RestyProcessRecordSerializer(models.MajoraArtifactProcessRecord.objects.filter(Q(in_artifact__id__in=wide_ids) | Q(out_artifact__id__in=wide_ids)).distinct().resolve_related('process'), many=True, context=self.context).data
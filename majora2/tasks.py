@@ -7,9 +7,18 @@ from . import serializers
 from . import resty_serializers
 from . import util
 
+from django.db import connection
 from django.db.models import Q, F
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import timezone
 
 import datetime
+import json
+import os
+import tempfile
+
+from dateutil.parser import parse
 
 from majora2 import mdv_tasks
 from tatl.models import TatlVerb, TatlRequest
@@ -24,7 +33,10 @@ def structify_pags(api_o):
 @shared_task
 def task_get_sequencing_faster(request, api_o, json_data, user=None, **kwargs):
 
-    run_names = list(models.DNASequencingProcess.objects.all().values_list("run_name", flat=True))
+    # Resolve the whole run -> library -> biosample graph with a fixed number of bulk
+    # queries and stitch it back together in memory, rather than walking it run by run
+    runs = models.DNASequencingProcess.objects.all().select_related('who__profile__institute')
+    run_ids = models.DNASequencingProcess.objects.all().values('id')
 
     n_runs = 0
     n_libs = 0
@@ -40,25 +52,28 @@ def task_get_sequencing_faster(request, api_o, json_data, user=None, **kwargs):
             pag_lookup[artifact_dice] = []
         pag_lookup[artifact_dice].append(published_name)
 
-    for run_name in run_names:
-
-        try:
-            process = models.DNASequencingProcess.objects.get(run_name=run_name)
-            n_runs += 1
-
-            lib_ids = models.MajoraArtifactProcessRecord.objects.filter(process_id=process.id).values_list("in_artifact__id", flat=True).distinct()
-
-            run = process.as_struct(deep=False)
-            run["libraries"] = []
-
-
-            for lib_id in lib_ids:
-                n_libs += 1
-                lib_obj = models.LibraryArtifact.objects.get(id=lib_id)
-                lib = lib_obj.as_struct(deep=False)
-
-                biosample_ids = models.MajoraArtifactProcessRecord.objects.filter(out_artifact__id=lib_id).values_list("in_artifact__id", flat=True).distinct()
-                lib["biosamples"] = {x["central_sample_id"]: x for x in models.BiosampleArtifact.objects.filter(id__in=biosample_ids).values(
+    # Libraries sequenced on each run
+    run_libraries = {}
+    for run_id, lib_id in models.MajoraArtifactProcessRecord.objects.filter(process_id__in=run_ids).values_list("process_id", "in_artifact__id").distinct():
+        if run_id not in run_libraries:
+            run_libraries[run_id] = []
+        if lib_id not in run_libraries[run_id]:
+            run_libraries[run_id].append(lib_id)
+    lib_ids = models.MajoraArtifactProcessRecord.objects.filter(process_id__in=run_ids).values('in_artifact__id')
+    libraries = {x.id: x for x in models.LibraryArtifact.objects.filter(id__in=lib_ids).prefetch_related('metadata')}
+
+    # Biosamples pooled into each library
+    library_biosamples = {}
+    for lib_id, biosample_id in models.MajoraArtifactProcessRecord.objects.filter(out_artifact__id__in=lib_ids).values_list("out_artifact__id", "in_artifact__id").distinct():
+        if lib_id not in library_biosamples:
+            library_biosamples[lib_id] = set([])
+        library_biosamples[lib_id].add(biosample_id)
+    biosample_ids = models.MajoraArtifactProcessRecord.objects.filter(out_artifact__id__in=lib_ids).values('in_artifact__id')
+
+    biosamples = {}
+    for x in models.BiosampleArtifact.objects.filter(id__in=biosample_ids).values(
+                    'id',
+                    'dice_name',
                     'central_sample_id',
                     'root_sample_id',
                     'sample_type_collected',
@@ -80,20 +95,21 @@ def task_get_sequencing_faster(request, api_o, json_data, user=None, **kwargs):
                     source_type=F('created__records__in_group__biosamplesource__source_type'),
                     sample_type_received=F('sample_type_current'),
                     swab_site=F('sample_site'),
-                )}
-                lib["metadata"] = lib_obj.get_metadata_as_struct()
-
-                # Preload ALL biosample metadata records for this lib
-                biosample_metadata = {}
-                for record in models.MajoraMetaRecord.objects.filter(artifact__id__in=biosample_ids, restricted=False).values('meta_tag', 'meta_name', 'value', 'artifact__dice_name'):
-                    if record["artifact__dice_name"] not in biosample_metadata:
-                        biosample_metadata[record["artifact__dice_name"]] = {}
-                    if record["meta_tag"] not in biosample_metadata[record["artifact__dice_name"]]:
-                        biosample_metadata[record["artifact__dice_name"]][record["meta_tag"]] = {}
-                    biosample_metadata[record["artifact__dice_name"]][record["meta_tag"]][record["meta_name"]] = record["value"]
-
-                # Preload ALL biosample-pool records for this lib
-                biosample_pooling = {x["in_artifact__dice_name"]: x for x in models.LibraryPoolingProcessRecord.objects.filter(out_artifact__id=lib_id).values(
+    ):
+        biosamples[x.pop("id")] = x
+
+    # Preload ALL biosample metadata records
+    biosample_metadata = {}
+    for record in models.MajoraMetaRecord.objects.filter(artifact__id__in=biosample_ids, restricted=False).values('meta_tag', 'meta_name', 'value', 'artifact__dice_name'):
+        if record["artifact__dice_name"] not in biosample_metadata:
+            biosample_metadata[record["artifact__dice_name"]] = {}
+        if record["meta_tag"] not in biosample_metadata[record["artifact__dice_name"]]:
+            biosample_metadata[record["artifact__dice_name"]][record["meta_tag"]] = {}
+        biosample_metadata[record["artifact__dice_name"]][record["meta_tag"]][record["meta_name"]] = record["value"]
+
+    # Preload ALL biosample-pool records, keyed by library
+    biosample_pooling = {}
+    for x in models.LibraryPoolingProcessRecord.objects.filter(out_artifact__id__in=lib_ids).values(
                     "in_artifact__dice_name",
                     "library_strategy",
                     "library_source",
@@ -102,18 +118,50 @@ def task_get_sequencing_faster(request, api_o, json_data, user=None, **kwargs):
                     "library_primers",
                     "sequencing_org_received_date",
                     library_adaptor_barcode=F("barcode"),
-                )}
+                    library_id=F("out_artifact__id"),
+    ):
+        lib_id = x.pop("library_id")
+        if lib_id not in biosample_pooling:
+            biosample_pooling[lib_id] = {}
+        biosample_pooling[lib_id][x["in_artifact__dice_name"]] = x
+
+    # Load ALL the biosample metrics, the polymorphic queryset costs one query per metric kind
+    biosample_metrics = {}
+    for metric in models.TemporaryMajoraArtifactMetric.objects.filter(artifact_id__in=biosample_ids).prefetch_related('metric_records'):
+        if metric.artifact_id not in biosamples:
+            continue
+        dice_name = biosamples[metric.artifact_id]["dice_name"]
+        if dice_name not in biosample_metrics:
+            biosample_metrics[dice_name] = {}
+        biosample_metrics[dice_name][metric.namespace] = metric.as_struct()
 
-                # Load all the metrics for this lib
-                biosample_metrics = {}
-                for metric in models.TemporaryMajoraArtifactMetric.objects.filter(artifact_id__in=biosample_ids):
-                    if metric.artifact.dice_name not in biosample_metrics:
-                        biosample_metrics[metric.artifact.dice_name] = {}
-                    biosample_metrics[metric.artifact.dice_name][metric.namespace] = metric.as_struct()
+    for process in runs:
+        run_name = process.run_name
+
+        try:
+            n_runs += 1
+
+            run = process.as_struct(deep=False)
+            run["libraries"] = []
+
+            for lib_id in run_libraries.get(process.id, []):
+                n_libs += 1
+                lib_obj = libraries.get(lib_id)
+                if not lib_obj:
+                    raise models.LibraryArtifact.DoesNotExist("LibraryArtifact matching query does not exist.")
+                lib = lib_obj.as_struct(deep=False)
+
+                lib["biosamples"] = {}
+                for biosample_id in library_biosamples.get(lib_id, []):
+                    if biosample_id in biosamples:
+                        bs = dict(biosamples[biosample_id])
+                        del bs["dice_name"]
+                        lib["biosamples"][bs["central_sample_id"]] = bs
+                lib["metadata"] = lib_obj.get_metadata_as_struct()
 
                 for bs in lib["biosamples"]:
                     n_biosamples += 1
-                    lib["biosamples"][bs].update(biosample_pooling.get(bs, {}))
+                    lib["biosamples"][bs].update(biosample_pooling.get(lib_id, {}).get(bs, {}))
                     lib["biosamples"][bs]["metrics"] = biosample_metrics.get(bs, {})
                     lib["biosamples"][bs]["metadata"] = biosample_metadata.get(bs, {})
                     lib["biosamples"][bs]["published_as"] = ",".join( set(pag_lookup.get(bs, [])) )
@@ -191,40 +239,7 @@ def task_get_sequencing(request, api_o, json_data, user=None, **kwargs):
     return api_o
 
 
-@shared_task
-def task_get_pag_v2(request, api_o, json_data, user=None, **kwargs):
-    pag_ids = _get_pags_by_qc_options(None, api_o, json_data)
-    if len(pag_ids) == 0:
-        api_o["messages"].append("No PAGs found.")
-
-    pags = {x["published_name"]: x for x in models.PublishedArtifactGroup.objects.filter(
-            id__in=pag_ids,
-    ).values(
-            'published_name',
-            'published_version',
-            'published_date',
-            owner_institute_code=F('owner__profile__institute__code'),
-            published_uuid=F('id'),
-            owner_org_ena_assembly_opted=F('owner__profile__institute__ena_assembly_opted'),
-            owner_org_ena_opted=F('owner__profile__institute__ena_opted'),
-            owner_org_gisaid_opted=F('owner__profile__institute__gisaid_opted'),
-
-            # Inserted for compat with deprecated task_get_pag_by_qc
-            owner_username=F('owner__username'),
-            owner_org_code=F('owner__profile__institute__code'),
-            owner_org_name=F('owner__profile__institute__name'),
-            owner_org_gisaid_user=F('owner__profile__institute__gisaid_user'),
-            owner_org_gisaid_mail=F('owner__profile__institute__gisaid_mail'),
-    )}
-
-    # adm1 lookup
-    countries = {
-        "UK-ENG": "England",
-        "UK-WLS": "Wales",
-        "UK-SCT": "Scotland",
-        "UK-NIR": "Northern_Ireland",
-    }
-
+def _get_pag_v2_credits():
     # get v1 credit
     v1_credits_lookup = {x["institute_code"]: x for x in models.Institute.objects.values(
             'credit_code_only',
@@ -254,16 +269,78 @@ def task_get_pag_v2(request, api_o, json_data, user=None, **kwargs):
             credit_codes_lookup[ic["institute_code"]] = {}
         credit_codes_lookup[ ic["institute_code"] ][ ic["credit_code"] ] = ic
 
+    return v1_credits_lookup, credit_codes_lookup
+
+
+def _get_pag_v2_structs(pag_ids, credits=None):
+    # Build the v2 PAG structs for the given PAG ids, keyed by published_name
+    # pag_ids may be a queryset or a list of ids (eg. one chunk of a larger export)
+    if credits:
+        v1_credits_lookup, credit_codes_lookup = credits
+    else:
+        v1_credits_lookup, credit_codes_lookup = _get_pag_v2_credits()
+
+    pags = {x["published_name"]: x for x in models.PublishedArtifactGroup.objects.filter(
+            id__in=pag_ids,
+    ).values(
+            'published_name',
+            'published_version',
+            'published_date',
+            owner_institute_code=F('owner__profile__institute__code'),
+            published_uuid=F('id'),
+            owner_org_ena_assembly_opted=F('owner__profile__institute__ena_assembly_opted'),
+            owner_org_ena_opted=F('owner__profile__institute__ena_opted'),
+            owner_org_gisaid_opted=F('owner__profile__institute__gisaid_opted'),
+
+            # Inserted for compat with deprecated task_get_pag_by_qc
+            owner_username=F('owner__username'),
+            owner_org_code=F('owner__profile__institute__code'),
+            owner_org_name=F('owner__profile__institute__name'),
+            owner_org_gisaid_user=F('owner__profile__institute__gisaid_user'),
+            owner_org_gisaid_mail=F('owner__profile__institute__gisaid_mail'),
+    )}
+
+    # adm1 lookup
+    countries = {
+        "UK-ENG": "England",
+        "UK-WLS": "Wales",
+        "UK-SCT": "Scotland",
+        "UK-NIR": "Northern_Ireland",
+    }
+
     # build pag to run map
-    # This is gross and only works because we use the run_name as a key on the PAG
-    # In future we'd do well to lock processes in to the PAG directly I think
+    # The run is the sequencing process that leads to an artifact of the PAG in the lineage closure,
+    # PAGs without one (eg. before the closure has been backfilled) fall back to the run_name that
+    # we use as a key on the PAG's published_name
+    # A PAG reached by several runs keeps the one named by its published_name, if it is one of them,
+    # otherwise the nearest run is used, then the earliest to start, then the first registered
+    closure_runs = {}
+    for published_name, depth, start_time, run_id, run_name in models.PublishedArtifactGroup.objects.filter(
+            id__in=pag_ids,
+            tagged_artifacts__closure_ancestors__via_process__dnasequencingprocess__isnull=False,
+    ).values_list(
+            'published_name',
+            'tagged_artifacts__closure_ancestors__depth',
+            'tagged_artifacts__closure_ancestors__via_process__dnasequencingprocess__start_time',
+            'tagged_artifacts__closure_ancestors__via_process_id',
+            'tagged_artifacts__closure_ancestors__via_process__dnasequencingprocess__run_name',
+    ):
+        if published_name not in closure_runs:
+            closure_runs[published_name] = []
+        closure_runs[published_name].append(((depth, start_time is None, start_time or 0, run_id), run_name))
+
     run_to_pag = {}
     pag_ids = []
     for pag in pags:
         try:
-            run_name = pag.split(':')[1]
+            named_run = pag.split(':')[1]
         except:
-            run_name = pag
+            named_run = pag
+        if pag in closure_runs:
+            run_names = [run_name for key, run_name in sorted(closure_runs[pag], key=lambda x: x[0])]
+            run_name = named_run if named_run in run_names else run_names[0]
+        else:
+            run_name = named_run
         if run_name not in run_to_pag:
             run_to_pag[run_name] = []
         run_to_pag[run_name].append(pag)
@@ -303,7 +380,8 @@ def task_get_pag_v2(request, api_o, json_data, user=None, **kwargs):
 
     # get sequencing processeses
     #NOTE probably get slow performance with the run_name__in filter but it'll be faster than processing every run overall i reckon
-    sequencing_procs = models.DNASequencingProcess.objects.filter(run_name__in=list(run_to_pag.keys())).values(
+    run_q = models.DNASequencingProcess.objects.filter(run_name__in=list(run_to_pag.keys()))
+    sequencing_procs = run_q.values(
             'id',
             'run_name',
             'instrument_make',
@@ -312,38 +390,49 @@ def task_get_pag_v2(request, api_o, json_data, user=None, **kwargs):
     )
 
     run_to_library_lookup = {}
+    run_names = {}
     for run in sequencing_procs:
         # determine the run
         run_name = run["run_name"]
+        run_names[run["id"]] = run_name
+        run_to_library_lookup[run_name] = {}
         if run["sequencing_org_run_date"]:
             run["sequencing_org_run_date"] = run["sequencing_org_run_date"].strftime("%Y-%m-%d")
 
         for pag in run_to_pag[run_name]:
             pags[pag]["artifacts"]["sequencing"] = [run] # cheat to make this fit the old ocarina api format
 
-        # get library info and match the biosample and run combo
-        # ffs this is also gross, should have put the library in the fucking pag, i hate myself
-        # we roll up to the biosample name here because you can't upload the same sample on two libraries on the same run (yet)
-        lib_ids = models.MajoraArtifactProcessRecord.objects.filter(process_id=run["id"]).values_list("in_artifact__id", flat=True).distinct()
-        biosample_pooling = {x["in_artifact__dice_name"]: x for x in models.LibraryPoolingProcessRecord.objects.filter(out_artifact__id__in=lib_ids).values(
-                    "in_artifact__dice_name",
-                    "library_strategy",
-                    "library_source",
-                    "library_selection",
-                    "library_protocol",
-                    "library_primers",
-                    "sequencing_org_received_date",
-                    seq_kit=F('out_artifact__libraryartifact__seq_kit'),
-                    seq_protocol=F('out_artifact__libraryartifact__seq_protocol'),
-                    library_adaptor_barcode=F("barcode"),
-        )}
-        for pool in biosample_pooling:
-            sord = biosample_pooling[pool].get("sequencing_org_received_date")
-            if sord:
-                biosample_pooling[pool]["sequencing_org_received_date"] = sord.strftime("%Y-%m-%d")
-        if run_name not in run_to_library_lookup:
-            run_to_library_lookup[run_name] = {}
-        run_to_library_lookup[run_name].update(biosample_pooling)
+    # get library info and match the biosample and run combo
+    # ffs this is also gross, should have put the library in the fucking pag, i hate myself
+    # we roll up to the biosample name here because you can't upload the same sample on two libraries on the same run (yet)
+    # libraries for every run are fetched at once, then the pooling records for every library at once
+    library_to_runs = {}
+    for run_id, lib_id in models.MajoraArtifactProcessRecord.objects.filter(process__in=run_q.values('id')).values_list("process_id", "in_artifact__id").distinct():
+        if lib_id not in library_to_runs:
+            library_to_runs[lib_id] = set([])
+        library_to_runs[lib_id].add(run_names[run_id])
+
+    biosample_pooling = models.LibraryPoolingProcessRecord.objects.filter(
+            out_artifact__id__in=models.MajoraArtifactProcessRecord.objects.filter(process__in=run_q.values('id')).values('in_artifact__id')
+    ).values(
+                "in_artifact__dice_name",
+                "library_strategy",
+                "library_source",
+                "library_selection",
+                "library_protocol",
+                "library_primers",
+                "sequencing_org_received_date",
+                seq_kit=F('out_artifact__libraryartifact__seq_kit'),
+                seq_protocol=F('out_artifact__libraryartifact__seq_protocol'),
+                library_adaptor_barcode=F("barcode"),
+                library_id=F("out_artifact__id"),
+    )
+    for pool in biosample_pooling:
+        sord = pool.get("sequencing_org_received_date")
+        if sord:
+            pool["sequencing_org_received_date"] = sord.strftime("%Y-%m-%d")
+        for run_name in library_to_runs.get(pool.pop("library_id"), []):
+            run_to_library_lookup[run_name][pool["in_artifact__dice_name"]] = pool
 
     # get biosamples
     biosamples = models.BiosampleArtifact.objects.filter(
@@ -359,8 +448,8 @@ def task_get_pag_v2(request, api_o, json_data, user=None, **kwargs):
             submission_org_code=F('created__biosourcesamplingprocess__submission_org__code'),
             adm0=F('created__biosourcesamplingprocess__collection_location_country'),
             adm1=F('created__biosourcesamplingprocess__collection_location_adm1'),
-            min_ct=F('metrics__temporarymajoraartifactmetric_thresholdcycle__min_ct'),
-            max_ct=F('metrics__temporarymajoraartifactmetric_thresholdcycle__max_ct'),
+            min_ct=F('metric_store__ct_min_ct'),
+            max_ct=F('metric_store__ct_max_ct'),
             is_surveillance=F('created__biosourcesamplingprocess__coguk_supp__is_surveillance'),
             collection_pillar=F('created__biosourcesamplingprocess__coguk_supp__collection_pillar'),
     )
@@ -423,14 +512,14 @@ def task_get_pag_v2(request, api_o, json_data, user=None, **kwargs):
                 'current_path',
                 'current_hash',
                 'current_size',
-                num_bases=F('metrics__temporarymajoraartifactmetric_sequence__num_bases'),
-                longest_ungap=F('metrics__temporarymajoraartifactmetric_sequence__longest_ungap'),
-                pc_acgt=F('metrics__temporarymajoraartifactmetric_sequence__pc_acgt'),
-                pc_masked=F('metrics__temporarymajoraartifactmetric_sequence__pc_masked'),
-                mean_cov=F('metrics__temporarymajoraartifactmetric_mapping__mean_cov'),
-                num_pos=F('metrics__temporarymajoraartifactmetric_mapping__num_pos'),
-                pc_pos_cov_gte10=F('metrics__temporarymajoraartifactmetric_mapping__pc_pos_cov_gte10'),
-                pc_pos_cov_gte20=F('metrics__temporarymajoraartifactmetric_mapping__pc_pos_cov_gte20'),
+                num_bases=F('metric_store__sequence_num_bases'),
+                longest_ungap=F('metric_store__sequence_longest_ungap'),
+                pc_acgt=F('metric_store__sequence_pc_acgt'),
+                pc_masked=F('metric_store__sequence_pc_masked'),
+                mean_cov=F('metric_store__mapping_mean_cov'),
+                num_pos=F('metric_store__mapping_num_pos'),
+                pc_pos_cov_gte10=F('metric_store__mapping_pc_pos_cov_gte10'),
+                pc_pos_cov_gte20=F('metric_store__mapping_pc_pos_cov_gte20'),
                 pipe_id=F('created__abstractbioinformaticsprocess__id'),
                 pipe_kind=F('created__abstractbioinformaticsprocess__pipe_kind'),
                 pipe_name=F('created__abstractbioinformaticsprocess__pipe_name'),
@@ -443,17 +532,135 @@ def task_get_pag_v2(request, api_o, json_data, user=None, **kwargs):
         if published_name not in deleted_pags:
             pags[published_name]["artifacts"][dra["current_kind"]] = [dra]
 
+    return pags
+
+
+def _refresh_pag_export_documents(pag_ids, credits=None):
+    # Return the materialised export document for each of the given PAG ids,
+    # rebuilding any that are missing, have never been built or have been marked stale since they were built
+    existing = {pag_id: is_stale or last_built is None for pag_id, is_stale, last_built in models.PAGExportDocument.objects.filter(pag_id__in=pag_ids).values_list('pag_id', 'is_stale', 'last_built')}
+    to_build = [pag_id for pag_id in pag_ids if existing.get(pag_id, True)]
+
+    documents = {}
+    if len(to_build) > 0:
+        # Clear the stale flag before building, so that anything invalidating
+        # these PAGs while we work will flag them again for the next export.
+        # PAGs without a document get an unbuilt placeholder first, as mark_pag_exports_stale
+        # can only flag a document that exists
+        missing = [pag_id for pag_id in to_build if pag_id not in existing]
+        if len(missing) > 0:
+            models.PAGExportDocument.objects.bulk_create([models.PAGExportDocument(pag_id=pag_id, is_stale=False) for pag_id in missing], ignore_conflicts=True)
+        models.PAGExportDocument.objects.filter(pag_id__in=to_build, is_stale=True).update(is_stale=False)
+
+        pags = _get_pag_v2_structs(to_build, credits=credits)
+        for published_name, pag in pags.items():
+            documents[pag["published_uuid"]] = json.dumps({"published_name": published_name, "pag": pag}, cls=DjangoJSONEncoder)
+
+        # The stale flag is left alone, so a PAG flagged during the build is rebuilt next time
+        now = timezone.now()
+        models.PAGExportDocument.objects.bulk_update([
+            models.PAGExportDocument(pag_id=pag_id, document=documents.get(pag_id), last_built=now) for pag_id in to_build
+        ], ['document', 'last_built'])
+
+    fresh = [pag_id for pag_id in pag_ids if pag_id not in documents and pag_id in existing]
+    if len(fresh) > 0:
+        documents.update(models.PAGExportDocument.objects.filter(pag_id__in=fresh).values_list('pag_id', 'document'))
+
+    return [documents[pag_id] for pag_id in pag_ids if documents.get(pag_id)]
+
+
+def _iter_pag_id_chunks(pag_ids, chunk_size):
+    # Keyset paginate over the selected PAG ids, so we never hold more than
+    # chunk_size PAGs (and their artifacts) in memory at once
+    last_id = None
+    while True:
+        chunk_q = pag_ids.order_by('id')
+        if last_id:
+            chunk_q = chunk_q.filter(id__gt=last_id)
+        chunk = list(chunk_q[:chunk_size])
+        if len(chunk) == 0:
+            break
+        yield chunk
+        last_id = chunk[-1]
+
+
+def _iter_pag_export_documents(pag_ids, chunk_size):
+    credits = None
+    for chunk in _iter_pag_id_chunks(pag_ids, chunk_size):
+        if credits is None:
+            credits = _get_pag_v2_credits()
+        for document in _refresh_pag_export_documents(chunk, credits=credits):
+            yield document
+
+
+@shared_task
+def task_get_pag_v2(request, api_o, json_data, user=None, **kwargs):
+    chunk_size = getattr(settings, "MAJORA_PAG_EXPORT_CHUNK_SIZE", 1000)
+
+    result = []
+    counter = util.QueryCounter()
+    with connection.execute_wrapper(counter):
+        pag_ids = _get_pags_by_qc_options(None, api_o, json_data)
+        if not isinstance(pag_ids, list):
+            result = [json.loads(document) for document in _iter_pag_export_documents(pag_ids, chunk_size)]
+        if len(result) == 0:
+            api_o["messages"].append("No PAGs found.")
+
     try:
         api_o["get"] = {}
-        api_o["get"]["result"] = [{"published_name": x, "pag": pags[x]} for x in pags]
-        api_o["get"]["count"] = len(pags)
+        api_o["get"]["result"] = result
+        api_o["get"]["count"] = len(result)
+        api_o["get"]["query_count"] = counter.count
+    except Exception as e:
+        api_o["errors"] += 1
+        api_o["messages"].append(str(e))
+    return api_o
+
+
+@shared_task
+def task_get_pag_v2_stream(request, api_o, json_data, user=None, **kwargs):
+    # Same output as task_get_pag_v2, but the result set is read in chunks and
+    # spooled to disk as NDJSON (one {"published_name", "pag"} per line) rather
+    # than returned in the task result. api.majora.task.get streams it back.
+    pag_ids = _get_pags_by_qc_options(None, api_o, json_data)
+    if isinstance(pag_ids, list):
+        return api_o # _get_pags_by_qc_options bailed
+
+    chunk_size = getattr(settings, "MAJORA_PAG_EXPORT_CHUNK_SIZE", 1000)
+    spool_dir = getattr(settings, "MAJORA_TASK_SPOOL_DIR", None)
+
+    count = 0
+    counter = util.QueryCounter()
+    fh = tempfile.NamedTemporaryFile(mode="w", dir=spool_dir, prefix="majora-pag-", suffix=".ndjson", delete=False)
+    try:
+        with fh, connection.execute_wrapper(counter):
+            for document in _iter_pag_export_documents(pag_ids, chunk_size):
+                fh.write(document)
+                fh.write("\n")
+                count += 1
     except Exception as e:
+        os.unlink(fh.name)
         api_o["errors"] += 1
         api_o["messages"].append(str(e))
+        return api_o
+
+    if count == 0:
+        api_o["messages"].append("No PAGs found.")
+
+    api_o["get"] = {}
+    api_o["get"]["stream"] = fh.name
+    api_o["get"]["count"] = count
+    api_o["get"]["query_count"] = counter.count
     return api_o
 
 
 def _get_pags_by_qc_options(request, api_o, json_data):
+    # Take the next cursor before the PAGs are selected so that nothing written
+    # while we work is missed, the overlap covers transactions that commit late
+    cursor_overlap = getattr(settings, "MAJORA_PAG_CURSOR_OVERLAP", 60)
+    cursor = util.make_export_cursor(timezone.now() - datetime.timedelta(seconds=cursor_overlap))
+    n_errors = api_o["errors"]
+
     test_name = json_data.get("test_name")
 
     if not test_name or len(test_name) == 0:
@@ -508,6 +715,41 @@ def _get_pags_by_qc_options(request, api_o, json_data):
             is_suppressed=False,
         )
 
+    # Return only PAGs whose exported representation may have changed since the
+    # last poll: new or updated QC, accession changes, or a suppression
+    changed_since = None
+    if json_data.get("cursor"):
+        try:
+            changed_since = util.parse_export_cursor(json_data["cursor"])
+        except ValueError as e:
+            api_o["errors"] += 1
+            api_o["messages"].append(str(e))
+            return []
+    elif json_data.get("changed_since"):
+        try:
+            changed_since = parse(json_data["changed_since"])
+        except (ValueError, OverflowError) as e:
+            api_o["errors"] += 1
+            api_o["messages"].append("Invalid 'changed_since': %s" % str(e))
+            return []
+
+    changed_pags = None
+    if changed_since:
+        if timezone.is_naive(changed_since):
+            changed_since = timezone.make_aware(changed_since)
+        changed_q = (
+            Q(quality_groups__last_updated__gt=changed_since) |
+            Q(accessions__requested_timestamp__gt=changed_since) |
+            Q(accessions__public_timestamp__gt=changed_since) |
+            Q(accessions__rejected_timestamp__gt=changed_since) |
+            Q(public_timestamp__gt=changed_since) |
+            Q(suppressed_date__gt=changed_since)
+        )
+        changed_pags = models.PublishedArtifactGroup.objects.filter(changed_q).values('id')
+        base_q = base_q & Q(
+            id__in=changed_pags,
+        )
+
     # Return only PAGs with the service name, otherwise use the is_public shortcut
     if json_data.get("public") and json_data.get("private"):
         if json_data.get("service_name"):
@@ -551,7 +793,21 @@ def _get_pags_by_qc_options(request, api_o, json_data):
     else:
         status_q= Q() # Should basically be NOP
 
-    return models.PublishedArtifactGroup.objects.filter(base_q & status_q).values_list('id', flat=True)
+    pag_ids = models.PublishedArtifactGroup.objects.filter(base_q & status_q).values_list('id', flat=True)
+
+    # Name the changed PAGs that no longer match the options (suppressed, or flipped
+    # out of the pass/fail filter), so clients applying the deltas can drop them
+    if changed_pags is not None:
+        api_o["removed"] = list(models.PublishedArtifactGroup.objects.filter(
+            is_latest = True,
+            quality_groups__test_group = t_group,
+            id__in = changed_pags,
+        ).exclude(id__in=pag_ids).values_list('published_name', flat=True).distinct())
+
+    # Only hand out a cursor if the selection can be trusted
+    if api_o["errors"] == n_errors:
+        api_o["cursor"] = cursor
+    return pag_ids
 
 
 @shared_task
@@ -0,0 +1,69 @@
+from django.db import connection
+from django.contrib.auth.models import Permission
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from majora2 import models
+from majora2 import util
+from majora2.test.test_basic_api import BasicAPIBase
+
+class APIKeyAuthCacheTest(BasicAPIBase):
+    def setUp(self):
+        super().setUp()
+        self.perm = Permission.objects.get(codename="temp_can_read_pags_via_api")
+        self.kd.permission = self.perm
+        self.kd.save()
+
+    def _auth(self, permission=None):
+        return util.get_api_key_auth(self.key.key, self.user.username, permission)
+
+    def test_cached_key(self):
+        profile, permitted = self._auth()
+        self.assertEqual(profile.user, self.user)
+        self.assertTrue(permitted)
+
+        # Only the profile is loaded once the key has been validated
+        with CaptureQueriesContext(connection) as queries:
+            profile, permitted = self._auth()
+        self.assertEqual(len(queries), 1)
+        self.assertEqual(profile.user, self.user)
+        self.assertEqual(profile.institute.code, "HOOT")
+
+        profile, permitted = util.get_api_key_auth(self.key.key, self.not_user.username)
+        self.assertIsNone(profile)
+
+    def test_revoked_key_invalidates(self):
+        self.assertIsNotNone(self._auth()[0])
+        self.key.was_revoked = True
+        self.key.save()
+        self.assertEqual(self._auth(), (None, False))
+
+    def test_cached_permission(self):
+        self.assertFalse(self._auth("majora2.temp_can_read_pags_via_api")[1])
+
+        self.user.user_permissions.add(self.perm)
+        self.assertTrue(self._auth("majora2.temp_can_read_pags_via_api")[1])
+        with CaptureQueriesContext(connection) as queries:
+            self.assertTrue(self._auth("majora2.temp_can_read_pags_via_api")[1])
+        self.assertEqual(len(queries), 1)
+
+        # The key must also have been granted the permission
+        self.assertFalse(self._auth("majora2.can_suppress_pags_via_api")[1])
+
+        self.user.user_permissions.remove(self.perm)
+        self.assertFalse(self._auth("majora2.temp_can_read_pags_via_api")[1])
+
+    def test_revoked_profile_rejected(self):
+        payload = {
+            "username": self.user.username,
+            "token": self.key.key,
+            "client_name": "pytest",
+            "client_version": 1,
+        }
+        response = self.c.post(reverse('api.meta.metric.add'), payload, secure=True, content_type="application/json")
+        self.assertEqual(200, response.status_code)
+
+        self.user.profile.is_revoked = True
+        self.user.profile.save()
+        response = self.c.post(reverse('api.meta.metric.add'), payload, secure=True, content_type="application/json")
+        self.assertEqual(400, response.status_code)
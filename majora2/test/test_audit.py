@@ -0,0 +1,123 @@
+from django.db import transaction
+from django.test import TransactionTestCase
+from django.contrib.auth.models import User
+from django.utils import timezone
+
+from tatl import audit
+from tatl import models as tmodels
+from tatl import tasks as ttasks
+
+from unittest.mock import patch
+
+class TatlAuditBufferTest(TransactionTestCase):
+    def setUp(self):
+        self.user = User.objects.create(username="hoot")
+        self.treq = tmodels.TatlRequest(user=self.user, view_name="hoot", view_path="/hoot/", timestamp=timezone.now(), status_code=0)
+        self.treq.save()
+
+    def _verb(self, verb="CREATE"):
+        return tmodels.TatlVerb(request=self.treq, verb=verb, content_object=self.user)
+
+    def _flex(self):
+        return tmodels.TatlPermFlex(user=self.user, used_permission="majora2.hoot", timestamp=timezone.now(), request=self.treq, content_object=self.treq)
+
+    def test_request_mode_defers_writes(self):
+        buf = audit.open_buffer()
+        verb = self._verb()
+        verb.save()
+        flex = self._flex()
+        flex.save()
+        flex.substitute_user = self.user
+        flex.save()
+        self.assertEqual(tmodels.TatlVerb.objects.count(), 0)
+        self.assertEqual(tmodels.TatlPermFlex.objects.count(), 0)
+
+        with self.assertLogs('majora', level='INFO') as logs:
+            audit.close_buffer(buf)
+        self.assertEqual(tmodels.TatlVerb.objects.filter(request=self.treq, verb="CREATE").count(), 1)
+        self.assertEqual(tmodels.TatlPermFlex.objects.filter(request=self.treq, substitute_user=self.user).count(), 1)
+        self.assertIn("verb=CREATE", "".join(logs.output))
+
+        # Nothing is buffered once the buffer has been closed
+        self._verb("UPDATE").save()
+        self.assertEqual(tmodels.TatlVerb.objects.filter(verb="UPDATE").count(), 1)
+
+    def test_rolled_back_records_are_discarded(self):
+        buf = audit.open_buffer()
+        with transaction.atomic():
+            self._verb("CREATE").save()
+            try:
+                with transaction.atomic():
+                    self._verb("UPDATE").save()
+                    raise Exception("hoot")
+            except Exception:
+                pass
+            # Nothing joins the buffer until the transaction commits
+            self.assertEqual(len(buf.records), 0)
+        self.assertEqual(len(buf.records), 1)
+
+        try:
+            with transaction.atomic():
+                self._verb("DELETE").save()
+                raise Exception("hoot")
+        except Exception:
+            pass
+        audit.close_buffer(buf)
+        self.assertEqual(list(tmodels.TatlVerb.objects.values_list('verb', flat=True)), ["CREATE"])
+
+        # A transaction that commits after the request's buffer has closed writes its own records
+        buf = audit.open_buffer()
+        with transaction.atomic():
+            self._verb("UPDATE").save()
+            audit.close_buffer(buf)
+        self.assertEqual(tmodels.TatlVerb.objects.filter(verb="UPDATE").count(), 1)
+
+    def test_sync_mode(self):
+        with self.settings(TATL_AUDIT_MODE="sync"):
+            buf = audit.open_buffer()
+            self._verb().save()
+            self.assertEqual(tmodels.TatlVerb.objects.count(), 1)
+            audit.close_buffer(buf)
+        self.assertEqual(tmodels.TatlVerb.objects.count(), 1)
+
+    @patch("tatl.tasks.task_write_audit.delay")
+    def test_queue_mode(self, delay):
+        delay.side_effect = lambda payload: ttasks.task_write_audit(payload)
+        with self.settings(TATL_AUDIT_MODE="queue"):
+            buf = audit.open_buffer()
+            self._verb().save()
+            self._flex().save()
+            audit.close_buffer(buf)
+        self.assertEqual(delay.call_count, 1)
+        self.assertEqual(tmodels.TatlVerb.objects.get().content_object, self.user)
+        self.assertEqual(tmodels.TatlPermFlex.objects.get().content_object, self.treq)
+
+    @patch("tatl.tasks.task_write_audit.delay")
+    def test_queue_mode_fallback(self, delay):
+        delay.side_effect = Exception("broker unavailable")
+        with self.settings(TATL_AUDIT_MODE="queue"):
+            buf = audit.open_buffer()
+            self._verb().save()
+            audit.close_buffer(buf)
+        self.assertEqual(tmodels.TatlVerb.objects.count(), 1)
+
+    def test_flush_open_buffers_at_exit(self):
+        buf = audit.open_buffer()
+        self._verb().save()
+        self.assertEqual(tmodels.TatlVerb.objects.count(), 0)
+        audit.flush_open_buffers()
+        self.assertEqual(tmodels.TatlVerb.objects.count(), 1)
+
+        audit.close_buffer(buf)
+        self.assertEqual(tmodels.TatlVerb.objects.count(), 1)
+
+    @patch("tatl.audit.write_records")
+    def test_close_buffer_failure_is_logged(self, write_records):
+        write_records.side_effect = Exception("database unavailable")
+        buf = audit.open_buffer()
+        self._verb().save()
+        with self.assertLogs('majora', level='ERROR') as logs:
+            audit.close_buffer(buf)
+        self.assertIn("Could not flush audit records", "".join(logs.output))
+        self.assertTrue(buf.closed)
+        self.assertNotIn(buf, audit._open_buffers)
@@ -822,6 +822,45 @@ class OAuthBiosampleArtifactTest(OAuthAPIClientBase):
         assert j["result"][self.default_central_sample_id]["has_sender_id"] == True
         assert j["result"][self.default_central_sample_id]["has_metadata"] == True
 
+    def test_add_biosample_batch(self):
+        payload = copy.deepcopy(self.default_payload)
+        template = payload["biosamples"][0]
+        payload["biosamples"] = []
+        for i in range(1, 6):
+            biosample = copy.deepcopy(template)
+            biosample["central_sample_id"] = "HOOT-0000%d" % i
+            biosample["biosample_source_id"] = "ABC0000%d" % (i % 2) # shared sources
+            payload["biosamples"].append(biosample)
+        payload["biosamples"][2]["source_age"] = "hoot" # invalid
+        payload["biosamples"].append(copy.deepcopy(payload["biosamples"][0])) # duplicate
+        payload["biosamples"][-1]["swab_site"] = "nose"
+
+        response = self.c.post(self.endpoint, payload, secure=True, content_type="application/json", HTTP_AUTHORIZATION="Bearer %s" % self.token)
+        self.assertEqual(200, response.status_code)
+        j = response.json()
+        self.assertEqual(j["errors"], 1)
+        self.assertIn("HOOT-00003", j["ignored"])
+
+        self.assertEqual(models.BiosampleArtifact.objects.filter(central_sample_id__startswith="HOOT-0000").count(), 4)
+        self.assertEqual(models.BiosampleSource.objects.filter(dice_name__startswith="ABC0000").count(), 2)
+        for sample_id in ["HOOT-00001", "HOOT-00002", "HOOT-00004", "HOOT-00005"]:
+            bs = models.BiosampleArtifact.objects.get(central_sample_id=sample_id)
+            self.assertEqual(bs.created.records.count(), 1)
+            self.assertEqual(bs.primary_group.dice_name, "ABC0000%d" % (int(sample_id[-1]) % 2))
+            self.assertEqual(bs.created.coguk_supp.is_hcw, True)
+
+        # Duplicate in the request is applied as an update on the sample created earlier in the request
+        self.assertEqual(models.BiosampleArtifact.objects.get(central_sample_id="HOOT-00001").sample_site, "nose")
+
+        # Resubmitting updates everything in place
+        payload["biosamples"][3]["is_hcw"] = False
+        response = self.c.post(self.endpoint, payload, secure=True, content_type="application/json", HTTP_AUTHORIZATION="Bearer %s" % self.token)
+        j = response.json()
+        self.assertEqual(j["errors"], 1)
+        self.assertEqual(len(j["new"]), 0)
+        self.assertEqual(models.BiosampleArtifact.objects.filter(central_sample_id__startswith="HOOT-0000").count(), 4)
+        self.assertEqual(models.BiosampleArtifact.objects.get(central_sample_id="HOOT-00004").created.coguk_supp.is_hcw, False)
+
     def test_add_biosample_bad_scope_bad(self):
         n_biosamples = models.BiosampleArtifact.objects.count()
 
@@ -0,0 +1,152 @@
+from io import StringIO
+
+from django.core.management import call_command
+from django.test import TestCase
+from django.utils import timezone
+
+from majora2 import models
+from majora2 import lineage
+from majora2 import resty_serializers
+from majora2 import tasks
+from majora2.test.util import create_full_user
+
+import datetime
+
+def closure_rows():
+    return set(models.MajoraArtifactClosure.objects.values_list(
+        'ancestor_artifact_id', 'ancestor_group_id', 'descendant_artifact_id', 'descendant_group_id', 'depth', 'via_process_id', 'bridge_artifact_id',
+    ))
+
+class LineageClosureTest(TestCase):
+    def setUp(self):
+        self.user = create_full_user("hoot")
+        self.t = timezone.now()
+
+        # Two biosamples pooled on one library, sequenced on one run, with a consensus for each
+        # bridged back to its own biosample, the way the sequencing and pipeline handlers do it
+        self.biosample = models.BiosampleArtifact(central_sample_id="HOOT-00001", dice_name="HOOT-00001")
+        self.biosample.save()
+        self.biosample2 = models.BiosampleArtifact(central_sample_id="HOOT-00002", dice_name="HOOT-00002")
+        self.biosample2.save()
+
+        self.library = models.LibraryArtifact(dice_name="HOOT-LIB")
+        self.library.save()
+        self.pooling = models.LibraryPoolingProcess(who=self.user, when=self._when(0))
+        self.pooling.save()
+        for biosample in [self.biosample, self.biosample2]:
+            models.LibraryPoolingProcessRecord(process=self.pooling, bridge_artifact=biosample, in_artifact=biosample, out_artifact=self.library).save()
+
+        self.run = models.DNASequencingProcess(run_name="HOOT-RUN", who=self.user, when=self._when(1))
+        self.run.save()
+        self.dgroup = models.DigitalResourceGroup(unique_name="sequencing-dummy-tree-HOOT-RUN", dice_name="sequencing-dummy-tree-HOOT-RUN", current_name="sequencing-dummy-tree-HOOT-RUN", physical=False)
+        self.dgroup.save()
+        models.DNASequencingProcessRecord(process=self.run, in_artifact=self.library, out_group=self.dgroup).save()
+
+        self.reads = models.DigitalResourceArtifact(current_name="sequencing-dummy-reads-HOOT-RUN", current_kind="dummy")
+        self.reads.save()
+        self.basecalling = models.AbstractBioinformaticsProcess(pipe_kind="Basecalling", who=self.user, when=self._when(2))
+        self.basecalling.save()
+        models.MajoraArtifactProcessRecord(process=self.basecalling, in_group=self.dgroup, out_artifact=self.reads).save()
+
+        self.pipe = models.AbstractBioinformaticsProcess(pipe_kind="Pipeline", who=self.user, when=self._when(3))
+        self.pipe.save()
+        self.consensus = self._consensus(self.biosample)
+        self.consensus2 = self._consensus(self.biosample2)
+
+    def _when(self, days):
+        return self.t + datetime.timedelta(days=days)
+
+    def _consensus(self, biosample):
+        consensus = models.DigitalResourceArtifact(current_name="%s.fasta" % biosample.dice_name, current_path="/hoot/%s.fasta" % biosample.dice_name, current_kind="consensus")
+        consensus.save()
+        models.MajoraArtifactProcessRecord(process=self.pipe, bridge_artifact=biosample, in_artifact=self.reads, out_artifact=consensus).save()
+        return consensus
+
+    def _ancestors(self, artifact):
+        return {
+            (row.ancestor_artifact_id or row.ancestor_group_id): (row.depth, row.via_process_id)
+            for row in models.MajoraArtifactClosure.objects.filter(descendant_artifact=artifact)
+        }
+
+    def test_rows(self):
+        self.assertEqual(self._ancestors(self.consensus), {
+            self.reads.id: (1, self.pipe.id),
+            self.dgroup.id: (2, self.basecalling.id),
+            self.library.id: (3, self.run.id),
+            self.biosample.id: (4, self.pooling.id),
+        })
+        self.assertEqual(self._ancestors(self.biosample), {})
+
+        descendants = set(models.MajoraArtifactClosure.objects.filter(ancestor_artifact=self.library).values_list('descendant_artifact_id', 'descendant_group_id'))
+        self.assertEqual(descendants, set([(None, self.dgroup.id), (self.reads.id, None), (self.consensus.id, None), (self.consensus2.id, None)]))
+
+    def test_bridge(self):
+        # The other sample on the run does not leak through the shared library and reads
+        self.assertNotIn(self.biosample2.id, self._ancestors(self.consensus))
+        self.assertNotIn(self.biosample.id, self._ancestors(self.consensus2))
+        self.assertEqual(
+                set(models.MajoraArtifactClosure.objects.filter(ancestor_artifact=self.biosample).values_list('descendant_artifact_id', flat=True)),
+                set([self.library.id, self.reads.id, self.consensus.id, None]),
+        )
+
+        # Extending a bridged consensus keeps to its own sample
+        vcf = models.DigitalResourceArtifact(current_name="hoot.vcf", current_path="/hoot/hoot.vcf")
+        vcf.save()
+        process = models.AbstractBioinformaticsProcess(pipe_kind="Hoot", who=self.user, when=self._when(4))
+        process.save()
+        models.MajoraArtifactProcessRecord(process=process, in_artifact=self.consensus, out_artifact=vcf).save()
+        self.assertIn(self.biosample.id, self._ancestors(vcf))
+        self.assertNotIn(self.biosample2.id, self._ancestors(vcf))
+        self.assertEqual(self._ancestors(vcf)[self.library.id], (4, self.run.id))
+
+    def test_edit_record(self):
+        before = closure_rows()
+
+        # Moving the consensus of the second sample to the first rebuilds its rows
+        record = models.MajoraArtifactProcessRecord.objects.get(out_artifact=self.consensus2)
+        record.bridge_artifact = self.biosample
+        record.save()
+        self.assertIn(self.biosample.id, self._ancestors(self.consensus2))
+        self.assertNotIn(self.biosample2.id, self._ancestors(self.consensus2))
+
+        record.bridge_artifact = self.biosample2
+        record.save()
+        self.assertEqual(closure_rows(), before)
+
+        # Repointing a record drops the rows of its old out node
+        other = models.DigitalResourceArtifact(current_name="other.fasta", current_path="/hoot/other.fasta")
+        other.save()
+        record.out_artifact = other
+        record.save()
+        self.assertEqual(self._ancestors(self.consensus2), {})
+        self.assertIn(self.biosample2.id, self._ancestors(other))
+
+    def test_rebuild_command(self):
+        before = closure_rows()
+        models.MajoraArtifactClosure.objects.all().delete()
+
+        out = StringIO()
+        call_command("rebuild_lineage_closure", "--chunk-size", "2", stdout=out)
+        self.assertIn("%d closure rows created" % len(before), out.getvalue())
+        self.assertEqual(closure_rows(), before)
+
+    def test_process_records(self):
+        pag = models.PublishedArtifactGroup(published_name="HOOT/HOOT-00001", published_version=1, published_date=datetime.date.today(), is_latest=True, owner=self.user)
+        pag.save()
+        pag.tagged_artifacts.add(self.consensus)
+
+        records = resty_serializers.RestyPublishedArtifactGroupSerializer(context={}).get_process_records(pag)
+        self.assertEqual(len(records), 3)
+
+    def test_pag_run(self):
+        # The run is found from the closure when the published_name does not carry it
+        pag = models.PublishedArtifactGroup(published_name="HOOT/HOOT-00001", published_version=1, published_date=datetime.date.today(), is_latest=True, owner=self.user)
+        pag.save()
+        pag.tagged_artifacts.add(self.biosample, self.consensus)
+
+        pags = tasks._get_pag_v2_structs([pag.id])
+        self.assertEqual(pags["HOOT/HOOT-00001"]["artifacts"]["sequencing"][0]["run_name"], "HOOT-RUN")
+
+    def test_connected_artifacts(self):
+        artifacts = lineage.connected_artifacts(self.library)
+        self.assertEqual(set(artifacts), set([self.consensus, self.consensus2, self.reads, self.biosample, self.biosample2]))
@@ -0,0 +1,47 @@
+from django.test import TestCase, Client
+
+from majora2 import models
+from majora2 import util
+
+class BufferedFactTest(TestCase):
+    def setUp(self):
+        util.flush_facts() # drop anything left over from other tests
+        models.MajoraFact.objects.all().delete()
+
+    def _counter(self):
+        fact = models.MajoraFact.objects.filter(namespace="hoot", key="hoots").first()
+        return fact.counter if fact else None
+
+    def test_buffer_fact_flushes_on_count(self):
+        with self.settings(MAJORA_FACT_FLUSH_COUNT=3, MAJORA_FACT_FLUSH_INTERVAL=3600):
+            util.buffer_fact(namespace="hoot", key="hoots")
+            util.buffer_fact(namespace="hoot", key="hoots")
+            self.assertIsNone(self._counter())
+
+            util.buffer_fact(namespace="hoot", key="hoots")
+            self.assertEqual(self._counter(), 3)
+
+            util.buffer_fact(namespace="hoot", key="hoots", delta=2)
+            self.assertEqual(self._counter(), 3)
+
+    def test_facts_view_reads_buffered_counts(self):
+        with self.settings(MAJORA_FACT_FLUSH_COUNT=100, MAJORA_FACT_FLUSH_INTERVAL=3600):
+            for i in range(5):
+                util.buffer_fact(namespace="hoot", key="hoots")
+            self.assertIsNone(self._counter())
+
+            response = Client().get("/public/facts", secure=True)
+            self.assertEqual(200, response.status_code)
+            facts = {(x["namespace"], x["key"]): x["counter"] for x in response.json()}
+            self.assertEqual(facts[("hoot", "hoots")], 5)
+
+    def test_buffer_fact_flushes_after_response(self):
+        with self.settings(MAJORA_FACT_FLUSH_COUNT=100, MAJORA_FACT_FLUSH_INTERVAL=3600):
+            util.buffer_fact(namespace="hoot", key="hoots")
+            Client().get("/hoot/", secure=True)
+            self.assertIsNone(self._counter())
+
+        # Counts older than the interval are written once any response is ready
+        with self.settings(MAJORA_FACT_FLUSH_COUNT=100, MAJORA_FACT_FLUSH_INTERVAL=0):
+            Client().get("/hoot/", secure=True)
+            self.assertEqual(self._counter(), 1)
@@ -0,0 +1,70 @@
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from majora2 import models
+from majora2 import instances
+from majora2.test.util import create_full_user
+
+class ResolveRelatedTest(TestCase):
+    def setUp(self):
+        self.user = create_full_user("hoot")
+        self.source = models.BiosampleSource(dice_name="HOOTSRC", source_type="human")
+        self.source.save()
+        self.library = models.LibraryArtifact(dice_name="HOOT-LIB")
+        self.library.save()
+        self.pooling = models.LibraryPoolingProcess(who=self.user, when=timezone.now())
+        self.pooling.save()
+        self.library.created = self.pooling
+        self.library.save()
+
+        self.biosamples = []
+        for i in range(5):
+            self._add_biosample(i)
+
+    def _add_biosample(self, i):
+        sampling = models.BiosourceSamplingProcess(who=self.user, when=timezone.now())
+        sampling.save()
+        biosample = models.BiosampleArtifact(central_sample_id="HOOT-%05d" % i, dice_name="HOOT-%05d" % i, created=sampling)
+        biosample.save()
+        models.BiosourceSamplingProcessRecord(process=sampling, in_group=self.source, out_artifact=biosample).save()
+        models.LibraryPoolingProcessRecord(process=self.pooling, in_artifact=biosample, out_artifact=self.library).save()
+        self.biosamples.append(biosample)
+
+    def test_real_instances(self):
+        base = list(models.MajoraArtifact.objects.non_polymorphic().filter(id__in=[self.library.id, self.biosamples[0].id]).order_by('dice_name'))
+        self.assertEqual([type(x) for x in base], [models.MajoraArtifact, models.MajoraArtifact])
+        with CaptureQueriesContext(connection) as queries:
+            real = instances.real_instances(base + [None])
+        self.assertEqual(real, [self.biosamples[0], self.library, None])
+        self.assertEqual([type(x) for x in real[:2]], [models.BiosampleArtifact, models.LibraryArtifact])
+        self.assertEqual(len(queries), 2)
+
+    def test_resolve_related(self):
+        with CaptureQueriesContext(connection) as queries:
+            records = models.MajoraArtifactProcessRecord.objects.non_polymorphic().resolve_related('process', 'in_artifact__created', 'in_group', 'out_artifact')
+        # The records, then a query for the base rows of each key and one for each subclass:
+        # processes (pooling, sampling), artifacts (library, biosample), groups (source) and created (sampling)
+        self.assertEqual(len(queries), 1 + 3 + 3 + 2 + 2)
+
+        with CaptureQueriesContext(connection) as queries:
+            for record in records:
+                self.assertNotEqual(type(record.process), models.MajoraArtifactProcess)
+                self.assertNotEqual(type(record.out_artifact), models.MajoraArtifact)
+                if record.in_artifact:
+                    self.assertIsInstance(record.in_artifact, models.BiosampleArtifact)
+                    self.assertIsInstance(record.in_artifact.created, models.BiosourceSamplingProcess)
+                else:
+                    self.assertIsInstance(record.in_group, models.BiosampleSource)
+        self.assertEqual(len(queries), 0)
+
+    def test_ordered_artifacts(self):
+        with CaptureQueriesContext(connection) as few:
+            self.pooling.ordered_artifacts
+        for i in range(5, 10):
+            self._add_biosample(i)
+        with CaptureQueriesContext(connection) as many:
+            ordered = self.pooling.ordered_artifacts
+        self.assertEqual(len(few), len(many))
+        self.assertEqual(ordered[models.BiosampleArtifact().kind], set(self.biosamples))
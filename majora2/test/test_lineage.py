@@ -0,0 +1,186 @@
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from majora2 import models
+from majora2 import lineage
+from majora2.test.util import create_full_user
+
+import datetime
+
+def recursive_process_tree_up(node):
+    # The one-node-at-a-time process_tree_up that majora2.lineage replaced
+    a = []
+    for proc in node.after_process.all().order_by('-process__when'):
+        if proc.in_group:
+            if proc.process not in a:
+                a.append(proc.process)
+            a.extend(recursive_process_tree_up(proc.in_group))
+        if proc.in_artifact:
+            if proc.process not in a:
+                a.append(proc.process)
+            a.extend(recursive_process_tree_up(proc.in_artifact))
+    return reversed(a)
+
+def recursive_process_tree_down(node, seen, crossed_bridges):
+    # The one-node-at-a-time build_process_tree_down that majora2.lineage replaced
+    a = []
+    is_group = isinstance(node, models.MajoraArtifactGroup)
+    records = list(node.before_process.all().order_by('-process__when'))
+    current_bridges = set([proc.bridge_artifact for proc in records if proc.out_artifact and proc.bridge_artifact])
+    can_cross = len(current_bridges & crossed_bridges) > 0
+    for proc in records:
+        add = 0
+        children = []
+        if proc.out_artifact and proc.out_artifact not in seen:
+            if (proc.bridge_artifact is None) or (proc.bridge_artifact in crossed_bridges) or not can_cross:
+                children.extend(recursive_process_tree_down(proc.out_artifact, seen, crossed_bridges))
+                if is_group:
+                    seen.add(proc.out_artifact)
+                add = 1
+        if proc.out_group and (is_group or proc.out_group not in seen):
+            children.extend(recursive_process_tree_down(proc.out_group, seen, crossed_bridges))
+            add = 1
+            seen.add(proc.out_group)
+        if add:
+            a.append({proc: children})
+    return a
+
+def flatten_tree_down(tree):
+    return [[(proc.id, flatten_tree_down(children)) for proc, children in d.items()] for d in tree]
+
+class ProvenanceGraphTest(TestCase):
+    def setUp(self):
+        self.user = create_full_user("hoot")
+        self.t = timezone.now()
+
+        # source -> biosample -> library -> consensus, with a second library from the same sample
+        self.source = models.BiosampleSource(dice_name="HOOTSRC", source_type="human")
+        self.source.save()
+        self.biosample = models.BiosampleArtifact(central_sample_id="HOOT-00001", dice_name="HOOT-00001")
+        self.biosample.save()
+        sampling = models.BiosourceSamplingProcess(who=self.user, when=self._when(0))
+        sampling.save()
+        models.BiosourceSamplingProcessRecord(process=sampling, in_group=self.source, out_artifact=self.biosample).save()
+
+        self.library = self._library("HOOT-LIB1", [self.biosample], 1)
+        self.library2 = self._library("HOOT-LIB2", [self.biosample], 2)
+
+        self.run = models.DNASequencingProcess(run_name="HOOT-RUN", who=self.user, when=self._when(3))
+        self.run.save()
+        models.DNASequencingProcessRecord(process=self.run, in_artifact=self.library).save()
+        models.DNASequencingProcessRecord(process=self.run, in_artifact=self.library2).save()
+
+        self.consensus = models.DigitalResourceArtifact(current_name="hoot.fasta", current_path="/hoot/hoot.fasta", current_kind="consensus")
+        self.consensus.save()
+        self.pipe = models.AbstractBioinformaticsProcess(pipe_kind="Consensus", who=self.user, when=self._when(4))
+        self.pipe.save()
+        models.MajoraArtifactProcessRecord(process=self.pipe, in_artifact=self.library, out_artifact=self.consensus).save()
+        models.MajoraArtifactProcessRecord(process=self.pipe, in_artifact=self.library2, out_artifact=self.consensus).save()
+
+    def _when(self, days):
+        return self.t + datetime.timedelta(days=days)
+
+    def _library(self, name, biosamples, days):
+        library = models.LibraryArtifact(dice_name=name)
+        library.save()
+        pooling = models.LibraryPoolingProcess(who=self.user, when=self._when(days))
+        pooling.save()
+        for biosample in biosamples:
+            models.LibraryPoolingProcessRecord(process=pooling, in_artifact=biosample, out_artifact=library).save()
+        return library
+
+    def test_process_tree_matches_recursion(self):
+        for node in [self.source, self.biosample, self.library, self.library2, self.consensus]:
+            expected = [p.id for p in recursive_process_tree_up(node)]
+            self.assertEqual([p.id for p in node.process_tree], expected)
+
+        # Processes are resolved to their real instances
+        kinds = set(type(p) for p in self.consensus.process_tree)
+        self.assertEqual(kinds, set([models.BiosourceSamplingProcess, models.LibraryPoolingProcess, models.AbstractBioinformaticsProcess]))
+
+    def test_process_tree_bioinf(self):
+        self.assertEqual([p.process_kind for p in self.consensus.process_tree_bioinf], ["Bioinformatics: Consensus"])
+
+    def test_artifact_tree(self):
+        artifacts = self.consensus.artifact_tree
+        self.assertEqual(set(artifacts), set([self.library, self.library2, self.biosample]))
+        self.assertEqual(len(artifacts), 3)
+        self.assertEqual(set(type(a) for a in artifacts), set([models.LibraryArtifact, models.BiosampleArtifact]))
+
+    def test_query_count_by_depth(self):
+        # Extend the chain with more levels of digital resources
+        parent = self.consensus
+        for i in range(10):
+            child = models.DigitalResourceArtifact(current_name="hoot%d.fasta" % i, current_path="/hoot/hoot%d.fasta" % i)
+            child.save()
+            process = models.AbstractBioinformaticsProcess(pipe_kind="Hoot", who=self.user, when=self._when(5 + i))
+            process.save()
+            models.MajoraArtifactProcessRecord(process=process, in_artifact=parent, out_artifact=child).save()
+            parent = child
+
+        graph = lineage.UpstreamGraph([parent])
+        self.assertEqual(graph.depth, 14)
+        with CaptureQueriesContext(connection) as queries:
+            tree = parent.process_tree
+        # One query per level, then the processes of each kind
+        self.assertEqual(len(queries), graph.depth + 4)
+        self.assertEqual([p.id for p in tree], [p.id for p in recursive_process_tree_up(parent)])
+
+    def test_cycle(self):
+        models.MajoraArtifactProcessRecord(process=self.pipe, in_artifact=self.consensus, out_artifact=self.biosample).save()
+        self.assertIn(self.pipe, self.consensus.process_tree)
+
+    def _extend_down(self, parent, n):
+        for i in range(n):
+            child = models.DigitalResourceArtifact(current_name="down%d.fasta" % i, current_path="/hoot/down%d.fasta" % i)
+            child.save()
+            process = models.AbstractBioinformaticsProcess(pipe_kind="Hoot", who=self.user, when=self._when(5 + i))
+            process.save()
+            models.MajoraArtifactProcessRecord(process=process, in_artifact=parent, out_artifact=child).save()
+            parent = child
+        return parent
+
+    def _check_tree_down(self):
+        for node in [self.source, self.biosample, self.library, self.consensus]:
+            expected = flatten_tree_down(recursive_process_tree_down(node, set([node]), set([node])))
+            self.assertEqual(flatten_tree_down(node.process_tree_down), expected)
+
+    def test_process_tree_down_matches_recursion(self):
+        # Bridge the second library so it is only reached from the biosample side
+        for i, (out_artifact, bridge_artifact) in enumerate([(self.consensus, self.biosample), (self.library2, self.library)]):
+            process = models.AbstractBioinformaticsProcess(pipe_kind="Bridge", who=self.user, when=self._when(20 + i))
+            process.save()
+            models.MajoraArtifactProcessRecord(process=process, in_artifact=self.biosample, out_artifact=out_artifact, bridge_artifact=bridge_artifact).save()
+        self._extend_down(self.consensus, 3)
+
+        self._check_tree_down()
+        with self.settings(MAJORA_LINEAGE_USE_CTE=False):
+            self._check_tree_down()
+
+        tree = self.source.process_tree_down
+        record = list(tree[0].keys())[0]
+        self.assertIsInstance(record.out_artifact, models.BiosampleArtifact)
+        self.assertIsInstance(record.process, models.BiosourceSamplingProcess)
+
+    def test_process_tree_down_query_count(self):
+        self._extend_down(self.consensus, 2)
+        with CaptureQueriesContext(connection) as shallow:
+            self.biosample.process_tree_down
+        self._extend_down(self.consensus, 10)
+        with CaptureQueriesContext(connection) as deep:
+            tree = self.biosample.process_tree_down
+        self.assertEqual(len(shallow), len(deep))
+
+        # Rendering the tree does not need anything else
+        with CaptureQueriesContext(connection) as render:
+            def visit(tree):
+                for d in tree:
+                    for proc, children in d.items():
+                        proc.out_artifact.artifact_kind if proc.out_artifact else proc.out_group.group_kind
+                        proc.process.process_kind
+                        proc.process.who.profile.institute.code
+                        visit(children)
+            visit(tree)
+        self.assertEqual(len(render), 0)
@@ -0,0 +1,447 @@
+from io import StringIO
+import os
+import tempfile
+import uuid
+
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from unittest.mock import patch
+
+from majora2 import models
+from majora2 import util
+from majora2.test.test_basic_api import OAuthAPIClientBase
+from majora2.test.util import create_full_user
+from tatl import models as tmodels
+
+class MAGPathTest(TestCase):
+    def setUp(self):
+        self.node, created = util.mkroot("hoot")
+
+    def _legacy_mkmag(self, path):
+        # Build a path the way handle_testdigitalresource used to, without a group_path
+        parent = self.node
+        for dir_name in path.split("/"):
+            parent, created = models.DigitalResourceGroup.objects.get_or_create(current_name=dir_name, root_group=self.node, parent_group=parent, physical=True)
+        return parent
+
+    def test_mkmag(self):
+        mags, created = util.mkmag("/a/b/c/d", root=self.node, kind="owl")
+        self.assertEqual(created, [True] * 4)
+        self.assertEqual([g.group_path for g in mags], ["a", "a/b", "a/b/c", "a/b/c/d"])
+        self.assertEqual([g.parent_group for g in mags], [self.node] + mags[:-1])
+        self.assertEqual(mags[-1].temp_kind, "owl")
+        self.assertEqual(mags[-1].group_path_hash, models.hash_group_path("a/b/c/d"))
+        self.assertEqual(mags[-1].group_path_prefix, "a/b/c/d")
+
+        # Only the leading characters of a long path are indexed
+        lpath = ["hoot%02d" % i + "o" * 40 for i in range(8)]
+        long_mags, created = util.mkmag("/" + "/".join(lpath), root=self.node)
+        self.assertEqual(long_mags[-1].group_path_prefix, "/".join(lpath)[:models.GROUP_PATH_PREFIX_LENGTH])
+        self.assertEqual(util.get_mag("hoot", "/".join(lpath), by_hard_path=True), long_mags[-1])
+
+        with CaptureQueriesContext(connection) as queries:
+            again, created = util.mkmag("/a/b/c/d", root=self.node)
+        self.assertEqual(created, [False] * 4)
+        self.assertEqual(again, mags)
+        # One query for the levels, and one for the cache generation
+        self.assertEqual(len(queries), 2)
+
+        deeper, created = util.mkmag("/a/b/c/d/e/file.txt", root=self.node, artifact=True)
+        self.assertEqual(created, [False] * 4 + [True])
+        self.assertEqual(deeper[-1].parent_group, mags[-1])
+
+    def test_get_mag(self):
+        mags, created = util.mkmag("/a/b/c/d/e/f", root=self.node)
+        other, created = util.mkroot("other")
+        util.mkmag("/a/b/c/d/e/f", root=other)
+
+        with CaptureQueriesContext(connection) as queries:
+            mag = util.get_mag("hoot", "/a/b/c/d/e/f", by_hard_path=True, prefetch=False)
+        self.assertEqual(mag, mags[-1])
+        self.assertEqual(len(queries), 1)
+
+        self.assertEqual(util.get_mag("hoot", "/a/b/c/file.txt", artifact=True), mags[2])
+        self.assertEqual(util.get_mag("hoot", "/a/b/c/", by_hard_path=True), mags[2])
+        self.assertIsNone(util.get_mag("hoot", "/a/b/x", by_hard_path=True))
+        self.assertIsNone(util.get_mag("owl", "/a/b/c", by_hard_path=True))
+
+    def test_path(self):
+        mags, created = util.mkmag("/a/b/c/d/e/f", root=self.node)
+        shallow_mag = models.DigitalResourceGroup.objects.get(pk=mags[1].pk)
+        mag = models.DigitalResourceGroup.objects.get(pk=mags[-1].pk)
+        with CaptureQueriesContext(connection) as shallow:
+            self.assertEqual(shallow_mag.path, "hoot://a/b")
+        with CaptureQueriesContext(connection) as deep:
+            self.assertEqual(mag.path, "hoot://a/b/c/d/e/f")
+        self.assertEqual(len(shallow), len(deep))
+        self.assertEqual(mag.hierarchy, [self.node] + mags)
+
+    def test_backfill(self):
+        legacy = self._legacy_mkmag("a/b/c")
+        self.assertIsNone(util.get_mag("hoot", "/a/b/c", by_hard_path=True))
+        self.assertEqual(util.get_mag("hoot", "/a/b/c"), legacy)
+        duplicate = models.DigitalResourceGroup(id=uuid.UUID("ffffffff-ffff-4fff-bfff-ffffffffffff"), current_name="c", root_group=self.node, parent_group=legacy.parent_group, physical=True)
+        duplicate.save()
+
+        out = StringIO()
+        call_command("backfill_mag_paths", "--dry-run", stdout=out)
+        self.assertIn("4 MAGs checked, 3 to update, 1 sharing a path", out.getvalue())
+        self.assertIsNone(util.get_mag("hoot", "/a/b/c", by_hard_path=True))
+
+        out = StringIO()
+        call_command("backfill_mag_paths", stdout=out)
+        self.assertIn("4 MAGs checked, 3 updated, 1 sharing a path", out.getvalue())
+        self.assertEqual(util.get_mag("hoot", "/a/b/c", by_hard_path=True), legacy)
+        self.assertIsNone(models.DigitalResourceGroup.objects.get(pk=duplicate.pk).group_path)
+
+        out = StringIO()
+        call_command("backfill_mag_paths", stdout=out)
+        self.assertIn("0 updated", out.getvalue())
+
+        mags, created = util.mkmag("/a/b/c/d", root=self.node)
+        self.assertEqual(created, [False, False, False, True])
+        self.assertEqual(mags[2], legacy)
+
+    def test_mkmag_claims_legacy(self):
+        legacy = self._legacy_mkmag("a/b/c")
+
+        mags, created = util.mkmag("/a/b/c/d", root=self.node)
+        self.assertEqual(created, [False, False, False, True])
+        self.assertEqual(mags[2], legacy)
+        self.assertEqual(mags[3].parent_group, legacy)
+        self.assertEqual(models.DigitalResourceGroup.objects.filter(root_group=self.node).count(), 4)
+        self.assertEqual([(g.group_path, g.group_path_prefix) for g in models.DigitalResourceGroup.objects.filter(pk__in=[g.pk for g in mags[:3]]).order_by('group_path')], [("a", "a"), ("a/b", "a/b"), ("a/b/c", "a/b/c")])
+        self.assertEqual(util.get_mag("hoot", "/a/b/c", by_hard_path=True), legacy)
+
+        out = StringIO()
+        call_command("backfill_mag_paths", stdout=out)
+        self.assertIn("4 MAGs checked, 0 updated, 0 sharing a path", out.getvalue())
+
+class ShardTest(TestCase):
+    def setUp(self):
+        self.user = create_full_user("hoot")
+        self.node, created = util.mkroot("climb")
+        self.big, created = util.mkmag("/big", root=self.node)
+        self.dras = []
+        for i in range(6):
+            dra = models.DigitalResourceArtifact(current_name="hoot%d.fasta" % i, current_path="/big/hoot%d.fasta" % i, primary_group=self.big[-1])
+            dra.save()
+            self.dras.append(dra)
+
+        fd, self.manifest = tempfile.mkstemp()
+        with os.fdopen(fd, "w") as fh:
+            for i in range(6):
+                fh.write("\t".join([str(int(i != 4)), "/big", "hoot%d.fasta" % i, "/big/%d" % (i % 2), "hoot%d.fasta" % i, "/big/%d/hoot%d.fasta" % (i % 2, i)]) + "\n")
+            fh.write("\t".join(["1", "/small", "owl.fasta", "/big/0", "owl.fasta", "/big/0/owl.fasta"]) + "\n")
+        self.checkpoint = self.manifest + ".ckpt"
+
+    def tearDown(self):
+        for path in [self.manifest, self.checkpoint + ".0-7", self.checkpoint + ".2-4"]:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def _shard(self, *args):
+        out = StringIO()
+        call_command("shard_bigfdir", "--filename", self.manifest, "--username", "hoot", "--view-name", "hoot", "--chunk-size", "2", "--checkpoint", self.checkpoint, *args, stdout=out)
+        return out.getvalue()
+
+    def test_shard(self):
+        # A range only touches its own lines, and every move is logged
+        with self.assertLogs("majora", level="INFO") as logs:
+            self.assertIn("2 manifest lines read, 2 files moved", self._shard("--start", "2", "--end", "4"))
+        self.assertEqual(len([line for line in logs.output if "[VERB]" in line and "verb=UPDATE" in line]), 2)
+        moved = {dra.current_name: dra for dra in models.DigitalResourceArtifact.objects.filter(current_path__startswith="/big/")}
+        self.assertEqual(moved["hoot2.fasta"].current_path, "/big/0/hoot2.fasta")
+        self.assertEqual(moved["hoot0.fasta"].primary_group, self.big[-1])
+        with open(self.checkpoint + ".2-4") as fh:
+            self.assertEqual(fh.read().strip(), "4")
+
+        # The whole manifest is a new range, the files moved above are no longer in their old MAG
+        self.assertIn("7 manifest lines read, 3 files moved", self._shard())
+        for dra in models.DigitalResourceArtifact.objects.filter(pk__in=[dra.pk for dra in self.dras]):
+            i = int(dra.current_name[4])
+            if i == 4:
+                self.assertEqual(dra.primary_group, self.big[-1])
+            else:
+                self.assertEqual(dra.primary_group.group_path, "big/%d" % (i % 2))
+                self.assertEqual(dra.current_path, "/big/%d/%s" % (i % 2, dra.current_name))
+        self.assertEqual(tmodels.TatlVerb.objects.filter(verb="UPDATE").count(), 5)
+
+        # Finished ranges are not moved again
+        self.assertIn("0 manifest lines read, 0 files moved", self._shard())
+
+class MAGCacheTest(TransactionTestCase):
+    # The caches are only filled once a transaction commits, so these tests run outside of one
+    def setUp(self):
+        util.invalidate_mag_cache()
+        self.node, created = util.mkroot("hoot")
+
+    def tearDown(self):
+        util.invalidate_mag_cache()
+
+    def test_resolve_mag(self):
+        mag = util.resolve_mag(self.node, "/a/b/c/hoot.fasta", artifact=True)
+        self.assertEqual(mag.group_path, "a/b/c")
+        self.assertEqual(mag.parent_group.group_path, "a/b")
+
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(util.resolve_mag(self.node, "/a/b/c/owl.fasta", artifact=True), mag)
+            self.assertEqual(util.resolve_mag(self.node, "/a/b/"), mag.parent_group)
+            self.assertEqual(util.resolve_mag(self.node, "/hoot.fasta", artifact=True), self.node)
+        # Only the cache generation is looked up
+        self.assertEqual(len(queries), 2)
+
+        self.assertIsNone(util.resolve_mag(self.node, "/a/x/y", create=False))
+        self.assertIsNone(util.resolve_mag(self.node, "/a/x/y", create=False))
+
+    def test_get_node(self):
+        self.assertIsNone(util.get_node("owl"))
+        node = util.get_node("owl", create=True)
+        self.assertEqual(node.node_name, "owl")
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(util.get_node("owl"), node)
+            self.assertEqual(util.get_node("owl", create=True), node)
+        self.assertEqual(len(queries), 2)
+
+    def test_nuke_tree(self):
+        mag = util.resolve_mag(self.node, "/a/b")
+        models.DigitalResourceGroup.objects.get(group_path="a").nuke_tree()
+        self.assertEqual(len(util._mag_cache), 0)
+
+        again = util.resolve_mag(self.node, "/a/b")
+        self.assertNotEqual(again.pk, mag.pk)
+
+    def test_other_process_invalidation(self):
+        mag = util.resolve_mag(self.node, "/a/b")
+        self.assertEqual(len(util._mag_cache), 2)
+
+        # Another process nukes the tree, this process still holds its entries but they are out of date
+        entries = list(util._mag_cache._entries.items())
+        models.DigitalResourceGroup.objects.get(group_path="a").nuke_tree()
+        for key, entry in entries:
+            util._mag_cache._entries[key] = entry
+
+        again = util.resolve_mag(self.node, "/a/b")
+        self.assertNotEqual(again.pk, mag.pk)
+        self.assertTrue(models.DigitalResourceGroup.objects.filter(pk=again.pk).exists())
+
+    def test_bounds(self):
+        with self.settings(MAJORA_MAG_CACHE_SIZE=2):
+            util.resolve_mag(self.node, "/a/b/c")
+            self.assertEqual(len(util._mag_cache), 2)
+
+        util.invalidate_mag_cache()
+        with self.settings(MAJORA_MAG_CACHE_TTL=0):
+            util.resolve_mag(self.node, "/a/b/c")
+            self.assertEqual(len(util._mag_cache), 0)
+            with CaptureQueriesContext(connection) as queries:
+                util.resolve_mag(self.node, "/a/b/c")
+            self.assertEqual(len(queries), 2)
+
+class OAuthFileAddTest(OAuthAPIClientBase):
+    def setUp(self):
+        super().setUp()
+        self.endpoint = reverse("api.artifact.file.add")
+        self.token = self._get_token("majora2.add_digitalresourceartifact majora2.change_digitalresourceartifact")
+
+    def tearDown(self):
+        # Requests commit, so drop the nodes and MAGs they cached before the database is flushed
+        util.invalidate_mag_cache()
+
+    def _add(self, path, **kwargs):
+        payload = {
+            "path": path,
+            "sep": "/",
+            "current_name": path.split("/")[-1],
+            "current_fext": "fasta",
+            "current_hash": "0" * 32,
+            "current_size": 29903,
+            "resource_type": "consensus",
+            "pipe_hook": "hoot-pipe",
+            "source_artifact": [],
+            "source_group": [],
+            "token": "oauth",
+            "username": "oauth",
+        }
+        payload.update(kwargs)
+        response = self.c.post(self.endpoint, payload, secure=True, content_type="application/json", HTTP_AUTHORIZATION="Bearer %s" % self.token)
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(response.json()["errors"], 0)
+        return models.DigitalResourceArtifact.objects.get(current_path=path)
+
+    def test_add_files(self):
+        hoot = self._add("/hoot/a/b/hoot.fasta")
+        owl = self._add("/hoot/a/b/owl.fasta")
+        self.assertEqual(hoot.primary_group, owl.primary_group)
+        self.assertEqual(hoot.primary_group.group_path, "hoot/a/b")
+        self.assertEqual(hoot.primary_group.root_group, util.get_node(self.user.profile.institute.code))
+
+        # Unknown nodes are rejected by the form
+        response = self.c.post(self.endpoint, {"node_name": "owl", "path": "/hoot.fasta", "token": "oauth", "username": "oauth"}, secure=True, content_type="application/json", HTTP_AUTHORIZATION="Bearer %s" % self.token)
+        self.assertEqual(response.json()["errors"], 1)
+        self.assertIn("node_name", str(response.json()["messages"]))
+
+    def test_add_bridged_file(self):
+        biosample = models.BiosampleArtifact(central_sample_id="HOOT-00001", dice_name="HOOT-00001")
+        biosample.save()
+
+        with patch("majora2.lineage.rebuild_closure") as rebuild_closure:
+            hoot = self._add("/hoot/a/b/hoot.fasta", source_artifact=["HOOT-00001"], bridge_artifact="HOOT-00001")
+            self._add("/hoot/a/b/hoot.fasta", source_artifact=["HOOT-00001"], bridge_artifact="HOOT-00001")
+        self.assertFalse(rebuild_closure.called)
+
+        record = models.MajoraArtifactProcessRecord.objects.get(out_artifact=hoot)
+        self.assertEqual(record.bridge_artifact_id, biosample.pk)
+        self.assertEqual(list(models.MajoraArtifactClosure.objects.filter(descendant_artifact=hoot).values_list("ancestor_artifact_id", "bridge_artifact_id")), [(biosample.pk, biosample.pk)])
+
+class OAuthFileBatchTest(OAuthAPIClientBase):
+    def setUp(self):
+        super().setUp()
+        self.endpoint = reverse("api.artifact.file.batch")
+        self.token = self._get_token("majora2.add_digitalresourceartifact majora2.change_digitalresourceartifact")
+        self.biosample = models.BiosampleArtifact(central_sample_id="HOOT-00001", dice_name="HOOT-00001")
+        self.biosample.save()
+
+    def tearDown(self):
+        util.invalidate_mag_cache()
+
+    def _file(self, path, **kwargs):
+        f = {
+            "path": path,
+            "current_name": path.split("/")[-1],
+            "current_fext": path.split(".")[-1],
+            "current_hash": "0" * 32,
+            "current_size": 29903,
+            "resource_type": "consensus",
+            "source_artifact": ["HOOT-00001"],
+            "bridge_artifact": "HOOT-00001",
+            "publish_group": "HOOT/HOOT-00001",
+        }
+        f.update(kwargs)
+        return f
+
+    def _batch(self, files):
+        payload = {
+            "sep": "/",
+            "pipe_hook": "hoot-pipe",
+            "files": files,
+            "token": "oauth",
+            "username": "oauth",
+        }
+        response = self.c.post(self.endpoint, payload, secure=True, content_type="application/json", HTTP_AUTHORIZATION="Bearer %s" % self.token)
+        self.assertEqual(200, response.status_code)
+        return response.json()
+
+    def test_batch(self):
+        j = self._batch([
+            self._file("/hoot/a/hoot.fasta"),
+            self._file("/hoot/a/hoot.bam"),
+            self._file("/hoot/b/owl.fasta", publish_group=None, source_artifact=[], bridge_artifact=None),
+            self._file("/hoot/a/bad.fasta", current_hash=None),
+            self._file("/hoot/a/owl.fasta", source_artifact=["OWL-00001"]),
+            "hoot",
+        ])
+        self.assertEqual([f["status"] for f in j["files"]], ["created", "created", "created", "invalid", "invalid", "invalid"])
+        self.assertEqual(j["errors"], 3)
+        self.assertEqual(len(j["new"]), 4) # three files and a PAG
+
+        fasta = models.DigitalResourceArtifact.objects.get(id=j["files"][0]["id"])
+        bam = models.DigitalResourceArtifact.objects.get(id=j["files"][1]["id"])
+        self.assertEqual(fasta.primary_group, bam.primary_group)
+        self.assertEqual(fasta.primary_group.group_path, "hoot/a")
+        self.assertEqual(fasta.created.hook_name, "hoot-pipe")
+        self.assertIsNone(models.DigitalResourceArtifact.objects.get(id=j["files"][2]["id"]).created)
+        self.assertFalse(models.DigitalResourceArtifact.objects.filter(current_name="owl.fasta", primary_group=fasta.primary_group).exists())
+
+        records = models.MajoraArtifactProcessRecord.objects.filter(out_artifact__in=[fasta, bam])
+        self.assertEqual(len(records), 2)
+        self.assertEqual(set(r.bridge_artifact for r in records), set([self.biosample]))
+        self.assertTrue(models.MajoraArtifactClosure.objects.filter(ancestor_artifact=self.biosample, descendant_artifact=fasta).exists())
+
+        pag = models.PublishedArtifactGroup.objects.get(published_name="HOOT/HOOT-00001")
+        self.assertEqual(set(pag.tagged_artifacts.all()), set([self.biosample, fasta, bam]))
+        self.assertIsNotNone(pag.published_date)
+        self.assertEqual(pag.owner, self.user)
+
+        # Registering again only updates what changed, and does not duplicate records or tags
+        j = self._batch([
+            self._file("/hoot/a/hoot.fasta", current_hash="1" * 32),
+            self._file("/hoot/a/hoot.bam"),
+        ])
+        self.assertEqual([f["status"] for f in j["files"]], ["updated", "unchanged"])
+        self.assertEqual(j["errors"], 0)
+        self.assertEqual(models.DigitalResourceArtifact.objects.get(id=fasta.id).current_hash, "1" * 32)
+        self.assertEqual(models.MajoraArtifactProcessRecord.objects.filter(out_artifact__in=[fasta, bam]).count(), 2)
+        self.assertEqual(pag.tagged_artifacts.count(), 3)
+
+    def test_batch_pag_owner(self):
+        # As handle_testdigitalresource, the PAG belongs to the user of the process that created the file
+        owl = User.objects.create(username="owl")
+        process = models.AbstractBioinformaticsProcess(hook_name="owl-pipe", who=owl, when=timezone.now())
+        process.save()
+        res = models.DigitalResourceArtifact(id=uuid.uuid4(), current_name="owl.fasta", created=process)
+        res.save()
+
+        j = self._batch([self._file("/hoot/c/owl.fasta", artifact_uuid=str(res.id), source_artifact=[], bridge_artifact=None, publish_group="OWL/OWL-00001")])
+        self.assertEqual(j["errors"], 0)
+        pag = models.PublishedArtifactGroup.objects.get(published_name="OWL/OWL-00001")
+        self.assertEqual(pag.owner, owl)
+        self.assertEqual(set(pag.tagged_artifacts.all()), set([res]))
+
+    def test_limits(self):
+        self.assertEqual(self._batch([])["errors"], 1)
+        with self.settings(MAJORA_FILE_BATCH_MAX=1):
+            j = self._batch([self._file("/hoot/a/hoot.fasta"), self._file("/hoot/a/hoot.bam")])
+        self.assertEqual(j["errors"], 1)
+        self.assertFalse(models.DigitalResourceArtifact.objects.exists())
+
+class OAuthMAGListTest(OAuthAPIClientBase):
+    def setUp(self):
+        super().setUp()
+        self.endpoint = reverse("api.group.mag.list")
+        self.token = self._get_token("majora2.view_majoraartifact")
+        self.node, created = util.mkroot("hoot")
+        for d in ["a/b", "a/c", "a/d/e"]:
+            util.mkmag("/" + d, root=self.node)
+        self.a = util.get_mag("hoot", "/a", by_hard_path=True)
+        for path in ["/a/x.fasta", "/a/y.fasta", "/a/b/z.fasta", "/a/d/e/w.fasta"]:
+            parent = util.get_mag("hoot", path, artifact=True, by_hard_path=True)
+            models.DigitalResourceArtifact(current_name=path.split("/")[-1], current_path=path, primary_group=parent).save()
+
+    def tearDown(self):
+        util.invalidate_mag_cache()
+
+    def _list(self, **kwargs):
+        payload = {"token": "oauth", "username": "oauth"}
+        payload.update(kwargs)
+        response = self.c.post(self.endpoint, payload, secure=True, content_type="application/json", HTTP_AUTHORIZATION="Bearer %s" % self.token)
+        self.assertEqual(200, response.status_code)
+        return response.json()
+
+    def _pages(self, **kwargs):
+        pages = [self._list(**kwargs)]
+        while pages[-1]["cursor"]:
+            pages.append(self._list(cursor=pages[-1]["cursor"], page_size=kwargs.get("page_size")))
+        self.assertEqual(sum(page["errors"] for page in pages), 0)
+        return pages
+
+    def test_list(self):
+        pages = self._pages(path="hoot://a", page_size=2)
+        self.assertEqual(len(pages), 3)
+        self.assertEqual(pages[0]["mag"]["id"], str(self.a.id))
+        self.assertEqual([[g["current_name"] for g in page["groups"]] for page in pages], [["b", "c"], ["d"], []])
+        self.assertEqual([[a["current_name"] for a in page["artifacts"]] for page in pages], [[], ["x.fasta"], ["y.fasta"]])
+
+        pages = self._pages(path="hoot://a", recursive=True, page_size=3)
+        self.assertEqual(sorted(g["group_path"] for page in pages for g in page["groups"]), ["a/b", "a/c", "a/d", "a/d/e"])
+        self.assertEqual(sorted(a["current_path"] for page in pages for a in page["artifacts"]), ["/a/b/z.fasta", "/a/d/e/w.fasta", "/a/x.fasta", "/a/y.fasta"])
+
+    def test_errors(self):
+        self.assertEqual(self._list(path="hoot://a/q")["errors"], 1)
+        self.assertEqual(self._list(path="hoot://a", page_size=0)["errors"], 1)
+        self.assertEqual(self._list(cursor="hoot")["errors"], 1)
@@ -0,0 +1,59 @@
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from majora2 import models
+from majora2.api_views import handle_metadata
+from majora2.test.test_basic_api import OAuthAPIClientBase
+from majora2.test.util import new_api_o
+
+class HandleMetadataTest(OAuthAPIClientBase):
+    def setUp(self):
+        super().setUp()
+        self.biosample = models.BiosampleArtifact(central_sample_id="HOOT-00001", dice_name="HOOT-00001")
+        self.biosample.save()
+
+    def test_metadata_upsert(self):
+        api_o = new_api_o()
+        changed = handle_metadata({"hoot": {"volume": "loud", "hoots": 8}, "investigation": {"name": "owl"}}, "artifact", "HOOT-00001", self.user, api_o)
+        self.assertEqual(api_o["errors"], 0)
+        self.assertEqual(sorted(changed), ["metadata:hoot.hoots", "metadata:hoot.volume", "metadata:investigation.name"])
+
+        self.assertEqual(self.biosample.get_metadata_as_struct(), {"hoot": {"volume": "loud", "hoots": "8"}})
+        self.assertTrue(models.MajoraMetaRecord.objects.get(meta_tag="investigation", meta_name="name").restricted)
+        self.assertEqual(models.MajoraMetaRecord.objects.filter(artifact=self.biosample).count(), 3)
+        self.assertTrue(all(type(mr) is models.MajoraMetaRecord for mr in models.MajoraMetaRecord.objects.all()))
+
+        # Only changed values are reported and written
+        ts = models.MajoraMetaRecord.objects.get(meta_tag="hoot", meta_name="hoots").timestamp
+        api_o = new_api_o()
+        changed = handle_metadata({"hoot": {"volume": "quiet", "hoots": 8}, "owl": {"kind": "tawny"}}, "artifact", "HOOT-00001", self.user, api_o)
+        self.assertEqual(api_o["errors"], 0)
+        self.assertEqual(sorted(changed), ["metadata:hoot.volume", "metadata:owl.kind"])
+        self.assertEqual(models.MajoraMetaRecord.objects.filter(artifact=self.biosample).count(), 4)
+        self.assertEqual(models.MajoraMetaRecord.objects.get(meta_tag="hoot", meta_name="volume").value, "quiet")
+        self.assertEqual(models.MajoraMetaRecord.objects.get(meta_tag="hoot", meta_name="hoots").timestamp, ts)
+
+    def test_metadata_query_count(self):
+        handle_metadata({"hoot": {"warm": "up"}}, "artifact", "HOOT-00001", self.user, new_api_o())
+
+        with CaptureQueriesContext(connection) as one_key:
+            handle_metadata({"hoot": {"a": "1"}}, "artifact", "HOOT-00001", self.user, new_api_o())
+        with CaptureQueriesContext(connection) as many_keys:
+            handle_metadata({"hoot": {"b%d" % i: str(i) for i in range(10)}, "owl": {"a": "2"}}, "artifact", "HOOT-00001", self.user, new_api_o())
+        self.assertEqual(len(one_key), len(many_keys))
+
+    def test_metadata_bad_value(self):
+        api_o = new_api_o()
+        changed = handle_metadata({"hoot": {"volume": "loud", "essay": "h" * 129}}, "artifact", "HOOT-00001", self.user, api_o)
+        self.assertEqual(api_o["errors"], 1)
+        self.assertEqual(api_o["ignored"], ["metadata__hoot__essay"])
+        self.assertEqual(changed, ["metadata:hoot.volume"])
+
+    def test_metadata_bad_target(self):
+        api_o = new_api_o()
+        changed = handle_metadata({"hoot": {"volume": "loud"}}, "artifact", "HOOT-00002", self.user, api_o)
+        self.assertEqual(api_o["errors"], 1)
+        self.assertEqual(api_o["ignored"], ["metadata__hoot__volume"])
+        self.assertIn("artifact", api_o["messages"][0])
+        self.assertEqual(changed, [])
+        self.assertEqual(models.MajoraMetaRecord.objects.count(), 0)
@@ -0,0 +1,87 @@
+from io import StringIO
+
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+
+from majora2 import api_views
+from majora2 import metric_store
+from majora2 import models
+from majora2.test.util import add_sequence_metric
+
+class MetricStoreTest(TestCase):
+    def setUp(self):
+        self.artifacts = []
+        for dice_name in ["HOOT-00001", "HOOT-00002"]:
+            artifact = models.BiosampleArtifact(central_sample_id=dice_name, dice_name=dice_name)
+            artifact.save()
+            self.artifacts.append(artifact)
+
+    def _ct(self, artifact, min_ct, max_ct):
+        ct = models.TemporaryMajoraArtifactMetric_ThresholdCycle(artifact=artifact, namespace="ct", num_tests=2, min_ct=min_ct, max_ct=max_ct)
+        ct.save()
+        return ct
+
+    def test_write_through(self):
+        sequence = add_sequence_metric(self.artifacts[0], pc_acgt=98.0, longest_gap=10)
+        ct = self._ct(self.artifacts[0], 20.0, 25.0)
+
+        row = models.MajoraArtifactMetricStore.objects.get(artifact=self.artifacts[0])
+        self.assertEqual((row.sequence_pc_acgt, row.sequence_longest_gap, row.ct_min_ct, row.ct_max_ct), (98.0, 10, 20.0, 25.0))
+        self.assertIsNone(row.mapping_num_pos)
+        self.assertFalse(models.MajoraArtifactMetricStore.objects.filter(artifact=self.artifacts[1]).exists())
+
+        ct.min_ct = 18.0
+        ct.save()
+        self.assertEqual(models.MajoraArtifactMetricStore.objects.get(artifact=self.artifacts[0]).ct_min_ct, 18.0)
+
+        # Deletes are written through once committed, refresh drops what a metric leaves behind
+        sequence.delete()
+        metric_store.refresh([self.artifacts[0].id])
+        row = models.MajoraArtifactMetricStore.objects.get(artifact=self.artifacts[0])
+        self.assertEqual((row.sequence_pc_acgt, row.ct_min_ct), (None, 18.0))
+        ct.delete()
+        metric_store.refresh([self.artifacts[0].id])
+        self.assertFalse(models.MajoraArtifactMetricStore.objects.exists())
+
+    def test_deferred(self):
+        with CaptureQueriesContext(connection) as queries:
+            with metric_store.deferred():
+                add_sequence_metric(self.artifacts[0])
+                add_sequence_metric(self.artifacts[1])
+                self._ct(self.artifacts[0], 20.0, 25.0)
+                self.assertFalse(models.MajoraArtifactMetricStore.objects.exists())
+        self.assertEqual(models.MajoraArtifactMetricStore.objects.count(), 2)
+        self.assertEqual(len([q for q in queries.captured_queries if "majoraartifactmetricstore" in q["sql"].lower() and q["sql"].startswith("INSERT")]), 1)
+
+    def test_get_structs(self):
+        sequence = add_sequence_metric(self.artifacts[0], longest_gap=10)
+        self._ct(self.artifacts[0], 20.0, 25.0)
+        structs = metric_store.get_structs([artifact.id for artifact in self.artifacts])
+        self.assertEqual(structs, {
+            self.artifacts[0].id: {
+                "sequence": (sequence.as_struct(), 1),
+                "ct": ({"num_tests": 2, "min_ct": 20.0, "max_ct": 25.0}, 1),
+            },
+        })
+
+        # A second metric of the same kind is counted, but only the first is copied
+        add_sequence_metric(self.artifacts[0], pc_acgt=50.0)
+        struct, n_metrics = metric_store.get_structs([self.artifacts[0].id])[self.artifacts[0].id]["sequence"]
+        self.assertEqual((struct["pc_acgt"], n_metrics), (99.0, 2))
+
+    def test_rebuild(self):
+        add_sequence_metric(self.artifacts[0])
+        add_sequence_metric(self.artifacts[1], pc_acgt=80.0)
+        models.MajoraArtifactMetricStore.objects.all().delete()
+
+        out = StringIO()
+        call_command("rebuild_metric_store", "--chunk-size", "1", stdout=out)
+        self.assertIn("2 artifacts with metrics, 2 store rows written", out.getvalue())
+        self.assertEqual(models.MajoraArtifactMetricStore.objects.get(artifact=self.artifacts[1]).sequence_pc_acgt, 80.0)
+
+    def test_namespaces_match_api(self):
+        # Structs are keyed by the namespace the API writes each metric model with
+        namespaces = {model: namespace for namespace, (model, form) in api_views.METRIC_FORMS.items()}
+        self.assertEqual({model: namespace for model, prefix, namespace, fields in metric_store.SOURCES if namespace}, namespaces)
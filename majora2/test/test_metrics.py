@@ -0,0 +1,95 @@
+from unittest.mock import patch
+
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from majora2 import models
+from majora2.test.test_basic_api import BasicAPIBase
+
+def ct_records(*ct_values):
+    return {i: {"test_platform": "INHOUSE", "test_target": target, "test_kit": "INHOUSE", "ct_value": ct_value} for i, (target, ct_value) in enumerate(ct_values)}
+
+class MetricBatchTest(BasicAPIBase):
+    def setUp(self):
+        super().setUp()
+        self.samples = []
+        for central_sample_id in ["HOOT-00001", "HOOT-00002", "HOOT-00003"]:
+            biosample = models.BiosampleArtifact(central_sample_id=central_sample_id, dice_name=central_sample_id)
+            biosample.save()
+            self.samples.append(biosample)
+
+    def _add(self, artifacts, expected_errors=0):
+        payload = {"artifacts": artifacts, "username": self.user.username, "token": self.key.key, "client_name": "pytest", "client_version": 1}
+        response = self.c.post(reverse("api.meta.metric.batch"), payload, secure=True, content_type="application/json")
+        self.assertEqual(200, response.status_code)
+        j = response.json()
+        self.assertEqual(j["errors"], expected_errors)
+        return j
+
+    def _ct(self, biosample):
+        return models.TemporaryMajoraArtifactMetric_ThresholdCycle.objects.get(artifact=biosample)
+
+    def test_add_metrics_batch(self):
+        j = self._add([
+            {"artifact": "HOOT-00001", "metrics": {"ct": {"records": ct_records(("S", 25), ("E", 20), ("N", None))}}},
+            {"artifact": "HOOT-00002", "metrics": {
+                "ct": {"records": ct_records(("S", 30))},
+                "sequence": {"num_seqs": 1, "num_bases": 29903, "pc_acgt": 99.0, "pc_masked": 1.0, "pc_invalid": 0.0},
+                "hoots": {},
+            }},
+            {"artifact": "HOOT-NOPE", "metrics": {"ct": {"records": ct_records(("S", 30))}}},
+            {"metrics": {}},
+        ], expected_errors=2)
+        self.assertIn(["HOOT-NOPE", ""], j["ignored"])
+        self.assertIn("ct:2", j["ignored"])
+        self.assertIn("'hoots' does not describe a valid metric", j["messages"])
+
+        ct = self._ct(self.samples[0])
+        self.assertEqual((ct.num_tests, ct.min_ct, ct.max_ct), (2, 20, 25))
+        ct = self._ct(self.samples[1])
+        self.assertEqual((ct.num_tests, ct.min_ct, ct.max_ct), (1, 30, 30))
+        self.assertEqual(models.TemporaryMajoraArtifactMetric_Sequence.objects.get(artifact=self.samples[1]).pc_acgt, 99.0)
+
+        # Sending the records again replaces them
+        j = self._add([{"artifact": "HOOT-00001", "metrics": {"ct": {"records": ct_records(("S", 18))}}}])
+        self.assertIn("2 existing Ct value records deleted and replaced with new values", j["messages"])
+        ct = self._ct(self.samples[0])
+        self.assertEqual((ct.num_tests, ct.min_ct, ct.max_ct), (1, 18, 18))
+        self.assertEqual(models.TemporaryMajoraArtifactMetricRecord_ThresholdCycle.objects.filter(artifact_metric=ct).count(), 1)
+        self.assertEqual(models.TemporaryMajoraArtifactMetric_ThresholdCycle.objects.count(), 2)
+
+        # The replaced aggregates are written through to the metric store
+        self.assertEqual(models.MajoraArtifactMetricStore.objects.get(artifact=self.samples[0]).ct_min_ct, 18)
+        self.assertEqual(models.MajoraArtifactMetricStore.objects.get(artifact=self.samples[1]).sequence_pc_acgt, 99.0)
+
+    def test_add_metrics_batch_empty_ct(self):
+        j = self._add([{"artifact": "HOOT-00001", "metrics": {"ct": {"records": ct_records(("S", None))}}}])
+        self.assertIn("'ct' records look empty", j["messages"])
+        self.assertFalse(models.TemporaryMajoraArtifactMetric_ThresholdCycle.objects.exists())
+
+    def test_add_metrics_batch_aggregates_once(self):
+        artifacts = [{"artifact": biosample.dice_name, "metrics": {"ct": {"records": ct_records(("S", 20 + i), ("E", 30 + i))}}} for i, biosample in enumerate(self.samples)]
+        self._add(artifacts)
+
+        # Replacing the records of the whole batch computes the aggregates with one query
+        with CaptureQueriesContext(connection) as queries:
+            self._add(artifacts)
+        self.assertEqual(len([q for q in queries.captured_queries if "MIN(" in q["sql"].upper()]), 1)
+        self.assertEqual(
+                sorted(models.TemporaryMajoraArtifactMetric_ThresholdCycle.objects.values_list('num_tests', 'min_ct', 'max_ct')),
+                [(2, 20, 30), (2, 21, 31), (2, 22, 32)],
+        )
+
+    def test_add_metrics_batch_rolled_back(self):
+        # A failed write leaves nothing behind, and nothing is reported as updated
+        with patch("majora2.metric_store.touch", side_effect=Exception("hoot")):
+            j = self._add([{"artifact": "HOOT-00001", "metrics": {"ct": {"records": ct_records(("S", 20))}}}], expected_errors=1)
+        self.assertIn("hoot", j["messages"])
+        self.assertEqual(j["updated"], [])
+        self.assertFalse(models.TemporaryMajoraArtifactMetric_ThresholdCycle.objects.exists())
+
+    def test_add_metrics_batch_too_many(self):
+        with self.settings(MAJORA_METRIC_BATCH_MAX=2):
+            j = self._add([{"artifact": biosample.dice_name, "metrics": {}} for biosample in self.samples], expected_errors=1)
+        self.assertIn("Too many artifacts, send at most 2 per request", j["messages"])
@@ -0,0 +1,357 @@
+import datetime
+import json
+import os
+import uuid
+
+from django.contrib.auth.models import Permission
+from django.core.serializers.json import DjangoJSONEncoder
+from django.urls import reverse
+from django.utils import timezone
+
+from majora2 import models
+from majora2 import tasks
+from majora2 import util
+from tatl import models as tmodels
+from majora2.test.test_basic_api import OAuthAPIClientBase
+from majora2.test.util import create_sequenced_pag, new_api_o
+
+from django.core.management import call_command
+
+from unittest.mock import patch, MagicMock
+
+class PAGExportBase(OAuthAPIClientBase):
+    def setUp(self):
+        super().setUp()
+
+        self.test_group = models.PAGQualityTestEquivalenceGroup(name="HOOT QC", slug="hoot-qc")
+        self.test_group.save()
+
+    def _make_pag(self, central_sample_id, run_name, is_pass=True):
+        return create_sequenced_pag(self.user, self.test_group, central_sample_id, run_name, is_pass=is_pass)
+
+
+class PAGExportStreamTest(PAGExportBase):
+    def setUp(self):
+        super().setUp()
+        self._make_pag("HOOT-00001", "HOOT-RUN-1")
+        self._make_pag("HOOT-00002", "HOOT-RUN-1")
+        self._make_pag("HOOT-00003", "HOOT-RUN-2", is_pass=False)
+
+    def _read_stream(self, api_o):
+        with open(api_o["get"]["stream"]) as fh:
+            lines = [json.loads(line) for line in fh]
+        os.unlink(api_o["get"]["stream"])
+        return lines
+
+    def test_stream_matches_inmemory_result(self):
+        json_data = {"test_name": "hoot-qc", "pass": True, "fail": True}
+        expected = tasks.task_get_pag_v2(None, new_api_o(), json_data)
+        self.assertEqual(expected["get"]["count"], 3)
+
+        with self.settings(MAJORA_PAG_EXPORT_CHUNK_SIZE=2):
+            api_o = tasks.task_get_pag_v2_stream(None, new_api_o(), json_data)
+        self.assertEqual(api_o["errors"], 0)
+        self.assertEqual(api_o["get"]["count"], 3)
+        self.assertNotIn("result", api_o["get"])
+
+        lines = self._read_stream(api_o)
+        self.assertEqual(
+            sorted(lines, key=lambda x: x["published_name"]),
+            sorted(json.loads(json.dumps(expected["get"]["result"], cls=DjangoJSONEncoder)), key=lambda x: x["published_name"]),
+        )
+
+        pag = [x for x in lines if x["published_name"] == "HOOT/HOOT-00001/HOOT:HOOT-RUN-1"][0]["pag"]
+        self.assertEqual(pag["artifacts"]["sequencing"][0]["run_name"], "HOOT-RUN-1")
+        self.assertEqual(pag["artifacts"]["library"][0]["library_adaptor_barcode"], "HOOT01")
+        self.assertEqual(pag["artifacts"]["consensus"][0]["current_size"], 29903)
+        self.assertEqual(pag["qc_reports"]["hoot_qc"], "PASS")
+
+    def test_stream_respects_qc_options(self):
+        api_o = tasks.task_get_pag_v2_stream(None, new_api_o(), {"test_name": "hoot-qc", "fail": True})
+        lines = self._read_stream(api_o)
+        self.assertEqual(api_o["get"]["count"], 1)
+        self.assertEqual([x["published_name"] for x in lines], ["HOOT/HOOT-00003/HOOT:HOOT-RUN-2"])
+
+    def test_stream_bad_test_name(self):
+        api_o = tasks.task_get_pag_v2_stream(None, new_api_o(), {"test_name": "meow-qc"})
+        self.assertEqual(api_o["errors"], 1)
+        self.assertNotIn("get", api_o)
+
+
+class PAGExportQueryCountTest(PAGExportBase):
+    def test_query_count_does_not_scale_with_runs(self):
+        json_data = {"test_name": "hoot-qc", "pass": True}
+
+        self._make_pag("HOOT-00001", "HOOT-RUN-1")
+        api_o = tasks.task_get_pag_v2(None, new_api_o(), json_data)
+        self.assertEqual(api_o["get"]["count"], 1)
+        base_count = api_o["get"]["query_count"]
+        self.assertTrue(base_count > 0)
+
+        for i in range(2, 6):
+            self._make_pag("HOOT-0000%d" % i, "HOOT-RUN-%d" % i)
+        models.PAGExportDocument.objects.all().delete() # compare two cold exports
+        api_o = tasks.task_get_pag_v2(None, new_api_o(), json_data)
+        self.assertEqual(api_o["get"]["count"], 5)
+        self.assertEqual(api_o["get"]["query_count"], base_count)
+
+        for result in api_o["get"]["result"]:
+            pag = result["pag"]
+            central_sample_id = pag["artifacts"]["biosample"][0]["central_sample_id"]
+            self.assertEqual(pag["artifacts"]["library"][0]["in_artifact__dice_name"], central_sample_id)
+            self.assertEqual(pag["artifacts"]["library"][0]["seq_kit"], "KIT")
+            self.assertNotIn("library_id", pag["artifacts"]["library"][0])
+
+
+class PAGExportRunTest(PAGExportBase):
+    def _sequence(self, pag, run_name, start_time):
+        # Add a run that leads to the consensus of the PAG
+        run, created = models.DNASequencingProcess.objects.get_or_create(run_name=run_name, defaults={"who": self.user, "when": timezone.now()})
+        run.start_time = start_time
+        run.save()
+        library = models.LibraryArtifact.objects.get(dice_name=pag.published_name.split("/")[1] + "-LIB")
+        consensus = pag.tagged_artifacts.get(digitalresourceartifact__isnull=False)
+        models.DNASequencingProcessRecord(process=run, in_artifact=library, out_artifact=consensus).save()
+
+    def _run_name(self, pag):
+        api_o = tasks.task_get_pag_v2(None, new_api_o(), {"test_name": "hoot-qc", "pass": True})
+        result = [x for x in api_o["get"]["result"] if x["published_name"] == pag.published_name][0]["pag"]
+        return result["artifacts"]["sequencing"][0]["run_name"]
+
+    def test_run_named_by_pag(self):
+        pag = self._make_pag("HOOT-00001", "HOOT-RUN-2")
+        now = timezone.now()
+        self._sequence(pag, "HOOT-RUN-1", now - datetime.timedelta(days=1))
+        self._sequence(pag, "HOOT-RUN-2", now)
+        self.assertEqual(self._run_name(pag), "HOOT-RUN-2")
+
+    def test_run_ordered(self):
+        # Without a run in its name, a PAG is matched to the earliest run that leads to it
+        pag = self._make_pag("HOOT-00001", "HOOT-RUN-0")
+        now = timezone.now()
+        self._sequence(pag, "HOOT-RUN-2", now)
+        self._sequence(pag, "HOOT-RUN-1", now - datetime.timedelta(days=1))
+        self._sequence(pag, "HOOT-RUN-3", None)
+        for i in range(3):
+            models.PAGExportDocument.objects.all().delete()
+            self.assertEqual(self._run_name(pag), "HOOT-RUN-1")
+
+
+class PAGExportDocumentTest(PAGExportBase):
+    def setUp(self):
+        super().setUp()
+        self.pag = self._make_pag("HOOT-00001", "HOOT-RUN-1")
+        self._make_pag("HOOT-00002", "HOOT-RUN-1")
+        self.json_data = {"test_name": "hoot-qc", "pass": True}
+
+    def _get_pag(self, api_o, published_name):
+        return [x for x in api_o["get"]["result"] if x["published_name"] == published_name][0]["pag"]
+
+    def test_documents_built_on_export(self):
+        self.assertEqual(models.PAGExportDocument.objects.count(), 0)
+        cold = tasks.task_get_pag_v2(None, new_api_o(), self.json_data)
+        self.assertEqual(models.PAGExportDocument.objects.filter(is_stale=False).count(), 2)
+
+        warm = tasks.task_get_pag_v2(None, new_api_o(), self.json_data)
+        self.assertEqual(warm["get"]["result"], cold["get"]["result"])
+        self.assertTrue(warm["get"]["query_count"] < cold["get"]["query_count"])
+
+    def test_stale_document_rebuilt(self):
+        tasks.task_get_pag_v2(None, new_api_o(), self.json_data)
+
+        consensus = self.pag.tagged_artifacts.get(digitalresourceartifact__isnull=False)
+        models.DigitalResourceArtifact.objects.filter(id=consensus.id).update(current_size=1)
+
+        # Document is served as built until the PAG is marked stale
+        api_o = tasks.task_get_pag_v2(None, new_api_o(), self.json_data)
+        self.assertEqual(self._get_pag(api_o, self.pag.published_name)["artifacts"]["consensus"][0]["current_size"], 29903)
+
+        self.assertEqual(util.mark_pag_exports_stale(artifacts=[consensus.id]), 1)
+        api_o = tasks.task_get_pag_v2(None, new_api_o(), self.json_data)
+        self.assertEqual(self._get_pag(api_o, self.pag.published_name)["artifacts"]["consensus"][0]["current_size"], 1)
+        self.assertFalse(models.PAGExportDocument.objects.get(pag=self.pag).is_stale)
+
+    def test_write_during_first_build(self):
+        # A PAG changed while its first document is being built is rebuilt on the next export
+        build = tasks._get_pag_v2_structs
+        def build_and_write(*args, **kwargs):
+            structs = build(*args, **kwargs)
+            util.mark_pag_exports_stale(pags=[self.pag])
+            return structs
+        with patch("majora2.tasks._get_pag_v2_structs", side_effect=build_and_write):
+            tasks.task_get_pag_v2(None, new_api_o(), self.json_data)
+        self.assertTrue(models.PAGExportDocument.objects.get(pag=self.pag).is_stale)
+        self.assertEqual(models.PAGExportDocument.objects.filter(is_stale=False).count(), 1)
+
+    def test_suppress_marks_stale(self):
+        tasks.task_get_pag_v2(None, new_api_o(), self.json_data)
+        self.user.user_permissions.add(Permission.objects.get(codename="can_suppress_pags_via_api"))
+        token = self._get_token("majora2.can_suppress_pags_via_api")
+
+        payload = {
+            "publish_group": self.pag.published_name,
+            "reason": "WRONG_SEQUENCE",
+            "username": "oauth",
+            "token": "oauth",
+        }
+        response = self.c.post(reverse("api.group.pag.suppress"), payload, secure=True, content_type="application/json", HTTP_AUTHORIZATION="Bearer %s" % token)
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(response.json()["errors"], 0)
+        self.assertTrue(models.PAGExportDocument.objects.get(pag=self.pag).is_stale)
+        self.assertEqual(models.PAGExportDocument.objects.filter(is_stale=True).count(), 1)
+
+    def test_rebuild_command(self):
+        call_command("rebuild_pag_exports", stdout=open(os.devnull, "w"))
+        self.assertEqual(models.PAGExportDocument.objects.filter(is_stale=False).count(), 2)
+        last_built = models.PAGExportDocument.objects.get(pag=self.pag).last_built
+
+        util.mark_pag_exports_stale(pags=[self.pag.id])
+        call_command("rebuild_pag_exports", "--stale-only", stdout=open(os.devnull, "w"))
+        doc = models.PAGExportDocument.objects.get(pag=self.pag)
+        self.assertFalse(doc.is_stale)
+        self.assertTrue(doc.last_built > last_built)
+        self.assertEqual(json.loads(doc.document)["published_name"], self.pag.published_name)
+
+
+class PAGExportChangedSinceTest(PAGExportBase):
+    def setUp(self):
+        super().setUp()
+        self.pag_a = self._make_pag("HOOT-00001", "HOOT-RUN-1")
+        self.pag_b = self._make_pag("HOOT-00002", "HOOT-RUN-1")
+        self.json_data = {"test_name": "hoot-qc", "pass": True}
+
+    def _get_names(self, json_data):
+        with self.settings(MAJORA_PAG_CURSOR_OVERLAP=0):
+            api_o = tasks.task_get_pag_v2(None, new_api_o(), json_data)
+        return api_o, sorted(x["published_name"] for x in api_o["get"]["result"])
+
+    def test_cursor_returns_only_changed_pags(self):
+        api_o, names = self._get_names(self.json_data)
+        self.assertEqual(len(names), 2)
+        cursor = api_o["cursor"]
+
+        # Nothing has changed
+        api_o, names = self._get_names(dict(self.json_data, cursor=cursor))
+        self.assertEqual(api_o["errors"], 0)
+        self.assertEqual(names, [])
+
+        # Re-QC one PAG and accession the other
+        models.PAGQualityReportEquivalenceGroup.objects.filter(pag=self.pag_a).update(last_updated=timezone.now())
+        models.TemporaryAccessionRecord(pag=self.pag_b, service="ENA", primary_accession="HOOT1", is_public=True, public_timestamp=timezone.now()).save()
+        api_o, names = self._get_names(dict(self.json_data, cursor=cursor))
+        self.assertEqual(names, [self.pag_a.published_name, self.pag_b.published_name])
+
+        # New cursor moves past those changes
+        api_o, names = self._get_names(dict(self.json_data, cursor=api_o["cursor"]))
+        self.assertEqual(names, [])
+
+    def test_changed_since_timestamp(self):
+        past = (timezone.now() - datetime.timedelta(days=1)).isoformat()
+        api_o, names = self._get_names(dict(self.json_data, changed_since=past))
+        self.assertEqual(len(names), 2)
+
+        future = (timezone.now() + datetime.timedelta(days=1)).strftime("%Y-%m-%d")
+        api_o, names = self._get_names(dict(self.json_data, changed_since=future))
+        self.assertEqual(names, [])
+
+    def test_bad_cursor(self):
+        api_o = tasks.task_get_pag_v2(None, new_api_o(), dict(self.json_data, cursor="hoot"))
+        self.assertEqual(api_o["errors"], 1)
+        self.assertIn("Invalid 'cursor'", "".join(api_o["messages"]))
+        self.assertEqual(api_o["get"]["count"], 0)
+        self.assertNotIn("cursor", api_o)
+
+    def test_no_cursor_on_error(self):
+        api_o = tasks.task_get_pag_v2(None, new_api_o(), {"test_name": "meow-qc"})
+        self.assertEqual(api_o["errors"], 1)
+        self.assertNotIn("cursor", api_o)
+
+        api_o = tasks.task_get_pag_v2(None, new_api_o(), dict(self.json_data, published_after="hoot"))
+        self.assertEqual(api_o["errors"], 1)
+        self.assertNotIn("cursor", api_o)
+
+    def test_cursor_reports_removed_pags(self):
+        api_o, names = self._get_names(self.json_data)
+        self.assertNotIn("removed", api_o)
+        cursor = api_o["cursor"]
+
+        # Fail one PAG and suppress the other, neither matches the options any more
+        models.PAGQualityReportEquivalenceGroup.objects.filter(pag=self.pag_a).update(is_pass=False, last_updated=timezone.now())
+        models.PublishedArtifactGroup.objects.filter(pk=self.pag_b.pk).update(is_suppressed=True, suppressed_date=timezone.now())
+        api_o, names = self._get_names(dict(self.json_data, cursor=cursor))
+        self.assertEqual(names, [])
+        self.assertEqual(sorted(api_o["removed"]), [self.pag_a.published_name, self.pag_b.published_name])
+
+        # The failed PAG is a change under the fail filter, not a removal
+        api_o, names = self._get_names({"test_name": "hoot-qc", "fail": True, "cursor": cursor})
+        self.assertEqual(names, [self.pag_a.published_name])
+        self.assertEqual(api_o["removed"], [self.pag_b.published_name])
+
+
+class OAuthPAGExportStreamTaskTest(PAGExportBase):
+    def setUp(self):
+        super().setUp()
+        self.endpoint = reverse("api.majora.task.get")
+        self.token = self._get_token("")
+
+        self._make_pag("HOOT-00001", "HOOT-RUN-1")
+        self._make_pag("HOOT-00002", "HOOT-RUN-2")
+
+        self.task_id = uuid.uuid4()
+        tmodels.TatlTask(
+            celery_uuid = self.task_id,
+            task = "task_get_pag_v2_stream",
+            payload = json.dumps({}),
+            timestamp = timezone.now(),
+            request = None,
+            user = self.user,
+        ).save()
+
+    @patch("mylims.celery.app.AsyncResult")
+    def test_task_result_is_streamed(self, task):
+        result = tasks.task_get_pag_v2_stream(None, new_api_o(), {"test_name": "hoot-qc", "pass": True})
+        stream_path = result["get"]["stream"]
+        task.return_value = MagicMock(state="SUCCESS", get=MagicMock(return_value=result))
+
+        payload = {
+            "task_id": self.task_id,
+            "username": "oauth",
+            "token": "oauth",
+        }
+        response = self.c.post(self.endpoint, payload, secure=True, content_type="application/json", HTTP_AUTHORIZATION="Bearer %s" % self.token)
+        self.assertEqual(200, response.status_code)
+        self.assertTrue(response.streaming)
+        self.assertEqual(response["Content-Type"], "application/x-ndjson")
+
+        lines = [json.loads(line) for line in b"".join(response.streaming_content).decode().splitlines()]
+        header = lines[0]
+        self.assertEqual(header["errors"], 0)
+        self.assertEqual(header["task"]["state"], "SUCCESS")
+        self.assertEqual(header["get"]["count"], 2)
+        self.assertEqual(header["get"]["stream"], True)
+        self.assertEqual(sorted(x["published_name"] for x in lines[1:]), [
+            "HOOT/HOOT-00001/HOOT:HOOT-RUN-1",
+            "HOOT/HOOT-00002/HOOT:HOOT-RUN-2",
+        ])
+
+        # Spooled result is removed once it has been read
+        self.assertFalse(os.path.exists(stream_path))
+
+    @patch("mylims.celery.app.AsyncResult")
+    def test_outdated_client_is_bounced(self, task):
+        payload = {
+            "task_id": self.task_id,
+            "username": "oauth",
+            "token": "oauth",
+            "client_name": "ocarina",
+            "client_version": "0.0.1",
+        }
+        response = self.c.post(self.endpoint, payload, secure=True, content_type="application/json", HTTP_AUTHORIZATION="Bearer %s" % self.token)
+        self.assertEqual(200, response.status_code)
+        self.assertFalse(response.streaming)
+        self.assertFalse(task.called)
+
+        j = response.json()
+        self.assertEqual(j["errors"], 1)
+        self.assertFalse(j["success"])
+        self.assertIn("Update your 'ocarina' client", "".join(j["messages"]))
@@ -0,0 +1,222 @@
+from io import StringIO
+
+from django.core.management import call_command
+from django.db import connection
+from django.db.models import F
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from majora2 import models
+from majora2 import qc
+from majora2.test.test_basic_api import OAuthAPIClientBase
+from majora2.test.util import create_full_user, create_sequenced_pag, create_qc_test_group, add_sequence_metric, new_api_o
+
+def decisions(test_data):
+    return {decision.a.rule_name: (result["is_warn"], result["is_fail"]) for tv in test_data for decision, result in test_data[tv]["decisions"].items()}
+
+class QCPlanTest(TestCase):
+    def setUp(self):
+        self.group = create_qc_test_group("hoot-qc")
+
+    def test_compile(self):
+        with CaptureQueriesContext(connection) as queries:
+            plan = qc.compile_plan(self.group)
+        self.assertEqual(len(queries), 5)
+        self.assertEqual([(p.test.slug, p.version.version_number) for p in plan.tests], [("hoot-qc-basic", 2), ("hoot-qc-owl", 1)])
+        self.assertEqual([rule.rule_name for rule in plan.tests[0].rules], ["acgt", "bases"])
+        self.assertEqual(plan.tests[0].thresholds[plan.tests[0].rules[0].pk], (95, None, 90, None))
+
+        with CaptureQueriesContext(connection) as queries:
+            plan.evaluate({"sequence": {"pc_acgt": 99.0, "num_bases": 29903}}, {"hoot": {"kind": "hoot"}}, new_api_o())
+        self.assertEqual(len(queries), 0)
+
+    def test_evaluate(self):
+        plan = qc.compile_plan(self.group)
+        metadata = {"hoot": {"kind": "hoot"}}
+
+        test_data, n_fails, all_skipped = plan.evaluate({"sequence": {"pc_acgt": 99.0, "num_bases": 29903}}, metadata, new_api_o())
+        self.assertEqual((n_fails, all_skipped), (0, False))
+        self.assertEqual(decisions(test_data), {"acgt": (False, False)})
+        self.assertEqual([test_data[tv]["is_skip"] for tv in test_data], [False, True])
+
+        test_data, n_fails, all_skipped = plan.evaluate({"sequence": {"pc_acgt": 92.0, "num_bases": 29903}}, metadata, new_api_o())
+        self.assertEqual(decisions(test_data), {"acgt": (True, False)})
+        test_data, n_fails, all_skipped = plan.evaluate({"sequence": {"pc_acgt": 99.0, "num_bases": 100}}, metadata, new_api_o())
+        self.assertEqual(n_fails, 1)
+
+        # The owl test applies once the filter matches
+        test_data, n_fails, all_skipped = plan.evaluate({"sequence": {"pc_acgt": 99.0, "num_bases": 29903, "longest_gap": 5000}}, {"hoot": {"kind": "owl"}}, new_api_o())
+        self.assertEqual(decisions(test_data), {"acgt": (False, False), "gaps": (False, True)})
+
+        api_o = new_api_o()
+        self.assertIsNone(plan.evaluate({"sequence": {"pc_acgt": 99.0, "num_bases": 29903}}, {}, api_o))
+        self.assertIn("missing required metadata (hoot.kind)", api_o["messages"][0])
+        api_o = new_api_o()
+        self.assertIsNone(plan.evaluate({"sequence": {"pc_acgt": 99.0}}, metadata, api_o))
+        self.assertEqual(api_o["ignored"], ["num_bases"])
+
+class ReQCTest(TestCase):
+    def setUp(self):
+        self.user = create_full_user("hoot")
+        self.group = create_qc_test_group(qc.MINIMAL_QC_SLUG)
+        self.pags = [
+            self._pag("HOOT-00001", 99.0, True),
+            self._pag("HOOT-00002", 80.0, True),
+            self._pag("HOOT-00003", 99.0, False, kind=None),
+        ]
+        models.MajoraFact(namespace="pag", key="minimal_qc_pass", value_type="counter", counter=2).save()
+
+    def _pag(self, central_sample_id, pc_acgt, is_pass, kind="hoot"):
+        pag = create_sequenced_pag(self.user, self.group, central_sample_id, "HOOT-RUN", is_pass=is_pass)
+        consensus = pag.tagged_artifacts.get(dice_name__isnull=True)
+        add_sequence_metric(consensus, pc_acgt=pc_acgt)
+        if kind:
+            models.MajoraMetaRecord(artifact=consensus, meta_tag="hoot", meta_name="kind", value_type="str", value=kind).save()
+        return pag
+
+    def test_gather_inputs(self):
+        with CaptureQueriesContext(connection) as few:
+            qc.gather_inputs([self.pags[0].id])
+        with CaptureQueriesContext(connection) as many:
+            inputs = qc.gather_inputs([pag.id for pag in self.pags])
+        self.assertEqual(len(few), len(many))
+        metrics, metadata, message = inputs[self.pags[1].id]
+        self.assertEqual(metrics["sequence"]["pc_acgt"], 80.0)
+        self.assertEqual(metadata, {"hoot": {"kind": "hoot"}})
+        self.assertIsNone(message)
+
+        # evaluate_batch agrees with evaluating each PAG alone
+        plan = qc.compile_plan(self.group)
+        rows = [inputs[pag.id][:2] for pag in self.pags]
+        together = plan.evaluate_batch(rows, [new_api_o() for row in rows])
+        alone = [plan.evaluate(metrics, metadata, new_api_o()) for metrics, metadata in rows]
+        self.assertEqual([None if x is None else (decisions(x[0]), x[1]) for x in together], [None if x is None else (decisions(x[0]), x[1]) for x in alone])
+        self.assertIsNone(together[2])
+
+    def test_gather_inputs_duplicate_metrics(self):
+        # Two metrics of one kind on the same artifact cannot be QC'd, as neither can be picked
+        add_sequence_metric(self.pags[0].tagged_artifacts.get(dice_name__isnull=True), pc_acgt=50.0)
+        metrics, metadata, message = qc.gather_inputs([self.pags[0].id])[self.pags[0].id]
+        self.assertEqual(message, "Cannot automatically QC a PAG with multiple objects containing the same metric type...")
+
+    def test_dry_run(self):
+        out = StringIO()
+        call_command("rerun_qc", qc.MINIMAL_QC_SLUG, "--dry-run", stdout=out)
+        self.assertIn("HOOT/HOOT-00002/HOOT:HOOT-RUN\tPASS\tFAIL", out.getvalue())
+        self.assertIn("HOOT/HOOT-00003/HOOT:HOOT-RUN\tNOT QC'D", out.getvalue())
+        self.assertIn("3 PAGs evaluated, 1 could not be QC'd, 0 would flip to pass, 1 would flip to fail", out.getvalue())
+        self.assertFalse(models.PAGQualityReport.objects.exists())
+        self.assertEqual(models.PAGQualityReportEquivalenceGroup.objects.filter(is_pass=True).count(), 2)
+
+    def test_rerun(self):
+        out = StringIO()
+        call_command("rerun_qc", qc.MINIMAL_QC_SLUG, "--chunk-size", "2", stdout=out)
+        self.assertIn("1 flipped to fail", out.getvalue())
+        self.assertEqual(
+                dict(models.PAGQualityReportEquivalenceGroup.objects.values_list('pag__published_name', 'is_pass')),
+                {pag.published_name: is_pass for pag, is_pass in zip(self.pags, [True, False, False])},
+        )
+        # Only the PAG that flipped to fail moves the fact
+        self.assertEqual(models.MajoraFact.objects.get(key="minimal_qc_pass").counter, 1)
+
+        # Each QC'd PAG has a report for each test, and the basic test's rules and decision recorded
+        report_gs = models.PAGQualityReportGroup.objects.filter(pag=self.pags[1])
+        self.assertEqual(sorted((g.test_set.slug, g.is_pass, g.is_skip) for g in report_gs), [
+            (qc.MINIMAL_QC_SLUG + "-basic", False, False),
+            (qc.MINIMAL_QC_SLUG + "-owl", False, True),
+        ])
+        decision = models.PAGQualityReportDecisionRecord.objects.get(report__report_group__pag=self.pags[1])
+        self.assertEqual((decision.a.rule.rule_name, decision.b.rule.rule_name, decision.is_fail), ("acgt", "bases", True))
+        self.assertEqual(models.PAGQualityReportRuleRecord.objects.filter(report__report_group__pag=self.pags[1]).count(), 2)
+
+        # Running again reuses the report groups
+        call_command("rerun_qc", qc.MINIMAL_QC_SLUG, stdout=StringIO())
+        self.assertEqual(models.PAGQualityReportGroup.objects.count(), 4)
+        self.assertEqual(models.PAGQualityReport.objects.count(), 8)
+        self.assertEqual(models.MajoraFact.objects.get(key="minimal_qc_pass").counter, 1)
+
+    def test_save_reports(self):
+        plan = qc.compile_plan(self.group)
+        inputs = qc.gather_inputs([pag.id for pag in self.pags])
+        evaluated = []
+        for pag in self.pags[:2]:
+            test_data, n_fails, all_skipped = plan.evaluate(inputs[pag.id][0], inputs[pag.id][1], new_api_o())
+            evaluated.append((pag.id, test_data, n_fails))
+
+        was_pass = qc.save_reports(plan, evaluated)
+        self.assertEqual(was_pass, {self.pags[0].id: True, self.pags[1].id: True})
+
+        # Writing the reports of more PAGs does not cost more queries
+        with CaptureQueriesContext(connection) as few:
+            qc.save_reports(plan, evaluated[:1])
+        with CaptureQueriesContext(connection) as many:
+            was_pass = qc.save_reports(plan, evaluated)
+        self.assertEqual(len(few), len(many))
+        self.assertEqual(was_pass, {self.pags[0].id: True, self.pags[1].id: False})
+
+        # Every passing evaluation adds to the fact, and failing ones leave it alone
+        self.assertEqual(models.MajoraFact.objects.get(key="minimal_qc_pass").counter, 5)
+        self.assertEqual(models.PAGQualityReport.objects.filter(report_group__pag=self.pags[0]).count(), 6)
+
+class OAuthQCTest(OAuthAPIClientBase):
+    def setUp(self):
+        super().setUp()
+        qc.invalidate_plans()
+        self.endpoint = reverse("api.meta.qc.add")
+        self.token = self._get_token("majora2.add_pagqualityreport majora2.change_pagqualityreport")
+        self.group = create_qc_test_group("hoot-qc")
+        self.pag = create_sequenced_pag(self.user, None, "HOOT-00001", "HOOT-RUN")
+        consensus = self.pag.tagged_artifacts.get(dice_name__isnull=True)
+        add_sequence_metric(consensus, pc_acgt=92.0)
+        models.MajoraMetaRecord(artifact=consensus, meta_tag="hoot", meta_name="kind", value_type="str", value="hoot").save()
+
+    def tearDown(self):
+        # Requests commit, so drop the plans they cached before the database is flushed
+        qc.invalidate_plans()
+
+    def _qc(self):
+        payload = {"publish_group": self.pag.published_name, "test_name": "hoot-qc", "test_version": 1, "token": "oauth", "username": "oauth"}
+        response = self.c.post(self.endpoint, payload, secure=True, content_type="application/json", HTTP_AUTHORIZATION="Bearer %s" % self.token)
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(response.json()["errors"], 0)
+        return models.PAGQualityReportEquivalenceGroup.objects.get(pag=self.pag, test_group=self.group)
+
+    def test_add_qc(self):
+        self.assertTrue(self._qc().is_pass)
+        record = models.PAGQualityReportRuleRecord.objects.get(rule__rule_name="acgt")
+        self.assertEqual((record.test_metric_str, record.is_warn, record.is_fail), ("92.0", True, False))
+
+        # The plan is cached once the first request commits
+        with CaptureQueriesContext(connection) as queries:
+            self._qc()
+        self.assertFalse(any("pagqualitytest" in q["sql"].lower() for q in queries.captured_queries))
+
+        # and dropped when a definition changes
+        rule = models.PAGQualityTestRule.objects.get(rule_name="acgt")
+        rule.fail_min = 95
+        rule.save()
+        self.assertFalse(self._qc().is_pass)
+
+    def test_add_qc_other_process_invalidates(self):
+        self.assertTrue(self._qc().is_pass)
+
+        # Another process changes a rule, its receiver bumps the shared generation but cannot clear our cache
+        models.PAGQualityTestRule.objects.filter(rule_name="acgt").update(fail_min=95)
+        self.assertTrue(self._qc().is_pass)
+        models.MajoraFact.objects.filter(namespace="qc", key="plan_generation").update(counter=F("counter") + 1)
+        self.assertFalse(self._qc().is_pass)
+
+    def test_rerun(self):
+        self._qc()
+        rule = models.PAGQualityTestRule.objects.get(rule_name="acgt")
+        rule.fail_min = 95
+        rule.save()
+
+        payload = {"publish_group": [self.pag.published_name, "HOOT/OWL"], "test_name": "hoot-qc", "dry_run": True, "token": "oauth", "username": "oauth"}
+        response = self.c.post(reverse("api.meta.qc.rerun"), payload, secure=True, content_type="application/json", HTTP_AUTHORIZATION="Bearer %s" % self.token)
+        self.assertEqual(200, response.status_code)
+        j = response.json()
+        self.assertEqual(j["ignored"], ["HOOT/OWL"])
+        self.assertEqual(j["results"][self.pag.published_name], {"was_pass": True, "is_pass": False, "messages": []})
+        self.assertTrue(models.PAGQualityReportEquivalenceGroup.objects.get(pag=self.pag, test_group=self.group).is_pass)
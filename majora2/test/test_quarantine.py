@@ -0,0 +1,121 @@
+from io import StringIO
+
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from majora2 import models
+from majora2 import util
+from majora2.test.util import create_full_user
+
+class QuarantinePropagationTest(TestCase):
+    def setUp(self):
+        self.user = create_full_user("hoot")
+
+        self.biosample = models.BiosampleArtifact(central_sample_id="HOOT-00001", dice_name="HOOT-00001")
+        self.biosample.save()
+        self.library = self._derive(self.biosample, models.LibraryArtifact(dice_name="HOOT-LIB"))
+        self.consensus = self._derive(self.library, models.DigitalResourceArtifact(current_name="hoot.fasta", current_path="/hoot/hoot.fasta"))
+
+        self.aliquot = models.LibraryArtifact(dice_name="HOOT-ALIQUOT", root_artifact=self.biosample)
+        self.aliquot.save()
+
+    def _derive(self, parent, child):
+        child.save()
+        process = models.AbstractBioinformaticsProcess(who=self.user, when=timezone.now())
+        process.save()
+        models.MajoraArtifactProcessRecord(process=process, in_artifact=parent, out_artifact=child).save()
+        return child
+
+    def _quarantine(self, artifact, note="hoot"):
+        process = models.MajoraArtifactQuarantinedProcess(who=self.user, when=timezone.now(), note=note)
+        process.save()
+        util.quarantine_artifact(process, artifact, note=note)
+
+    def _reload(self, artifact):
+        return models.MajoraArtifact.objects.get(pk=artifact.pk)
+
+    def test_quarantine_propagates(self):
+        for artifact in [self.biosample, self.library, self.consensus, self.aliquot]:
+            artifact = self._reload(artifact)
+            with CaptureQueriesContext(connection) as queries:
+                self.assertFalse(artifact.is_quarantined)
+                self.assertEqual(artifact.quarantined_reason, "")
+            self.assertEqual(len(queries), 0)
+
+        self._quarantine(self.library)
+        self.assertEqual(self._reload(self.biosample).is_quarantined, False)
+        self.assertEqual(self._reload(self.library).is_quarantined, self.library)
+        self.assertEqual(self._reload(self.consensus).is_quarantined, self.library)
+        self.assertEqual(self._reload(self.aliquot).is_quarantined, False)
+
+        # Quarantining further up makes the biosample the nearest source of its root descendants only
+        self._quarantine(self.biosample)
+        self.assertEqual(self._reload(self.consensus).is_quarantined, self.library)
+        self.assertEqual(self._reload(self.aliquot).is_quarantined, self.biosample)
+
+        # New artifacts derived from quarantined ones are quarantined too
+        child = self._derive(self.consensus, models.DigitalResourceArtifact(current_name="hoot.vcf", current_path="/hoot/hoot.vcf"))
+        self.assertEqual(self._reload(child).is_quarantined, self.library)
+
+    def test_unquarantine(self):
+        self._quarantine(self.biosample)
+        self._quarantine(self.library)
+
+        process = models.MajoraArtifactUnquarantinedProcess(who=self.user, when=timezone.now(), note="unhoot")
+        process.save()
+        util.unquarantine_artifact(process, self.library, note="unhoot")
+        self.assertFalse(self._reload(self.library).quarantined)
+        self.assertEqual(self._reload(self.library).is_quarantined, self.biosample)
+        self.assertEqual(self._reload(self.consensus).is_quarantined, self.biosample)
+
+        util.unquarantine_artifact(process, self.biosample, note="unhoot")
+        for artifact in [self.biosample, self.library, self.consensus, self.aliquot]:
+            self.assertFalse(self._reload(artifact).is_quarantined)
+
+    def test_quarantined_reason(self):
+        self._quarantine(self.library, note="owls")
+        consensus = self._reload(self.consensus)
+        self.assertEqual(consensus.quarantined_reason, "owls")
+
+    def test_rederive_quarantine_command(self):
+        self._quarantine(self.library)
+        models.MajoraArtifact.objects.filter(pk=self.consensus.pk).update(effective_quarantine_source=None)
+        models.MajoraArtifact.objects.filter(pk=self.aliquot.pk).update(effective_quarantine_source=self.library)
+
+        out = StringIO()
+        with self.assertRaises(CommandError):
+            call_command("rederive_quarantine", "--check", stdout=out)
+        self.assertIn("2 with the wrong quarantine source", out.getvalue())
+        self.assertIsNone(self._reload(self.consensus).effective_quarantine_source)
+
+        out = StringIO()
+        call_command("rederive_quarantine", "--chunk-size", "2", stdout=out)
+        self.assertIn("2 quarantine sources updated", out.getvalue())
+        self.assertEqual(self._reload(self.consensus).is_quarantined, self.library)
+        self.assertEqual(self._reload(self.aliquot).is_quarantined, False)
+
+        out = StringIO()
+        call_command("rederive_quarantine", "--check", stdout=out)
+        self.assertIn("0 with the wrong quarantine source", out.getvalue())
+
+    def test_migration_backfill(self):
+        # The migration that fills the closure and quarantine sources of existing
+        # artifacts derives the same sources as the live code
+        from importlib import import_module
+        from django.apps import apps
+        backfill = import_module("majora2.migrations.0158_backfill_closure_and_quarantine")
+
+        self._quarantine(self.biosample)
+        n_closure = models.MajoraArtifactClosure.objects.count()
+        models.MajoraArtifactClosure.objects.all().delete()
+        models.MajoraArtifact.objects.update(effective_quarantine_source=None)
+
+        backfill.fill_closure(apps, None)
+        backfill.fill_quarantine_sources(apps, None)
+        self.assertEqual(models.MajoraArtifactClosure.objects.count(), n_closure)
+        for artifact in [self.biosample, self.library, self.consensus, self.aliquot]:
+            self.assertEqual(self._reload(artifact).is_quarantined, self.biosample)
@@ -2,9 +2,14 @@ import datetime
 
 from django.urls import reverse
 
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
 from majora2 import models
+from majora2 import tasks
 from tatl import models as tmodels
 from majora2.test.test_basic_api import OAuthAPIClientBase
+from majora2.test.util import create_sequenced_pag
 
 class OAuthLibraryArtifactTest(OAuthAPIClientBase):
     def setUp(self):
@@ -246,3 +251,68 @@ class OAuthLibraryArtifactTest(OAuthAPIClientBase):
         self.assertEqual(j["errors"], 1)
         self.assertIn("Failed to get or create a DNASequencingProcess. Possible race condition detected", "".join(j["messages"]))
         self.assertIn("Likely caught other process in the middle of adding a run, advised to resubmit", "".join(j["messages"]))
+
+
+class GetSequencingFasterTaskTest(OAuthAPIClientBase):
+    def setUp(self):
+        super().setUp()
+        self.test_group = models.PAGQualityTestEquivalenceGroup(name="HOOT QC", slug="hoot-qc")
+        self.test_group.save()
+
+    def _add_sample(self, central_sample_id, run_name):
+        create_sequenced_pag(self.user, self.test_group, central_sample_id, run_name)
+        biosample = models.BiosampleArtifact.objects.get(central_sample_id=central_sample_id)
+
+        models.MajoraMetaRecord(artifact=biosample, meta_tag="hoot", meta_name="volume", value="loud", value_type="str").save()
+        models.MajoraMetaRecord(artifact=biosample, meta_tag="hoot", meta_name="secret", value="shh", value_type="str", restricted=True).save()
+
+        ct = models.TemporaryMajoraArtifactMetric_ThresholdCycle(artifact=biosample, namespace="ct", num_tests=1, min_ct=20.0, max_ct=20.0)
+        ct.save()
+        models.TemporaryMajoraArtifactMetricRecord_ThresholdCycle(artifact_metric=ct, ct_value=20.0, test_platform="HOOT", test_target="S", test_kit="HOOTKIT").save()
+
+    def _get_sequencing(self):
+        api_o = {"errors": 0, "warnings": 0, "messages": [], "ignored": []}
+        with CaptureQueriesContext(connection) as queries:
+            api_o = tasks.task_get_sequencing_faster(None, api_o, {})
+        return api_o, len(queries)
+
+    def test_get_sequencing_faster(self):
+        self._add_sample("HOOT-00001", "HOOT-RUN-1")
+        self._add_sample("HOOT-00002", "HOOT-RUN-1")
+
+        api_o, n_queries = self._get_sequencing()
+        self.assertEqual(api_o["errors"], 0)
+        self.assertEqual(api_o["get"]["count_detail"], (1, 2, 2))
+
+        run = api_o["get"]["result"]["HOOT-RUN-1"]
+        self.assertEqual(run["instrument_make"], "ILLUMINA")
+        self.assertEqual(run["sequencing_org_code"], "HOOT")
+        self.assertEqual(sorted(x["library_name"] for x in run["libraries"]), ["HOOT-00001-LIB", "HOOT-00002-LIB"])
+
+        lib = [x for x in run["libraries"] if x["library_name"] == "HOOT-00001-LIB"][0]
+        self.assertEqual(list(lib["biosamples"].keys()), ["HOOT-00001"])
+        bs = lib["biosamples"]["HOOT-00001"]
+        self.assertEqual(bs["library_adaptor_barcode"], "HOOT01")
+        self.assertEqual(bs["library_strategy"], "AMPLICON")
+        self.assertEqual(bs["metadata"], {"hoot": {"volume": "loud"}})
+        self.assertEqual(bs["metrics"]["ct"]["min_ct"], 20.0)
+        self.assertEqual(bs["metrics"]["ct"]["records"][0]["test_kit"], "HOOTKIT")
+        self.assertEqual(bs["published_as"], "HOOT/HOOT-00001/HOOT:HOOT-RUN-1")
+        self.assertEqual(bs["collected_by"], "")
+        self.assertEqual(bs["is_surveillance"], "")
+        self.assertNotIn("in_artifact__dice_name", bs)
+        self.assertNotIn("source_type", bs)
+        self.assertNotIn("dice_name", bs)
+
+    def test_get_sequencing_faster_query_count(self):
+        self._add_sample("HOOT-00001", "HOOT-RUN-1")
+        self._get_sequencing() # warm the ContentType cache used by the polymorphic queries
+        api_o, base_queries = self._get_sequencing()
+        self.assertEqual(api_o["get"]["count_detail"], (1, 1, 1))
+
+        for i in range(2, 6):
+            self._add_sample("HOOT-0000%d" % i, "HOOT-RUN-%d" % i)
+        api_o, n_queries = self._get_sequencing()
+        self.assertEqual(api_o["errors"], 0)
+        self.assertEqual(api_o["get"]["count_detail"], (5, 5, 5))
+        self.assertEqual(n_queries, base_queries)
@@ -1,6 +1,7 @@
 import datetime
 
 from django.contrib.auth.models import User
+from django.utils import timezone
 
 from django_otp import DEVICE_ID_SESSION_KEY
 from django_otp.plugins.otp_static.models import StaticDevice
@@ -19,3 +20,112 @@ def create_full_user(username):
     profile = models.Profile(user=user, institute=hoot, is_site_approved=True)
     profile.save()
     return user
+
+def new_api_o():
+    # An empty api_o, as wrap_api_v2 hands to the functions it wraps
+    return {
+        "errors": 0,
+        "warnings": 0,
+        "messages": [],
+        "tasks": [],
+        "new": [],
+        "updated": [],
+        "ignored": [],
+    }
+
+def create_sequenced_pag(user, test_group, central_sample_id, run_name, is_pass=True):
+    # Build a biosample -> library -> run chain with a consensus and a QC'd PAG
+    biosample = models.BiosampleArtifact(central_sample_id=central_sample_id, dice_name=central_sample_id)
+    biosample.save()
+
+    library = models.LibraryArtifact(dice_name="%s-LIB" % central_sample_id, seq_kit="KIT", seq_protocol="PROTOCOL")
+    library.save()
+    pooling = models.LibraryPoolingProcess(who=user)
+    pooling.save()
+    models.LibraryPoolingProcessRecord(
+        process=pooling,
+        in_artifact=biosample,
+        out_artifact=library,
+        barcode="HOOT01",
+        library_strategy="AMPLICON",
+        library_source="VIRAL_RNA",
+        library_selection="PCR",
+    ).save()
+
+    run, created = models.DNASequencingProcess.objects.get_or_create(run_name=run_name, defaults={
+        "instrument_make": "ILLUMINA",
+        "instrument_model": "MiSeq",
+        "when": timezone.now(),
+        "who": user,
+    })
+    models.DNASequencingProcessRecord(process=run, in_artifact=library).save()
+
+    consensus = models.DigitalResourceArtifact(
+        current_name="%s.fasta" % central_sample_id,
+        current_path="/hoot/%s.fasta" % central_sample_id,
+        current_hash="0" * 32,
+        current_size=29903,
+        current_kind="consensus",
+    )
+    consensus.save()
+
+    pag = models.PublishedArtifactGroup(
+        published_name="HOOT/%s/HOOT:%s" % (central_sample_id, run_name),
+        published_version=1,
+        published_date=datetime.date.today(),
+        is_latest=True,
+        owner=user,
+    )
+    pag.save()
+    pag.tagged_artifacts.add(biosample, consensus)
+
+    models.PAGQualityReportEquivalenceGroup(
+        pag=pag,
+        test_group=test_group,
+        is_pass=is_pass,
+        last_updated=timezone.now(),
+    ).save()
+    return pag
+
+def create_qc_test_group(slug):
+    # A test group of two tests, the first fails a PAG on low pc_acgt OR num_bases (and warns on
+    # pc_acgt below 95), the second only applies to PAGs with hoot.kind OWL and fails long gaps
+    group = models.PAGQualityTestEquivalenceGroup(name=slug, slug=slug)
+    group.save()
+
+    test = models.PAGQualityTest(group=group, name="%s-basic" % slug, slug="%s-basic" % slug)
+    test.save()
+    old = models.PAGQualityTestVersion(test=test, version_number=1, version_date=datetime.date.today())
+    old.save()
+    models.PAGQualityTestRule(test=old, rule_name="old", rule_desc="old", metric_namespace="sequence", metric_name="pc_acgt", fail_min=99).save()
+    tv = models.PAGQualityTestVersion(test=test, version_number=2, version_date=datetime.date.today())
+    tv.save()
+    acgt = models.PAGQualityTestRule(test=tv, rule_name="acgt", rule_desc="acgt", metric_namespace="sequence", metric_name="pc_acgt", warn_min=95, fail_min=90)
+    acgt.save()
+    bases = models.PAGQualityTestRule(test=tv, rule_name="bases", rule_desc="bases", metric_namespace="sequence", metric_name="num_bases", fail_min=25000)
+    bases.save()
+    models.PAGQualityBasicTestDecision(test=tv, a=acgt, b=bases, op="OR").save()
+
+    owl = models.PAGQualityTest(group=group, name="%s-owl" % slug, slug="%s-owl" % slug)
+    owl.save()
+    models.PAGQualityTestFilter(test=owl, filter_name="owl", filter_desc="owl", force_field=True, metadata_namespace="hoot", metadata_name="kind", filter_on_str="OWL", op="EQ").save()
+    owl_tv = models.PAGQualityTestVersion(test=owl, version_number=1, version_date=datetime.date.today())
+    owl_tv.save()
+    gaps = models.PAGQualityTestRule(test=owl_tv, rule_name="gaps", rule_desc="gaps", metric_namespace="sequence", metric_name="longest_gap", fail_max=1000)
+    gaps.save()
+    models.PAGQualityBasicTestDecision(test=owl_tv, a=gaps).save()
+    return group
+
+def add_sequence_metric(artifact, pc_acgt=99.0, num_bases=29903, longest_gap=None):
+    metric = models.TemporaryMajoraArtifactMetric_Sequence(
+        artifact=artifact,
+        namespace="sequence",
+        num_seqs=1,
+        num_bases=num_bases,
+        pc_acgt=pc_acgt,
+        pc_masked=100.0 - pc_acgt,
+        pc_invalid=0.0,
+        longest_gap=longest_gap,
+    )
+    metric.save()
+    return metric
@@ -65,12 +65,15 @@ urlpatterns = [
     path('api/v2/artifact/biosample/get/', csrf_exempt(api_views.get_biosample), name="api.artifact.biosample.get"),
     path('api/v2/artifact/library/add/', csrf_exempt(api_views.add_library), name="api.artifact.library.add"),
     path('api/v2/artifact/file/add/', csrf_exempt(api_views.add_digitalresource), name="api.artifact.file.add"),
+    path('api/v2/artifact/file/batch/', csrf_exempt(api_views.add_digitalresources), name="api.artifact.file.batch"),
     path('api/v2/process/sequencing/add/', csrf_exempt(api_views.add_sequencing), name="api.process.sequencing.add"),
     path('api/v2/process/sequencing/get/', csrf_exempt(api_views.get_sequencing), name="api.process.sequencing.get"),
     path('api/v2/process/sequencing/get2/', csrf_exempt(api_views.get_sequencing2), name="api.process.sequencing.get2"),
     path('api/v2/meta/tag/add/', csrf_exempt(api_views.add_tag), name="api.meta.tag.add"),
     path('api/v2/meta/metric/add/', csrf_exempt(api_views.add_metrics), name="api.meta.metric.add"),
+    path('api/v2/meta/metric/batch/', csrf_exempt(api_views.add_metrics_batch), name="api.meta.metric.batch"),
     path('api/v2/meta/qc/add/', csrf_exempt(api_views.add_qc), name="api.meta.qc.add"),
+    path('api/v2/meta/qc/rerun/', csrf_exempt(api_views.rerun_qc), name="api.meta.qc.rerun"),
     path('api/v2/pag/accession/add/', csrf_exempt(api_views.add_pag_accession), name="api.pag.accession.add"),
     path('api/v2/pag/qc/get/', csrf_exempt(api_views.get_pag_by_qc_celery), name="api.pag.qc.get"),
     path('api/v2/majora/summary/get/', csrf_exempt(api_views.get_dashboard_metrics), name="api.majora.summary.get"),
@@ -80,6 +83,7 @@ urlpatterns = [
     path('api/v2/artifact/biosample/query/validity/', csrf_exempt(api_views.biosample_query_validity), name="api.artifact.biosample.query.validity"),
 
     path('api/v2/group/mag/get/', csrf_exempt(api_views.get_mag), name="api.group.mag.get"),
+    path('api/v2/group/mag/list/', csrf_exempt(api_views.list_mag), name="api.group.mag.list"),
     path('api/v2/group/pag/suppress/', csrf_exempt(api_views.suppress_pag), name="api.group.pag.suppress"),
 
     path('api/v2/majora/task/get/', csrf_exempt(api_views.get_task_result), name="api.majora.task.get"),
@@ -1,11 +1,26 @@
 from . import models
 
 from dateutil.rrule import rrule, DAILY
+import argparse
+import atexit
+import base64
+import collections
 import datetime
+import hashlib
+import json
+import logging
+import multiprocessing
 import re
+import threading
+import time
+import uuid
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connections, transaction
 from django.utils import timezone
 from dateutil.parser import parse
-from django.db.models import F, prefetch_related_objects
+from django.db.models import F, Q, Value, prefetch_related_objects
+from django.db.models.functions import Greatest
 
 def get_mdv_fields(mdv_codename):
     mdv = models.MajoraDataview.objects.filter(code_name=mdv_codename).first()
@@ -18,13 +33,42 @@ def get_mdv_fields(mdv_codename):
             mdv_fields[f.model_name].append(f.model_field)
     return mdv_fields
 
-def get_mag(root, path, sep="/", artifact=False, by_hard_path=False, prefetch=True):
+class QueryCounter(object):
+    # Count the queries issued on a connection, use with connection.execute_wrapper
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
 
+def positive_int(value):
+    # argparse type for the --workers and --chunk-size options of management commands
     try:
-        node = models.DigitalResourceNode.objects.get(node_name=root)
-    except:
-        return None
+        value = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError("must be a positive integer")
+    if value < 1:
+        raise argparse.ArgumentTypeError("must be a positive integer")
+    return value
+
+def _close_connections():
+    # Forked workers must not share the parent's database connection
+    connections.close_all()
 
+def map_in_pool(f, jobs, workers):
+    # Yield f(job) for each job, in the order they finish, from a pool of forked processes
+    # when there is more than one worker and job, otherwise in this process
+    if workers <= 1 or len(jobs) <= 1:
+        for job in jobs:
+            yield f(job)
+        return
+    _close_connections()
+    with multiprocessing.Pool(min(workers, len(jobs)), initializer=_close_connections) as pool:
+        for result in pool.imap_unordered(f, jobs):
+            yield result
+
+def _split_mag_path(path, sep="/", artifact=False):
     lpath = path.split(sep)
     if path[0] == sep:
         # Chop leading path head
@@ -35,20 +79,28 @@ def get_mag(root, path, sep="/", artifact=False, by_hard_path=False, prefetch=Tr
     if artifact:
         # Chop path tail
         lpath = lpath[:-1]
+    return lpath
+
+def get_mag(root, path, sep="/", artifact=False, by_hard_path=False, prefetch=True):
+
+    lpath = _split_mag_path(path, sep=sep, artifact=artifact)
 
+    # Find the MAG by the hash of its path under the node, in one query whatever its depth
+    try:
+        dir_g = models.DigitalResourceGroup.objects.get(
+                root_group__digitalresourcenode__node_name=root,
+                group_path_hash=models.hash_group_path("/".join(lpath)),
+        )
+    except:
+        dir_g = None
 
-    if by_hard_path:
+    if not dir_g and not by_hard_path:
+        # Walk the path a level at a time, for groups that backfill_mag_paths has not reached
         try:
-            dir_g = models.DigitalResourceGroup.objects.get(root_group=node, group_path=sep.join(lpath))
+            node = models.DigitalResourceNode.objects.get(node_name=root)
         except:
             return None
-        a = [dir_g]
-        #prefetch_related_objects(a, 'children', 'groups', 'out_glinks', 'parent_group', 'root_group')
 
-        if prefetch:
-            prefetch_related_objects(a, 'children__tagged_artifacts', 'groups__tagged_artifacts', 'out_glinks', 'parent_group', 'root_group')
-        return a[0]
-    else:
         parent = node
         for i, dir_name in enumerate(lpath):
             try:
@@ -61,10 +113,14 @@ def get_mag(root, path, sep="/", artifact=False, by_hard_path=False, prefetch=Tr
                 parent = dir_g
             except:
                 return None
-        a = [dir_g]
-        if prefetch:
-            prefetch_related_objects(a, 'children__tagged_artifacts', 'groups__tagged_artifacts', 'out_glinks', 'parent_group', 'root_group')
-        return a[0]
+
+    if not dir_g:
+        return None
+    a = [dir_g]
+    #prefetch_related_objects(a, 'children', 'groups', 'out_glinks', 'parent_group', 'root_group')
+    if prefetch:
+        prefetch_related_objects(a, 'children__tagged_artifacts', 'groups__tagged_artifacts', 'out_glinks', 'parent_group', 'root_group')
+    return a[0]
 
 
 def mkroot(node_name):
@@ -88,36 +144,270 @@ def mkmag(path, sep="/", parents=True, artifact=False, physical=True, root=None,
         # Chop path tail
         lpath = lpath[:-1]
 
+    # Fetch every level that already exists in one query, and only create the rest
+    group_paths = ["/".join(lpath[:i+1]) for i in range(len(lpath))]
+    existing = {g.group_path: g for g in models.DigitalResourceGroup.objects.filter(
+            root_group=root,
+            group_path_hash__in=[models.hash_group_path(x) for x in group_paths],
+    )}
+
     mags = []
     mags_created = []
     parent = root
     for i, dir_name in enumerate(lpath):
-        dir_g, created = models.DigitalResourceGroup.objects.get_or_create(
-                group_path=sep.join(lpath[:i+1]),
-                current_name=dir_name,
-                root_group=root,
-                parent_group=parent,
-                physical=physical)
+        dir_g = existing.get(group_paths[i])
+        created = False
+        if not dir_g and not (i > 0 and mags_created[-1]):
+            # Claim a MAG made before paths were stored rather than forking the tree beside it,
+            # the oldest one wins if siblings share a name, as in backfill_mag_paths
+            dir_g = models.DigitalResourceGroup.objects.filter(
+                    root_group=root,
+                    parent_group=parent,
+                    current_name=dir_name,
+                    group_path__isnull=True,
+            ).order_by('id').first()
+            if dir_g:
+                if models.MajoraArtifactGroup.objects.non_polymorphic().filter(pk=dir_g.pk, group_path__isnull=True).update(
+                        group_path=group_paths[i],
+                        group_path_hash=models.hash_group_path(group_paths[i]),
+                        group_path_prefix=models.prefix_group_path(group_paths[i]),
+                ) == 1:
+                    dir_g.group_path = group_paths[i]
+                    dir_g.group_path_hash = models.hash_group_path(group_paths[i])
+                    dir_g.group_path_prefix = models.prefix_group_path(group_paths[i])
+                else:
+                    # Another request claimed it first, so find it by its hash below
+                    dir_g = None
+        if not dir_g:
+            dir_g, created = models.DigitalResourceGroup.objects.get_or_create(
+                    root_group=root,
+                    group_path_hash=models.hash_group_path(group_paths[i]),
+                    defaults={
+                        "group_path": group_paths[i],
+                        "current_name": dir_name,
+                        "parent_group": parent,
+                        "physical": physical,
+                        "temp_kind": kind if i == len(lpath) - 1 else None,
+                    },
+            )
         parent = dir_g
 
         mags.append(dir_g)
         mags_created.append(created)
-    if mags_created[-1]:
-        mags[-1].temp_kind = kind
-        mags[-1].save()
 
+    if root is not None:
+        gen = get_generation("mag", "cache_generation")
+        for i, dir_g in enumerate(mags):
+            _cache_on_commit(_mag_cache, (root.pk, group_paths[i]), (gen, dir_g))
     return mags, mags_created
 
-def quarantine_artifact(process, artifact):
+
+class LocalLRUCache(object):
+    # A bounded, thread safe, per-process LRU whose entries expire after a number of seconds
+    # Its size and TTL are read from settings on use, a TTL of 0 turns the cache off
+    def __init__(self, size_setting, ttl_setting, default_size=10000, default_ttl=300):
+        self.size_setting = size_setting
+        self.ttl_setting = ttl_setting
+        self.default_size = default_size
+        self.default_ttl = default_ttl
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires <= time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        ttl = getattr(settings, self.ttl_setting, self.default_ttl)
+        if ttl <= 0:
+            return
+        size = getattr(settings, self.size_setting, self.default_size)
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > size:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+def get_generation(namespace, key):
+    # Caches held by each process stamp their entries with a generation kept in a counter fact,
+    # read with one lookup on its unique key, and drop any entry whose generation is out of date
+    gen = models.MajoraFact.objects.filter(namespace=namespace, key=key).values_list('counter', flat=True).first()
+    return gen or 0
+
+def bump_generation(namespace, key):
+    # Move a generation on, so every process drops the entries stamped with the old one
+    # Called inside the transaction that makes the change, the bump commits (or rolls back) with it
+    if models.MajoraFact.objects.filter(namespace=namespace, key=key).update(counter=F("counter") + 1, timestamp=timezone.now()) == 0:
+        fact, created = models.MajoraFact.objects.get_or_create(namespace=namespace, key=key, defaults={
+            "value_type": "counter",
+            "counter": 1,
+            "restricted": True,
+            "timestamp": timezone.now(),
+        })
+        if not created:
+            models.MajoraFact.objects.filter(pk=fact.pk).update(counter=F("counter") + 1, timestamp=timezone.now())
+
+# File registrations resolve their node and MAG through these caches, so repeated registrations
+# into the same directory skip the lookups. Cached nodes and MAGs are shared by every request
+# the process serves, so treat them as read only. Missing nodes and paths are never cached,
+# entries are only added once the transaction that found them commits (so a rolled back MAG
+# cannot be handed out), and entries are stamped with the mag.cache_generation fact, which
+# invalidate_mag_cache bumps so that every process drops its entries as soon as the change commits
+_node_cache = LocalLRUCache("MAJORA_MAG_CACHE_SIZE", "MAJORA_MAG_CACHE_TTL")
+_mag_cache = LocalLRUCache("MAJORA_MAG_CACHE_SIZE", "MAJORA_MAG_CACHE_TTL")
+
+def _cache_on_commit(local_cache, key, value):
+    transaction.on_commit(lambda: local_cache.set(key, value))
+
+def _get_cached(local_cache, key, gen):
+    entry = local_cache.get(key)
+    if entry is not None and entry[0] == gen:
+        return entry[1]
+    return None
+
+def get_node(unique_name, create=False):
+    gen = get_generation("mag", "cache_generation")
+    node = _get_cached(_node_cache, unique_name, gen)
+    if node is None:
+        if create:
+            node, created = mkroot(unique_name)
+        else:
+            node = models.DigitalResourceNode.objects.filter(unique_name=unique_name).first()
+            if node is None:
+                return None
+        _cache_on_commit(_node_cache, unique_name, (gen, node))
+    return node
+
+def resolve_mag(node, path, sep="/", artifact=False, create=True):
+    # Find the MAG at path below node (making it if create is set) through the MAG cache
+    # Paths with no directories resolve to the node itself
+    lpath = _split_mag_path(path, sep=sep, artifact=artifact)
+    if len(lpath) == 0:
+        return node
+    key = (node.pk, "/".join(lpath))
+    gen = get_generation("mag", "cache_generation")
+    mag = _get_cached(_mag_cache, key, gen)
+    if mag is None:
+        mag = get_mag(node.node_name, path, sep=sep, artifact=artifact, prefetch=False)
+        if mag is None and create:
+            mags, mags_created = mkmag(path, sep=sep, artifact=artifact, physical=True, root=node)
+            mag = mags[-1]
+        if mag is None:
+            return None
+        _cache_on_commit(_mag_cache, key, (gen, mag))
+    return mag
+
+def resolve_mags(node, paths, sep="/", artifact=False, create=True):
+    # Resolve many paths below node at once, returning a dict of path to MAG (or None)
+    # Paths that miss the MAG cache are looked up by their path hash together, and only
+    # those left over (unhashed legacy paths, or paths to create) go through resolve_mag
+    mags = {}
+    keys = {}
+    gen = get_generation("mag", "cache_generation")
+    for path in set(paths):
+        lpath = _split_mag_path(path, sep=sep, artifact=artifact)
+        if len(lpath) == 0:
+            mags[path] = node
+            continue
+        key = (node.pk, "/".join(lpath))
+        mag = _get_cached(_mag_cache, key, gen)
+        if mag is None:
+            keys[path] = key
+        else:
+            mags[path] = mag
+
+    if len(keys) > 0:
+        found = {g.group_path: g for g in models.DigitalResourceGroup.objects.filter(
+                root_group=node,
+                group_path_hash__in=set([models.hash_group_path(key[1]) for key in keys.values()]),
+        )}
+        for path, key in keys.items():
+            mag = found.get(key[1])
+            if mag is None:
+                mag = resolve_mag(node, path, sep=sep, artifact=artifact, create=create)
+            else:
+                _cache_on_commit(_mag_cache, key, (gen, mag))
+            mags[path] = mag
+    return mags
+
+def invalidate_mag_cache():
+    # Drop every cached node and MAG in this process, and bump the generation so every other process drops theirs
+    _node_cache.clear()
+    _mag_cache.clear()
+    bump_generation("mag", "cache_generation")
+
+def quarantine_artifact(process, artifact, note=""):
     artifact.quarantined = True
 
     qr = models.MajoraArtifactQuarantinedProcessRecord(
         process=process,
         in_artifact=artifact,
         out_artifact=artifact,
+        note=note,
     )
     qr.save()
     artifact.save()
+    refresh_quarantine(artifact)
+
+def unquarantine_artifact(process, artifact, note=""):
+    artifact.quarantined = False
+
+    ur = models.MajoraArtifactUnquarantinedProcessRecord(
+        process=process,
+        in_artifact=artifact,
+        out_artifact=artifact,
+        note=note,
+    )
+    ur.save()
+    artifact.save()
+    refresh_quarantine(artifact)
+
+def refresh_quarantine(artifact):
+    # Re-derive the effective_quarantine_source of an artifact and everything below it,
+    # which is either downstream in the process graph or has it as its root_artifact
+    artifacts = [artifact] + list(models.MajoraArtifact.objects.non_polymorphic().filter(
+        Q(closure_ancestors__ancestor_artifact=artifact) | Q(root_artifact=artifact)
+    ).exclude(id=artifact.id).distinct())
+    return update_quarantine_sources(artifacts)
+
+def update_quarantine_sources(artifacts):
+    # Write the derived quarantine sources of artifacts that have changed, returns how many did
+    from . import lineage
+    sources = lineage.derive_quarantine_sources(artifacts)
+
+    field = models.MajoraArtifact._meta.get_field("effective_quarantine_source")
+    changed = {}
+    for artifact in artifacts:
+        source_id = sources[artifact.pk]
+        if artifact.effective_quarantine_source_id != source_id:
+            artifact.effective_quarantine_source_id = source_id
+            if field.is_cached(artifact):
+                field.delete_cached_value(artifact)
+            if source_id not in changed:
+                changed[source_id] = []
+            changed[source_id].append(artifact.pk)
+    for source_id, artifact_ids in changed.items():
+        models.MajoraArtifact.objects.filter(id__in=artifact_ids).update(effective_quarantine_source_id=source_id)
+    return sum(len(x) for x in changed.values())
 
 def try_date(str_):
     dt = None
@@ -189,3 +479,188 @@ def decrement_fact(namespace, key):
     except models.MajoraFact.DoesNotExist:
         return
     models.MajoraFact.objects.filter(namespace=namespace, key=key).update(counter=F("counter") - 1, timestamp=timezone.now())
+
+def adjust_fact(namespace, key, delta):
+    # Add delta (which may be negative) to a counter fact, creating it only if it does not exist yet
+    # Counters do not go below zero
+    if delta == 0:
+        return
+    counter = Greatest(F("counter") + delta, Value(0))
+    if models.MajoraFact.objects.filter(namespace=namespace, key=key).update(counter=counter, timestamp=timezone.now()) == 0 and delta > 0:
+        models.MajoraFact.objects.get_or_create(namespace=namespace, key=key, value_type="counter")
+        models.MajoraFact.objects.filter(namespace=namespace, key=key).update(counter=counter, timestamp=timezone.now())
+
+# Hot counters (eg. tatl.api_requests) are accumulated in process and added to their
+# MajoraFact every MAJORA_FACT_FLUSH_COUNT increments, rather than every request queueing
+# on the lock of the same row. The tatl request middleware calls flush_facts_if_due once
+# each response is ready, so counts are not held for more than MAJORA_FACT_FLUSH_INTERVAL
+# seconds while requests are being served, and flush_facts runs again when a process
+# exits. Only a hard kill (eg. SIGKILL) loses the counts still held by a process.
+_fact_deltas = {}
+_fact_lock = threading.Lock()
+_fact_state = {"pending": 0, "last_flush": time.monotonic()}
+
+def buffer_fact(namespace, key, delta=1):
+    with _fact_lock:
+        _fact_deltas[(namespace, key)] = _fact_deltas.get((namespace, key), 0) + delta
+        _fact_state["pending"] += 1
+        due = _facts_due()
+    if due:
+        flush_facts()
+
+def _facts_due():
+    # Call with _fact_lock held
+    if _fact_state["pending"] == 0:
+        return False
+    return (_fact_state["pending"] >= getattr(settings, "MAJORA_FACT_FLUSH_COUNT", 100) or
+            time.monotonic() - _fact_state["last_flush"] >= getattr(settings, "MAJORA_FACT_FLUSH_INTERVAL", 30))
+
+def flush_facts_if_due():
+    with _fact_lock:
+        due = _facts_due()
+    if due:
+        flush_facts()
+
+@atexit.register
+def flush_facts():
+    with _fact_lock:
+        deltas = dict(_fact_deltas)
+        _fact_deltas.clear()
+        _fact_state["pending"] = 0
+        _fact_state["last_flush"] = time.monotonic()
+
+    for (namespace, key), delta in deltas.items():
+        if delta == 0:
+            continue
+        try:
+            models.MajoraFact.objects.get_or_create(namespace=namespace, key=key, value_type="counter")
+            models.MajoraFact.objects.filter(namespace=namespace, key=key).update(counter=F("counter") + delta, timestamp=timezone.now())
+        except Exception as e:
+            # Keep the count for the next flush
+            logging.getLogger('majora').warning("Could not flush fact %s.%s: %s" % (namespace, key, str(e)))
+            with _fact_lock:
+                _fact_deltas[(namespace, key)] = _fact_deltas.get((namespace, key), 0) + delta
+
+
+def make_export_cursor(ts):
+    # Opaque cursor handed back to clients polling PAG exports for changes
+    return base64.urlsafe_b64encode(json.dumps({"v": 1, "ts": ts.isoformat()}).encode()).decode()
+
+def parse_export_cursor(cursor):
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+        return parse(payload["ts"])
+    except Exception:
+        raise ValueError("Invalid 'cursor'")
+
+def make_page_cursor(state):
+    # Opaque cursor for the next page of a keyset paginated listing, state must be JSON serialisable
+    return base64.urlsafe_b64encode(json.dumps(dict(state, v=1)).encode()).decode()
+
+def parse_page_cursor(cursor):
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+        if payload.get("v") != 1:
+            raise ValueError()
+        return payload
+    except Exception:
+        raise ValueError("Invalid 'cursor'")
+
+def keyset_page(queryset, fields, page_size, after=None):
+    # Fetch up to page_size rows of queryset ordered by fields, starting after the row whose values
+    # of fields were after. The fields together must be unique and not null (end with the pk), so
+    # each page is a range scan rather than an ever growing OFFSET. Returns the rows and the values
+    # to carry on after, or None if this was the last page
+    queryset = queryset.order_by(*fields)
+    if after:
+        q = Q()
+        for i in range(len(fields)):
+            cond = {fields[j]: after[j] for j in range(i)}
+            cond["%s__gt" % fields[i]] = after[i]
+            q |= Q(**cond)
+        queryset = queryset.filter(q)
+    rows = list(queryset[:page_size + 1])
+    if len(rows) <= page_size:
+        return rows, None
+    rows = rows[:page_size]
+    return rows, [str(rows[-1][f]) if isinstance(rows[-1][f], uuid.UUID) else rows[-1][f] for f in fields]
+
+def mark_pag_exports_stale(pags=None, artifacts=None):
+    # Flag the materialised export documents of the given PAGs (or the PAGs tagging
+    # the given artifacts) so they are rebuilt the next time they are exported
+    q = Q()
+    if pags is not None:
+        q |= Q(pag__in=pags)
+    if artifacts is not None:
+        q |= Q(pag__tagged_artifacts__in=artifacts)
+    if not q:
+        return 0
+    return models.PAGExportDocument.objects.filter(q, is_stale=False).update(is_stale=True)
+
+# Validated API keys are cached for MAJORA_API_KEY_CACHE_TTL seconds so that high rate
+# clients do not pay for the key, permission and profile lookups on every request.
+# Entries are stamped with a per-profile generation (and a global one for permission
+# changes), bumping either invalidates them, see invalidate_api_key_auth
+def _api_key_cache_key(token, username):
+    return "majora:apikey:%s" % hashlib.sha256(("%s\0%s" % (token, username)).encode()).hexdigest()
+
+def _api_key_generations(profile_id):
+    gen_keys = ["majora:apikey:gen", "majora:apikey:gen:%s" % profile_id]
+    gens = cache.get_many(gen_keys)
+    for gen_key in gen_keys:
+        if gen_key not in gens:
+            # A generation that has been evicted must not match anything cached before it was
+            cache.add(gen_key, uuid.uuid4().hex, None)
+            gens[gen_key] = cache.get(gen_key)
+    return [gens[gen_key] for gen_key in gen_keys]
+
+def get_api_key_auth(token, username, permission=None):
+    # Returns the Profile (with user) of a valid, unrevoked ProfileAPIKey, and whether
+    # both the user and the key are allowed to use permission. Returns (None, False)
+    # if the key does not exist, has expired or was revoked
+    cache_key = _api_key_cache_key(token, username)
+    now = timezone.now()
+
+    entry = cache.get(cache_key)
+    if entry and (entry["validity_end"] <= now or entry["generations"] != _api_key_generations(entry["profile_id"])):
+        entry = None
+
+    changed = False
+    if not entry:
+        changed = True
+        try:
+            key = models.ProfileAPIKey.objects.select_related('key_definition__permission').get(key=token, profile__user__username=username, was_revoked=False, validity_start__lt=now, validity_end__gt=now)
+        except models.ProfileAPIKey.DoesNotExist:
+            return None, False
+        entry = {
+            "profile_id": key.profile_id,
+            "validity_end": key.validity_end,
+            "key_permission": key.key_definition.permission.codename if key.key_definition.permission else None,
+            "user_perms": {},
+            "generations": _api_key_generations(key.profile_id),
+        }
+
+    profile = models.Profile.objects.select_related('user', 'institute').get(pk=entry["profile_id"])
+
+    permitted = True
+    if permission:
+        if permission not in entry["user_perms"]:
+            entry["user_perms"][permission] = profile.user.has_perm(permission)
+            changed = True
+        permitted = entry["user_perms"][permission] and entry["key_permission"] == permission.split('.')[1]
+
+    # Only (re)write the entry when it changes, so the TTL bounds how long a
+    # validation can be reused if an invalidation is missed
+    if changed:
+        ttl = min(getattr(settings, "MAJORA_API_KEY_CACHE_TTL", 60), (entry["validity_end"] - now).total_seconds())
+        if ttl > 0:
+            cache.set(cache_key, entry, ttl)
+    return profile, permitted
+
+def invalidate_api_key_auth(profile_id=None):
+    # Drop cached API key validations for one profile, or for everyone
+    if profile_id:
+        gen_key = "majora:apikey:gen:%s" % profile_id
+    else:
+        gen_key = "majora:apikey:gen"
+    cache.set(gen_key, uuid.uuid4().hex, None)
@@ -0,0 +1,156 @@
+import atexit
+import json
+import logging
+import threading
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import router, transaction
+from django.db.models.signals import post_save
+
+logger = logging.getLogger('majora')
+
+# Write-behind buffer for the TatlVerb and TatlPermFlex audit records raised while
+# handling a request. TatlRequestLogMiddleware opens a buffer for each request and
+# flushes it once the response has been built, so the N audit inserts of a request
+# become one bulk_create per model. TATL_AUDIT_MODE controls the durability:
+#   sync     every record is written as soon as it is saved (no buffering)
+#   request  records are bulk written by the web process at the end of the request
+#   queue    records are handed to the tatl.tasks.task_write_audit celery task,
+#            falling back to writing them in the web process if that fails
+# Records raised inside a transaction join the buffer only once it commits (see
+# buffer_record), so a rolled back savepoint or transaction discards its audit
+# records along with its work, just as it would have in sync mode.
+AUDIT_MODES = ["sync", "request", "queue"]
+
+_local = threading.local()
+_open_buffers = set()
+_open_buffers_lock = threading.Lock()
+
+def get_audit_mode():
+    mode = getattr(settings, "TATL_AUDIT_MODE", "request")
+    if mode not in AUDIT_MODES:
+        return "sync"
+    return mode
+
+
+class AuditBuffer(object):
+    def __init__(self):
+        self.records = []
+        self.seen = set()
+        self.closed = False
+        self.lock = threading.Lock()
+
+    def add(self, record):
+        # Records saved more than once before the flush (eg. a TatlPermFlex that
+        # picks up a substitute_user) are written once, in their final state
+        with self.lock:
+            if not self.closed:
+                if id(record) not in self.seen:
+                    self.seen.add(id(record))
+                    self.records.append(record)
+                return
+        # A transaction that commits after the buffer has been closed writes its records itself
+        write_records([record])
+
+    def flush(self, mode=None):
+        with self.lock:
+            records = self.records
+            self.records = []
+            self.seen = set()
+        if len(records) == 0:
+            return 0
+
+        if not mode:
+            mode = get_audit_mode()
+        if mode == "queue":
+            try:
+                from .tasks import task_write_audit
+                task_write_audit.delay(serialize_records(records))
+                return len(records)
+            except Exception as e:
+                logger.warning("[AUDIT] Could not queue %d audit records, writing them now: %s" % (len(records), str(e)))
+        write_records(records)
+        return len(records)
+
+
+def open_buffer():
+    buf = AuditBuffer()
+    _local.buffer = buf
+    with _open_buffers_lock:
+        _open_buffers.add(buf)
+    return buf
+
+def close_buffer(buf):
+    # The view's work has already been committed, so an audit flush that fails is logged
+    # rather than raised, it must not replace the response or the view's own exception
+    if getattr(_local, "buffer", None) is buf:
+        _local.buffer = None
+    try:
+        buf.flush()
+    except Exception as e:
+        logger.error("[AUDIT] Could not flush audit records: %s" % str(e))
+    finally:
+        with buf.lock:
+            buf.closed = True
+        with _open_buffers_lock:
+            _open_buffers.discard(buf)
+
+def buffer_record(record):
+    # Called by the save of buffered models, returns True if the record has been
+    # deferred to the request's buffer and should not be written now
+    buf = getattr(_local, "buffer", None)
+    if buf is None or get_audit_mode() == "sync":
+        return False
+    db = router.db_for_write(record.__class__)
+    if transaction.get_connection(db).in_atomic_block:
+        # Bind the record to the work it describes, if the enclosing savepoint or
+        # transaction rolls back the callback is discarded and the record with it
+        transaction.on_commit(lambda: buf.add(record), using=db)
+    else:
+        buf.add(record)
+    return True
+
+
+def write_records(records):
+    by_model = {}
+    for record in records:
+        if record.__class__ not in by_model:
+            by_model[record.__class__] = []
+        by_model[record.__class__].append(record)
+
+    for model, model_records in by_model.items():
+        db = router.db_for_write(model)
+        model.objects.using(db).bulk_create(model_records)
+
+        # bulk_create skips the signals, send them so the syslog and slack
+        # receivers see every record exactly as if it had been saved
+        for record in model_records:
+            record._state.adding = False
+            record._state.db = db
+            post_save.send(sender=model, instance=record, created=True, update_fields=None, raw=False, using=db)
+
+def serialize_records(records):
+    payload = []
+    for record in records:
+        payload.append({
+            "model": record._meta.label,
+            "fields": {f.attname: getattr(record, f.attname) for f in record._meta.concrete_fields if not f.primary_key},
+        })
+    return json.dumps(payload, cls=DjangoJSONEncoder)
+
+def deserialize_records(payload):
+    from django.apps import apps
+    return [apps.get_model(x["model"])(**x["fields"]) for x in json.loads(payload)]
+
+
+@atexit.register
+def flush_open_buffers():
+    # Do not lose the audit records of requests still in flight at shutdown
+    with _open_buffers_lock:
+        buffers = list(_open_buffers)
+    for buf in buffers:
+        try:
+            buf.flush(mode="request")
+        except Exception as e:
+            logger.error("[AUDIT] Could not flush audit records at exit: %s" % str(e))
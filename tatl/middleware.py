@@ -2,6 +2,8 @@ import json
 import logging
 
 from .models import TatlRequest
+from . import audit
+from majora2 import util
 
 from django.utils import timezone
 from django.urls import resolve
@@ -56,9 +58,15 @@ class TatlRequestLogMiddleware:
         # Add the TREQ to the request scope
         request.treq = treq
 
-        #### PRE CORE  /\
-        response = self.get_response(request)
-        #### POST CORE \/
+        # Buffer the audit records raised by the view and write them once it
+        # has returned, see tatl.audit
+        audit_buffer = audit.open_buffer()
+        try:
+            #### PRE CORE  /\
+            response = self.get_response(request)
+            #### POST CORE \/
+        finally:
+            audit.close_buffer(audit_buffer)
 
         # Check the user hasn't been added by some other middleware (e.g. DRF)
         if not remote_user:
@@ -92,6 +100,12 @@ class TatlRequestLogMiddleware:
             1 if treq.is_api else 0,
         ))
 
+        # Write the hot counters held by this process once they are old enough, see util.buffer_fact
+        try:
+            util.flush_facts_if_due()
+        except Exception as e:
+            logger.warning("Could not flush facts: %s" % str(e))
+
         return response
 
 
@@ -136,6 +150,9 @@ class TempOAuth2TokenMiddleware(MiddlewareMixin):
                 if valid:
                     request.user = request._cached_user = r.user
                     request.tatl_oauth = True
+                    # Keep the validated token so wrap_api_v2 can check its scopes
+                    # without verifying the request all over again
+                    request.tatl_oauth_token = r.access_token
 
     def process_response(self, request, response):
         patch_vary_headers(response, ("Authorization",))
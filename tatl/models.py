@@ -9,7 +9,9 @@ from django.utils.translation import gettext_lazy as _
 
 from oauth2_provider.models import AbstractApplication
 
-from majora2.util import create_or_increment_fact
+from majora2.util import buffer_fact
+
+from . import audit
 
 class TatlRequest(models.Model):
     user = models.ForeignKey(settings.AUTH_USER_MODEL, blank=True, null=True, on_delete=models.PROTECT, related_name="requests")
@@ -35,7 +37,7 @@ class TatlRequest(models.Model):
             # Roughly catch a successful looking API request
             # The treq is saved a few times and the status_code is one of the last things that are changed
             try:
-                create_or_increment_fact(namespace="tatl", key="api_requests")
+                buffer_fact(namespace="tatl", key="api_requests")
             except:
                 pass
         super().save(*args, **kwargs)
@@ -69,6 +71,12 @@ class TatlVerb(models.Model):
     def __str__(self):
         return "%s: %s" % (self.verb, str(self.content_object))
 
+    def save(self, *args, **kwargs):
+        # New verbs may be deferred to the request's audit buffer
+        if self._state.adding and audit.buffer_record(self):
+            return
+        super().save(*args, **kwargs)
+
 class TatlPermFlex(models.Model):
     user = models.ForeignKey(settings.AUTH_USER_MODEL, blank=True, null=True, on_delete=models.PROTECT, related_name="actions")
     substitute_user = models.ForeignKey(settings.AUTH_USER_MODEL, blank=True, null=True, on_delete=models.PROTECT, related_name="su_actions")
@@ -83,6 +91,11 @@ class TatlPermFlex(models.Model):
 
     request = models.ForeignKey('TatlRequest', on_delete=models.PROTECT, related_name="action", blank=True, null=True)
 
+    def save(self, *args, **kwargs):
+        if self._state.adding and audit.buffer_record(self):
+            return
+        super().save(*args, **kwargs)
+
 class OAuth2CodeOnlyApplication(AbstractApplication):
     GRANT_AUTHORIZATION_CODE = "authorization-code"
     GRANT_TYPES = (
@@ -79,8 +79,13 @@ def handle_app_authorized(sender, request, token, **kwargs):
         request.treq.save()
     models.TatlVerb(request=request.treq, verb="OAUTHORIZE", content_object=token.application).save()
 
+# Housekeeping tasks that are not tracked with a TatlTask
+UNTRACKED_TASKS = ["tatl.tasks.task_write_audit"]
+
 @task_prerun.connect()
 def task_prerun(signal=None, sender=None, task_id=None, task=None, args=None, **kwargs):
+    if task.name in UNTRACKED_TASKS:
+        return
     kwargs = kwargs.get("kwargs") # Don't ask
 
     treq = None
@@ -104,6 +109,8 @@ def task_prerun(signal=None, sender=None, task_id=None, task=None, args=None, **
 
 @task_postrun.connect()
 def task_postrun_tatl(signal=None, sender=None, task_id=None, task=None, args=None, retval=None, state=None, **kwargs):
+    if task.name in UNTRACKED_TASKS:
+        return
     ttask = models.TatlTask.objects.get(celery_uuid=task_id)
     now = timezone.now()
     ttask.response_time = now - ttask.timestamp
@@ -112,6 +119,8 @@ def task_postrun_tatl(signal=None, sender=None, task_id=None, task=None, args=No
 
 @task_postrun.connect()
 def task_postrun_slack(signal=None, sender=None, task_id=None, task=None, args=None, retval=None, state=None, **kwargs):
+    if task.name in UNTRACKED_TASKS:
+        return
     if settings.SLACK_CHANNEL:
         ttask = models.TatlTask.objects.get(celery_uuid=task_id)
         slack_message('slack/blank', {
@@ -0,0 +1,12 @@
+from __future__ import absolute_import, unicode_literals
+
+from celery import shared_task
+
+from . import audit
+
+@shared_task
+def task_write_audit(payload):
+    # Consumer for TATL_AUDIT_MODE="queue", writes the audit records of a request
+    records = audit.deserialize_records(payload)
+    audit.write_records(records)
+    return len(records)